@@ -0,0 +1,50 @@
+import hydra
+from dotenv import load_dotenv
+from loguru import logger
+from omegaconf import DictConfig
+
+from src.load_ds_utils import load_coco_ds, load_vqav2_ds
+from src.tensor_cache import build_vision_feature_cache
+from src.utils import init_flamingo
+
+
+@hydra.main(
+    version_base=None,
+    config_path="./configs",
+    config_name="encode_vision_features.yaml",
+)
+def main(cfg: DictConfig):
+    logger.info(f'{cfg=}')
+    if cfg.task.task_name == 'caption':
+        train_ds = load_coco_ds(cfg, split='train')
+    elif cfg.task.task_name == 'vqa':
+        train_ds = load_vqav2_ds(cfg, split='train')
+    else:
+        raise ValueError(f'{cfg.task.task_name=} error, should in ["caption", "vqa"]')
+
+    model, image_processor, tokenizer, autocast_context = init_flamingo(
+        cfg.flamingo.lang_encoder_path,
+        cfg.flamingo.tokenizer_path,
+        cfg.flamingo.flamingo_checkpoint_dir,
+        cfg.flamingo.cross_attn_every_n_layers,
+        cfg.flamingo.hf_root,
+        cfg.precision,
+        cfg.device,
+        cfg.flamingo.load_from_local,
+    )
+    build_vision_feature_cache(
+        cfg.vision_feature_cache_dir,
+        model,
+        image_processor,
+        train_ds,
+        cfg.task.image_field,
+        cfg.device,
+        autocast_context,
+        cfg.batch_size,
+    )
+    logger.info(f'save the vision feature cache to {cfg.vision_feature_cache_dir}')
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    main()
@@ -1,7 +1,6 @@
 import json
 import os
 import random
-from time import sleep
 from typing import Dict, List
 
 import hydra
@@ -11,12 +10,28 @@ from dotenv import load_dotenv
 from loguru import logger
 from omegaconf import DictConfig
 from openicl import PromptTemplate
-from torch.multiprocessing import spawn
-from tqdm import tqdm
 
+from src import profiler
+from src.adaptive_batch import AdaptiveBatchSizer
+from src.beam_search import ICDBeamSearch
+from src.candidate_store import build_candidate_store
 from src.load_ds_utils import load_coco_ds, load_vqav2_ds
-from src.metrics.info_score import get_info_score
-from src.utils import beam_filter, init_flamingo
+from src.metrics.info_score import (
+    PromptTokenizer,
+    ScoreCache,
+    get_beam_info_score,
+)
+from src.pruning import get_clip_proxy_score, successive_halving
+from src.result_log import (
+    append_result_log,
+    find_rank_logs,
+    get_rank_log_path,
+    load_result_log,
+    merge_result_logs,
+)
+from src.task_queue import run_task_queue
+from src.tensor_cache import TensorCache, build_image_cache
+from src.utils import init_flamingo
 
 
 @torch.inference_mode()
@@ -29,161 +44,316 @@ def generate_single_sample_icd(
     candidate_set: Dataset,
     autocast_context,
     device,
+    image_cache=None,
+):
+    return generate_multi_sample_icd(
+        model=model,
+        tokenizer=tokenizer,
+        image_processor=image_processor,
+        test_data_list=[test_data],
+        cfg=cfg,
+        candidate_set_list=[candidate_set],
+        autocast_context=autocast_context,
+        device=device,
+        image_cache=image_cache,
+    )
+
+
+@torch.inference_mode()
+def generate_multi_sample_icd(
+    model,
+    tokenizer,
+    image_processor,
+    test_data_list: List[Dict],
+    cfg: DictConfig,
+    candidate_set_list: List[Dataset],
+    autocast_context,
+    device,
+    image_cache=None,
+    clip_score_list=None,
+    batch_sizer=None,
 ):
+    """
+    Several test samples (anchors) share one beam search loop, so the rows of
+    (anchor, beam, candidate) are packed into the same forward batches.
+    If image_cache is given, the preprocessed images are gathered from it by idx.
+    If cfg.pruning.enable, the candidates of every beam are pruned by the cheap
+    proxies (successive halving) before the full InfoScore, clip_score_list is
+    the {candidate idx: clip similarity} dict of every anchor for the clip proxy.
+    batch_sizer: the AdaptiveBatchSizer of this rank, None uses cfg.batch_size.
+    """
     template = PromptTemplate(
         cfg.task.template,
         column_token_map=dict(cfg.task.column_token_map),
         icd_token=cfg.task.icd_token,
     )
 
-    # 构建test sample prompt
-    test_data_text = template.generate_item(test_data)
-
-    test_data_image = test_data[cfg.task.image_field]
-    test_data_id = test_data['idx']
-
-    # 构建candidate set
-    candidateidx2data = {
-        data['idx']: {
-            'text_input': template.generate_item(data),
-            'image': data[cfg.task.image_field],
-            'idx': data['idx'],
-        }
-        for data in candidate_set
-    }
-    test_data_id_list = [[test_data_id]]
-
-    for _ in range(cfg.few_shot_num):
-        new_test_data_id_list = []
-        new_test_score_list = []
-        for test_data_id_seq in test_data_id_list:
-            # 避免添加重复的结果 将已经添加的进行过滤
-            filtered_candidateidx2data = candidateidx2data.copy()
-            if len(test_data_id_seq) >= 2:
-                filter_id_list = test_data_id_seq[:-1]
-                for i in filter_id_list:
-                    filtered_candidateidx2data.pop(i)
+    anchor_list = []
+    if clip_score_list is None:
+        clip_score_list = [None] * len(test_data_list)
+    with profiler.timer('build_prompts'):
+        for test_data, candidate_set, clip_score in zip(
+            test_data_list, candidate_set_list, clip_score_list
+        ):
+            # 构建candidate set
+            candidateidx2data = {
+                data['idx']: {
+                    'text_input': template.generate_item(data),
+                    'image': (
+                        data[cfg.task.image_field]
+                        if image_cache is None
+                        else image_cache[data['idx']]
+                    ),
+                    'idx': data['idx'],
+                }
+                for data in candidate_set
+            }
+            anchor_list.append(
+                {
+                    # 构建test sample prompt
+                    'test_data_text': template.generate_item(test_data),
+                    'test_data_image': (
+                        test_data[cfg.task.image_field]
+                        if image_cache is None
+                        else image_cache[test_data['idx']]
+                    ),
+                    'test_data_id': test_data['idx'],
+                    'candidateidx2data': candidateidx2data,
+                    'clip_score': clip_score,
+                    'pruned_list': [],
+                }
+            )
 
-            # 构建已经选好的icd + 测试样本的输入
-            icd_id_seq = test_data_id_seq[:-1]
-            lang_x = [candidateidx2data[idx]['text_input'] for idx in icd_id_seq] + [
-                test_data_text
-            ]
-            image_x = [candidateidx2data[idx]['image'] for idx in icd_id_seq] + [
-                test_data_image
-            ]
+    # 候选的text_input在所有beam search step中只tokenize一次
+    prompt_tokenizer = PromptTokenizer(tokenizer)
+    # 以(anchor id, 有序的已选icd id)为key缓存InfoScore和P(y|x), 命中的不再计算
+    # 只有truncated proxy每一步都会重复查询同一个key, 其他情况几乎不会命中
+    use_score_cache = cfg.pruning.enable and any(
+        pruning_round['proxy'] == 'truncated' for pruning_round in cfg.pruning.rounds
+    )
+    score_cache = ScoreCache() if use_score_cache else None
 
-            filtered_idx_list = sorted(list(filtered_candidateidx2data.keys()))
-            info_score = get_info_score(
+    def score_info(beam_inputs):
+        with profiler.timer('info_score'):
+            return get_beam_info_score(
                 model,
                 tokenizer,
                 image_processor,
                 device,
                 icd_join_char=cfg.task.icd_join_char,
-                lang_x=lang_x,
-                image_x=image_x,
-                candidate_set=filtered_candidateidx2data,
+                beam_inputs=beam_inputs,
                 batch_size=cfg.batch_size,
                 autocast_context=autocast_context,
                 split_token=cfg.task.split_token,
+                prefix_kv_cache=cfg.prefix_kv_cache,
+                max_batch_tokens=cfg.max_batch_tokens,
+                vision_features=cfg.vision_feature_cache,
+                prompt_tokenizer=prompt_tokenizer,
+                prefetch_depth=cfg.prefetch_depth,
+                score_cache=score_cache,
+                length_bucketing=cfg.length_bucketing,
+                batch_sizer=batch_sizer,
             )
 
-            # 选出最高的InfoScore
-            scores, indices = info_score.topk(cfg.beam_size)
-            indices = indices.tolist()
-            indices = list(
-                map(
-                    lambda x: filtered_idx_list[x],
-                    indices,
-                )
+    def get_proxy_score(proxy, candidate_idx_list, beam_anchor):
+        if proxy == 'clip':
+            return [
+                [anchor_list[anchor_i]['clip_score'][idx] for idx in idx_list]
+                for anchor_i, idx_list in zip(beam_anchor, candidate_idx_list)
+            ]
+        if proxy != 'truncated':
+            raise ValueError(f'{proxy=} error, should in ["clip", "truncated"]')
+        # 去掉已选icd的InfoScore, 与第一步的key相同, 已计算的直接从缓存中取出
+        anchor_cand_idx = {}
+        for anchor_i, idx_list in zip(beam_anchor, candidate_idx_list):
+            anchor_cand_idx.setdefault(anchor_i, set()).update(idx_list)
+        truncated_score = {}
+        for anchor_i, info_score in zip(
+            anchor_cand_idx,
+            score_info(
+                [
+                    {
+                        'lang_x': [anchor_list[anchor_i]['test_data_text']],
+                        'image_x': [anchor_list[anchor_i]['test_data_image']],
+                        'candidate_set': {
+                            idx: anchor_list[anchor_i]['candidateidx2data'][idx]
+                            for idx in idx_set
+                        },
+                        'cache_key': (anchor_list[anchor_i]['test_data_id'], ()),
+                    }
+                    for anchor_i, idx_set in anchor_cand_idx.items()
+                ]
+            ),
+        ):
+            truncated_score[anchor_i] = dict(
+                zip(sorted(anchor_cand_idx[anchor_i]), info_score.tolist())
             )
-            scores = scores.tolist()
+        return [
+            [truncated_score[anchor_i][idx] for idx in idx_list]
+            for anchor_i, idx_list in zip(beam_anchor, candidate_idx_list)
+        ]
 
-            for idx, score in zip(indices, scores):
-                new_test_data_id_list.append([idx, *test_data_id_seq])
-                new_test_score_list.append(score)
+    def score_beams(step, beams):
+        beam_inputs = []
+        for beam in beams:
+            anchor = anchor_list[beam['anchor']]
+            candidateidx2data = anchor['candidateidx2data']
+            # 构建已经选好的icd + 测试样本的输入
+            icd_id_seq = beam['icd_seq']
+            beam_inputs.append(
+                {
+                    'lang_x': [
+                        candidateidx2data[idx]['text_input'] for idx in icd_id_seq
+                    ]
+                    + [anchor['test_data_text']],
+                    'image_x': [candidateidx2data[idx]['image'] for idx in icd_id_seq]
+                    + [anchor['test_data_image']],
+                    # 已经添加的icd已被beam search的mask过滤
+                    'candidate_set': {
+                        idx: candidateidx2data[idx] for idx in beam['candidate_idx']
+                    },
+                    'cache_key': (anchor['test_data_id'], tuple(icd_id_seq)),
+                }
+            )
+        if not cfg.pruning.enable:
+            # 当前step所有anchor的所有beam的候选一起打包计算
+            return score_info(beam_inputs)
 
-        new_test_score_list, new_test_data_id_list = beam_filter(
-            new_test_score_list, new_test_data_id_list, cfg.beam_size
-        )
-        test_data_id_list = new_test_data_id_list
-    return {
-        test_data_id: {'id_list': test_data_id_list, 'score_list': new_test_score_list}
-    }
+        # 先用低成本的proxy逐轮淘汰候选, 剩下的候选才计算完整的InfoScore
+        # 第一步还没有已选icd, 完整的InfoScore就是truncated proxy, 跳过该轮
+        rounds = [
+            pruning_round
+            for pruning_round in cfg.pruning.rounds
+            if step > 0 or pruning_round['proxy'] != 'truncated'
+        ]
+        beam_anchor = [beam['anchor'] for beam in beams]
+        with profiler.timer('pruning'):
+            survivor_list, pruned_list = successive_halving(
+                [beam['candidate_idx'] for beam in beams],
+                rounds,
+                cfg.beam_size,
+                lambda proxy, idx_list: get_proxy_score(proxy, idx_list, beam_anchor),
+            )
+        for beam_i, beam in enumerate(beams):
+            survivor_list[beam_i] = sorted(survivor_list[beam_i])
+            candidate_set = beam_inputs[beam_i]['candidate_set']
+            beam_inputs[beam_i]['candidate_set'] = {
+                idx: candidate_set[idx] for idx in survivor_list[beam_i]
+            }
+            anchor = anchor_list[beam['anchor']]
+            anchor['pruned_list'].append(
+                {
+                    'step': step,
+                    'beam': [*beam['icd_seq'], anchor['test_data_id']],
+                    **pruned_list[beam_i],
+                }
+            )
+        # 被淘汰的候选分数为-inf, 不会被选中
+        score_list = []
+        for beam, survivors, info_score in zip(
+            beams, survivor_list, score_info(beam_inputs)
+        ):
+            scores = torch.full((len(beam['candidate_idx']),), float('-inf'))
+            scores[
+                torch.searchsorted(
+                    torch.tensor(beam['candidate_idx']), torch.tensor(survivors)
+                )
+            ] = info_score.float()
+            score_list.append(scores)
+        return score_list
+
+    beam_search = ICDBeamSearch(
+        [list(anchor['candidateidx2data']) for anchor in anchor_list],
+        cfg.beam_size,
+        score_beams,
+        # prefix_kv_cache: 新的icd放在已选icd之后, 测试样本之前
+        prepend=not cfg.prefix_kv_cache,
+        dedup=cfg.dedup_beams,
+    ).run(cfg.few_shot_num)
+    if score_cache is not None:
+        logger.info(f'score cache: {score_cache.info()}')
+    if batch_sizer is not None:
+        logger.debug(f'adaptive batch size: {batch_sizer.info()}')
+    res = {}
+    for anchor, anchor_res in zip(
+        anchor_list,
+        beam_search.results([anchor['test_data_id'] for anchor in anchor_list]),
+    ):
+        res[anchor['test_data_id']] = anchor_res
+        if cfg.pruning.enable:
+            res[anchor['test_data_id']]['pruned_list'] = anchor['pruned_list']
+    return res
 
 
 def gen_data(
     rank,
+    task_queue,
     cfg,
-    sample_data,
     train_ds,
+    anchor_idx_list,
     candidate_set_idx,
     save_path,
+    image_cache=None,
+    clip_score_list=None,
 ):
-    world_size = len(cfg.gpu_ids)
+    """
+    Pull the anchor positions from the shared task_queue until it is empty and
+    append the results to the rank log.
+    train_ds: the HF dataset or the CandidateStore, the anchors and candidates
+        are selected from it by the dataset idx.
+    """
     process_device = f'cuda:{cfg.gpu_ids[rank]}'
 
-    subset_size = len(sample_data) // world_size
-    subset_start = rank * subset_size
-    subset_end = (
-        subset_start + subset_size if rank != world_size - 1 else len(sample_data)
-    )
-    subset = sample_data.select(range(subset_start, subset_end))
-    sub_cand_set_idx = candidate_set_idx[subset_start:subset_end]
-
     # load several models will cost large memory at the same time.
-    # use sleep to load one by one.
-    sleep(cfg.sleep_time * rank)
-    model, image_processor, tokenizer, autocast_context = init_flamingo(
-        cfg.flamingo.lang_encoder_path,
-        cfg.flamingo.tokenizer_path,
-        cfg.flamingo.flamingo_checkpoint_dir,
-        cfg.flamingo.cross_attn_every_n_layers,
-        cfg.flamingo.hf_root,
-        cfg.precision,
-        process_device,
-        cfg.flamingo.load_from_local,
-    )
-
-    final_res = {}
-    sub_res_basename = (
-        os.path.basename(save_path).split('.')[0]
-        + f'_rank:{rank}_({subset_start}, {subset_end}).json'
-    )
-    save_path = save_path.replace(os.path.basename(save_path), sub_res_basename)
-    if os.path.exists(save_path):
-        final_res.update(json.load(open(save_path)))
-        logger.info(
-            f'Rank: {rank} reloading data from {save_path}, begin from {len(final_res)}'
+    # the next rank begins loading as soon as the previous one is ready.
+    profiler.configure_from_cfg(cfg.profile, process_device)
+    with task_queue.model_loading(), profiler.timer('load_model'):
+        model, image_processor, tokenizer, autocast_context = init_flamingo(
+            cfg.flamingo.lang_encoder_path,
+            cfg.flamingo.tokenizer_path,
+            cfg.flamingo.flamingo_checkpoint_dir,
+            cfg.flamingo.cross_attn_every_n_layers,
+            cfg.flamingo.hf_root,
+            cfg.precision,
+            process_device,
+            cfg.flamingo.load_from_local,
         )
-    if len(final_res) == subset_size:
-        logger.info(f'Rank: {rank} task is Done.')
-        return
 
-    subset = subset.select(range(len(final_res), len(subset)))
-    for i, test_data in enumerate(
-        tqdm(
-            subset,
-            disable=(rank != 0),
-            total=subset_size,
-            initial=len(final_res),
-            ncols=100,
-        ),
-    ):
-        candidate_set = train_ds.select(sub_cand_set_idx[i])
-        res = generate_single_sample_icd(
-            model=model,
-            tokenizer=tokenizer,
-            image_processor=image_processor,
-            test_data=test_data,
-            cfg=cfg,
-            candidate_set=candidate_set,
-            device=process_device,
-            autocast_context=autocast_context,
-        )
-        final_res.update(res)
-        with open(save_path, 'w') as f:
-            json.dump(final_res, f)
+    # the learned batch size of each length bucket is kept for the whole run
+    batch_sizer = AdaptiveBatchSizer.from_config(cfg.adaptive_batch, cfg.batch_size)
+    save_path = get_rank_log_path(save_path, rank)
+    for _, anchor_pos_list in task_queue:
+        with profiler.timer('select_data'):
+            test_data_list = train_ds.select(
+                [anchor_idx_list[i] for i in anchor_pos_list]
+            )
+            candidate_set_list = [
+                train_ds.select(candidate_set_idx[i]) for i in anchor_pos_list
+            ]
+        with profiler.timer('generate'):
+            res = generate_multi_sample_icd(
+                model=model,
+                tokenizer=tokenizer,
+                image_processor=image_processor,
+                test_data_list=test_data_list,
+                cfg=cfg,
+                candidate_set_list=candidate_set_list,
+                device=process_device,
+                autocast_context=autocast_context,
+                image_cache=image_cache,
+                clip_score_list=(
+                    None
+                    if clip_score_list is None
+                    else [clip_score_list[i] for i in anchor_pos_list]
+                ),
+                batch_sizer=batch_sizer,
+            )
+        with profiler.timer('dump_log'):
+            append_result_log(save_path, res)
+        profiler.count('anchors', len(anchor_pos_list))
+    profiler.export(
+        os.path.join(cfg.profile.dir, os.path.splitext(os.path.basename(save_path))[0])
+    )
     return
 
 
@@ -234,46 +404,89 @@ def main(cfg: DictConfig):
         with open(anchor_set_cache_filename, 'w') as f:
             logger.info(f'save {anchor_set_cache_filename}...')
             json.dump(anchor_idx_list, f)
-    anchor_data = train_ds.select(anchor_idx_list)
 
     candidate_sampler = hydra.utils.instantiate(cfg.sampler)
     candidate_set_idx = candidate_sampler(anchor_idx_list, train_ds)
 
     candidate_set_idx = [candidate_set_idx[k] for k in anchor_idx_list]
-    spawn(
-        gen_data,
-        args=(
-            cfg,
-            anchor_data,
-            train_ds,
-            candidate_set_idx,
-            sub_save_path,
-        ),
-        nprocs=len(cfg.gpu_ids),
-        join=True,
-    )
 
-    world_size = len(cfg.gpu_ids)
-    subset_size = len(anchor_data) // world_size
-    total_data = {}
-    for rank in range(world_size):
-        subset_start = rank * subset_size
-        subset_end = (
-            subset_start + subset_size if rank != world_size - 1 else len(anchor_data)
+    image_cache = None
+    if cfg.vision_feature_cache:
+        # the perceiver features take the place of the preprocessed images
+        image_cache = TensorCache.open(cfg.vision_feature_cache_dir)
+        need_idx_list = set(anchor_idx_list)
+        for cand_idx in candidate_set_idx:
+            need_idx_list.update(cand_idx)
+        missing_idx = image_cache.missing(need_idx_list)
+        if missing_idx:
+            raise ValueError(
+                f'{len(missing_idx)} idx are not in the vision feature cache '
+                f'{cfg.vision_feature_cache_dir}, please run encode_vision_features.py first'
+            )
+    elif cfg.image_cache:
+        need_idx_list = set(anchor_idx_list)
+        for cand_idx in candidate_set_idx:
+            need_idx_list.update(cand_idx)
+        image_cache = build_image_cache(
+            cfg.image_cache_dir,
+            train_ds,
+            need_idx_list,
+            cfg.task.image_field,
         )
-        sub_res_basename = (
-            os.path.basename(save_path).split('.')[0]
-            + f'_rank:{rank}_({subset_start}, {subset_end}).json'
+    if cfg.candidate_store:
+        if image_cache is None:
+            raise ValueError(
+                'candidate_store needs the images from image_cache or vision_feature_cache'
+            )
+        # 所有rank共享同一个内存映射的文本存储, 代替各自pickle的HF dataset
+        train_ds = build_candidate_store(
+            cfg.candidate_store_dir,
+            train_ds,
+            list(cfg.task.input_columns) + ['image_id'],
+        )
+    elif image_cache is not None:
+        # the images come from the cache, avoid decoding them when select the data
+        train_ds = train_ds.remove_columns(cfg.task.image_field)
+
+    clip_score_list = None
+    if cfg.pruning.enable and any(
+        pruning_round['proxy'] == 'clip' for pruning_round in cfg.pruning.rounds
+    ):
+        clip_score_list = get_clip_proxy_score(
+            cfg.pruning.clip_feature_path, anchor_idx_list, candidate_set_idx
         )
-        sub_save_path = sub_save_path.replace(
-            os.path.basename(sub_save_path), sub_res_basename
+
+    # 已完成的anchor从所有rank日志中恢复, 剩余的anchor放入共享队列
+    done_id_set = set()
+    for log_path in find_rank_logs(sub_save_path):
+        done_id_set.update(load_result_log(log_path).keys())
+    todo_pos_list = [
+        i for i, idx in enumerate(anchor_idx_list) if str(idx) not in done_id_set
+    ]
+    logger.info(f'{len(done_id_set)} anchors are done, {len(todo_pos_list)} to do')
+    task_list = [
+        todo_pos_list[i : i + cfg.anchor_batch_size]
+        for i in range(0, len(todo_pos_list), cfg.anchor_batch_size)
+    ]
+    if task_list:
+        run_task_queue(
+            gen_data,
+            args=(
+                cfg,
+                train_ds,
+                anchor_idx_list,
+                candidate_set_idx,
+                sub_save_path,
+                image_cache,
+                clip_score_list,
+            ),
+            task_list=task_list,
+            nprocs=len(cfg.gpu_ids),
+            max_parallel_load=cfg.max_parallel_model_load,
+            max_task_retries=cfg.max_task_retries,
         )
-        with open(sub_save_path, 'r') as f:
-            data = json.load(f)
-        logger.info(f'load the data from {sub_save_path}, the data length: {len(data)}')
-        total_data.update(data)
-    with open(save_path, 'w') as f:
-        json.dump(total_data, f)
+
+    merge_result_logs(find_rank_logs(sub_save_path), save_path)
     logger.info(f'save the final data to {save_path}')
 
 
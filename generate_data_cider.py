@@ -1,7 +1,6 @@
 import json
 import os
 import random
-from time import sleep
 from typing import Dict, List
 
 import hydra
@@ -12,33 +11,28 @@ from loguru import logger
 from omegaconf import DictConfig
 from openicl import PromptTemplate
 from PIL import Image
-from torch.multiprocessing import spawn
-from tqdm import tqdm
 
+from src import profiler
+from src.adaptive_batch import AdaptiveBatchSizer
+from src.beam_search import ICDBeamSearch
+from src.candidate_store import build_candidate_store
 from src.load_ds_utils import load_coco_ds, load_vqav2_ds
-from src.metrics.cider_calculator import get_cider_score
-from src.utils import encode_image, encode_text, init_flamingo, recall_sim_feature
-
-
-def load_feature_cache(cfg, cache_path, encoding_method, train_ds, data_key):
-    if os.path.exists(cache_path):
-        features = torch.load(cache_path)
-    else:
-        features = encoding_method(
-            train_ds,
-            data_key,
-            cfg.device,
-            cfg.sim_model_type,
-            cfg.candidate_set_encode_bs,
-        )
-        torch.save(features, cache_path)
-    return features
-
-
-def beam_filter(score_list, data_id_list, beam_size):
-    score_list = torch.tensor(score_list)
-    score_value, indices = torch.topk(score_list, beam_size)
-    return score_value.tolist(), [data_id_list[idx] for idx in indices]
+from src.metrics.cider_calculator import CiderReferenceIndex, get_cider_score
+from src.result_log import (
+    append_result_log,
+    find_rank_logs,
+    get_rank_log_path,
+    load_result_log,
+    merge_result_logs,
+)
+from src.task_queue import run_task_queue
+from src.tensor_cache import TensorCache, build_image_cache
+from src.utils import (
+    init_flamingo,
+    load_feature_cache,
+    recall_sim_feature,
+    remove_anchor,
+)
 
 
 @torch.inference_mode()
@@ -51,7 +45,18 @@ def generate_single_sample_icd(
     candidate_set: Dataset,
     autocast_context,
     device,
+    image_cache=None,
+    batch_sizer=None,
+    cider_index=None,
 ):
+    """
+    cider_index: the CiderReferenceIndex of the train annotations, shared by the
+        whole run. None loads it from cfg.dataset.train_coco_annotation_file.
+    """
+    if cider_index is None:
+        cider_index = CiderReferenceIndex(
+            cfg.dataset.train_coco_annotation_file, ptb_tokenizer=cfg.ptb_tokenizer
+        )
     template = PromptTemplate(
         cfg.task.template,
         column_token_map=dict(cfg.task.column_token_map),
@@ -63,154 +68,137 @@ def generate_single_sample_icd(
         test_data, output_field=cfg.task.output_column
     )
 
-    test_data_image = test_data[cfg.task.image_field]
+    test_data_image = (
+        test_data[cfg.task.image_field]
+        if image_cache is None
+        else image_cache[test_data['idx']]
+    )
     test_data_id = test_data['idx']
 
     # 构建candidate set
     candidateidx2data = {
         data['idx']: {
             'text_input': template.generate_item(data),
-            'image': data[cfg.task.image_field],
+            'image': (
+                data[cfg.task.image_field]
+                if image_cache is None
+                else image_cache[data['idx']]
+            ),
             'idx': data['idx'],
             'image_id': data['image_id'],
         }
         for data in candidate_set
     }
-    test_data_id_list = [[test_data_id]]
-
-    for _ in range(cfg.few_shot_num):
-        new_test_data_id_list = []
-        new_test_score_list = []
-        for test_data_id_seq in test_data_id_list:
-            # 避免添加重复的结果 将已经添加的进行过滤
-            filtered_candidateidx2data = candidateidx2data.copy()
-            if len(test_data_id_seq) >= 2:
-                filter_id_list = test_data_id_seq[:-1]
-                for i in filter_id_list:
-                    filtered_candidateidx2data.pop(i)
 
+    def score_beams(step, beams):
+        score_list = []
+        for beam in beams:
             # 构建已经选好的icd + 测试样本的输入
-            icd_id_seq = test_data_id_seq[:-1]
+            icd_id_seq = beam['icd_seq']
             lang_x = [candidateidx2data[idx]['text_input'] for idx in icd_id_seq] + [
                 test_data_text
             ]
             image_x = [candidateidx2data[idx]['image'] for idx in icd_id_seq] + [
                 test_data_image
             ]
-
-            filtered_idx_list = sorted(list(filtered_candidateidx2data.keys()))
-            info_score = get_cider_score(
-                model,
-                tokenizer,
-                image_processor,
-                device,
-                icd_join_char=cfg.task.icd_join_char,
-                lang_x=lang_x,
-                image_x=image_x,
-                candidate_set=filtered_candidateidx2data,
-                batch_size=cfg.batch_size,
-                train_ann_path=cfg.dataset.train_coco_annotation_file,
-                gen_kwargs=cfg.task.gen_args,
-                autocast_context=autocast_context,
-            )
-
-            # 选出最高的InfoScore
-            scores, indices = info_score.topk(cfg.beam_size)
-            indices = indices.tolist()
-            indices = list(
-                map(
-                    lambda x: filtered_idx_list[x],
-                    indices,
+            score_list.append(
+                get_cider_score(
+                    model,
+                    tokenizer,
+                    image_processor,
+                    device,
+                    icd_join_char=cfg.task.icd_join_char,
+                    lang_x=lang_x,
+                    image_x=image_x,
+                    # 已经添加的icd已被beam search的mask过滤
+                    candidate_set={
+                        idx: candidateidx2data[idx] for idx in beam['candidate_idx']
+                    },
+                    batch_size=cfg.batch_size,
+                    cider_index=cider_index,
+                    gen_kwargs=cfg.task.gen_args,
+                    autocast_context=autocast_context,
+                    vision_features=cfg.vision_feature_cache,
+                    prefetch_depth=cfg.prefetch_depth,
+                    batch_sizer=batch_sizer,
+                    stop_strings=cfg.task.get('stop_strings'),
                 )
             )
-            scores = scores.tolist()
-
-            for idx, score in zip(indices, scores):
-                new_test_data_id_list.append([idx, *test_data_id_seq])
-                new_test_score_list.append(score)
+        return score_list
 
-        new_test_score_list, new_test_data_id_list = beam_filter(
-            new_test_score_list, new_test_data_id_list, cfg.beam_size
-        )
-        test_data_id_list = new_test_data_id_list
-    return {
-        test_data_id: {'id_list': test_data_id_list, 'score_list': new_test_score_list}
-    }
+    beam_search = ICDBeamSearch(
+        [list(candidateidx2data)], cfg.beam_size, score_beams, dedup=cfg.dedup_beams
+    ).run(cfg.few_shot_num)
+    return {test_data_id: beam_search.results([test_data_id])[0]}
 
 
 def gen_data(
     rank,
+    task_queue,
     cfg,
-    sample_data,
     train_ds,
+    anchor_idx_list,
     candidate_set_idx,
     save_path,
+    image_cache=None,
 ):
-    world_size = len(cfg.gpu_ids)
+    """
+    Pull the anchor positions from the shared task_queue until it is empty and
+    append the results to the rank log.
+    train_ds: the HF dataset or the CandidateStore, the anchors and candidates
+        are selected from it by the dataset idx.
+    """
     process_device = f'cuda:{cfg.gpu_ids[rank]}'
 
-    subset_size = len(sample_data) // world_size
-    subset_start = rank * subset_size
-    subset_end = (
-        subset_start + subset_size if rank != world_size - 1 else len(sample_data)
-    )
-    subset = sample_data.select(range(subset_start, subset_end))
-    sub_cand_set_idx = candidate_set_idx[subset_start:subset_end]
-
     # load several models will cost large memory at the same time.
-    # use sleep to load one by one.
-    sleep(cfg.sleep_time * rank)
-    model, image_processor, tokenizer, autocast_context = init_flamingo(
-        cfg.flamingo.lang_encoder_path,
-        cfg.flamingo.tokenizer_path,
-        cfg.flamingo.flamingo_checkpoint_dir,
-        cfg.flamingo.cross_attn_every_n_layers,
-        cfg.flamingo.hf_root,
-        cfg.precision,
-        process_device,
-        cfg.flamingo.load_from_local,
-    )
-
-    final_res = {}
-    sub_res_basename = (
-        os.path.basename(save_path).split('.')[0]
-        + f'_rank:{rank}_({subset_start}, {subset_end}).json'
-    )
-    save_path = save_path.replace(os.path.basename(save_path), sub_res_basename)
-    if os.path.exists(save_path):
-        final_res.update(json.load(open(save_path)))
-        logger.info(
-            f'Rank: {rank} reloading data from {save_path}, begin from {len(final_res)}'
+    # the next rank begins loading as soon as the previous one is ready.
+    profiler.configure_from_cfg(cfg.profile, process_device)
+    with task_queue.model_loading(), profiler.timer('load_model'):
+        model, image_processor, tokenizer, autocast_context = init_flamingo(
+            cfg.flamingo.lang_encoder_path,
+            cfg.flamingo.tokenizer_path,
+            cfg.flamingo.flamingo_checkpoint_dir,
+            cfg.flamingo.cross_attn_every_n_layers,
+            cfg.flamingo.hf_root,
+            cfg.precision,
+            process_device,
+            cfg.flamingo.load_from_local,
         )
-    if len(final_res) == subset_size:
-        logger.info(f'Rank: {rank} task is Done.')
-        return
 
-    subset = subset.select(range(len(final_res), len(subset)))
-    for i, test_data in enumerate(
-        tqdm(
-            subset,
-            disable=(rank != 0),
-            total=subset_size,
-            initial=len(final_res),
-            ncols=100,
-        ),
-    ):
-        candidate_set = train_ds.select(sub_cand_set_idx[i])
-        res = generate_single_sample_icd(
-            model=model,
-            tokenizer=tokenizer,
-            image_processor=image_processor,
-            test_data=test_data,
-            cfg=cfg,
-            candidate_set=candidate_set,
-            device=process_device,
-            autocast_context=autocast_context,
+    # the learned batch size of each length bucket is kept for the whole run
+    batch_sizer = AdaptiveBatchSizer.from_config(cfg.adaptive_batch, cfg.batch_size)
+    # the train references are tokenized once instead of for every beam
+    with profiler.timer('load_cider_index'):
+        cider_index = CiderReferenceIndex(
+            cfg.dataset.train_coco_annotation_file, ptb_tokenizer=cfg.ptb_tokenizer
         )
-        final_res.update(res)
-
-        with open(save_path, 'w') as f:
-            json.dump(final_res, f)
+    save_path = get_rank_log_path(save_path, rank)
+    for _, anchor_pos_list in task_queue:
+        # the cider version processes one anchor per task
+        anchor_pos = anchor_pos_list[0]
+        with profiler.timer('select_data'):
+            test_data = train_ds.select([anchor_idx_list[anchor_pos]])[0]
+            candidate_set = train_ds.select(candidate_set_idx[anchor_pos])
+        with profiler.timer('generate'):
+            res = generate_single_sample_icd(
+                model=model,
+                tokenizer=tokenizer,
+                image_processor=image_processor,
+                test_data=test_data,
+                cfg=cfg,
+                candidate_set=candidate_set,
+                device=process_device,
+                autocast_context=autocast_context,
+                image_cache=image_cache,
+                batch_sizer=batch_sizer,
+                cider_index=cider_index,
+            )
+        with profiler.timer('dump_log'):
+            append_result_log(save_path, res)
+        profiler.count('anchors')
+    profiler.export(
+        os.path.join(cfg.profile.dir, os.path.splitext(os.path.basename(save_path))[0])
+    )
     return
 
 
@@ -268,7 +256,6 @@ def main(cfg: DictConfig):
         with open(anchor_set_cache_filename, 'w') as f:
             logger.info(f'save {anchor_set_cache_filename}...')
             json.dump(anchor_idx_list, f)
-    anchor_data = train_ds.select(anchor_idx_list)
 
     if os.path.exists(candidate_set_cache_filename):
         logger.info('the candidate set cache exists, loding...')
@@ -289,10 +276,10 @@ def main(cfg: DictConfig):
         else:
             # pre-calculate the cache feature for knn search
             if cfg.candidate_set_method == 'text-sim':
-                encoding_method = encode_text
+                modality = 'text'
                 data_key = cfg.task.sim_text_field
             elif cfg.candidate_set_method == 'image-sim':
-                encoding_method = encode_image
+                modality = 'image'
                 data_key = cfg.task.sim_image_field
             else:
                 raise ValueError('the candidate_set_method error')
@@ -300,59 +287,89 @@ def main(cfg: DictConfig):
             train_cache_path = os.path.join(
                 cache_dir,
                 f'{cfg.task.task_name}-{cfg.dataset.name}-'
-                f'{cfg.candidate_set_method}-{sim_model_name}-feature.pth',
+                f'{cfg.candidate_set_method}-{sim_model_name}-feature',
             )
             train_feature = load_feature_cache(
-                cfg, train_cache_path, encoding_method, train_ds, data_key
+                cfg, train_cache_path, modality, train_ds, data_key
             )
             test_feature = train_feature[anchor_idx_list]
             _, sim_sample_idx = recall_sim_feature(
                 test_feature, train_feature, top_k=cfg.candidate_set_num + 1
             )
-
-            sim_sample_idx = sim_sample_idx[:, 1:].tolist()
-            candidate_set_idx = {
-                idx: cand for idx, cand in zip(anchor_idx_list, sim_sample_idx)
-            }
+            candidate_set_idx = remove_anchor(
+                anchor_idx_list, sim_sample_idx, cfg.candidate_set_num
+            )
         with open(candidate_set_cache_filename, 'w') as f:
             logger.info(f'save {candidate_set_cache_filename}...')
             json.dump(candidate_set_idx, f)
     candidate_set_idx = [candidate_set_idx[k] for k in anchor_idx_list]
 
-    spawn(
-        gen_data,
-        args=(
-            cfg,
-            anchor_data,
+    image_cache = None
+    if cfg.vision_feature_cache:
+        # the perceiver features take the place of the preprocessed images
+        image_cache = TensorCache.open(cfg.vision_feature_cache_dir)
+        need_idx_list = set(anchor_idx_list)
+        for cand_idx in candidate_set_idx:
+            need_idx_list.update(cand_idx)
+        missing_idx = image_cache.missing(need_idx_list)
+        if missing_idx:
+            raise ValueError(
+                f'{len(missing_idx)} idx are not in the vision feature cache '
+                f'{cfg.vision_feature_cache_dir}, please run encode_vision_features.py first'
+            )
+    elif cfg.image_cache:
+        need_idx_list = set(anchor_idx_list)
+        for cand_idx in candidate_set_idx:
+            need_idx_list.update(cand_idx)
+        image_cache = build_image_cache(
+            cfg.image_cache_dir,
             train_ds,
-            candidate_set_idx,
-            sub_save_path,
-        ),
-        nprocs=len(cfg.gpu_ids),
-        join=True,
-    )
-
-    world_size = len(cfg.gpu_ids)
-    subset_size = len(anchor_data) // world_size
-    total_data = {}
-    for rank in range(world_size):
-        subset_start = rank * subset_size
-        subset_end = (
-            subset_start + subset_size if rank != world_size - 1 else len(anchor_data)
+            need_idx_list,
+            cfg.task.image_field,
         )
-        sub_res_basename = (
-            os.path.basename(save_path).split('.')[0]
-            + f'_rank:{rank}_({subset_start}, {subset_end}).json'
+
+    if cfg.candidate_store:
+        if image_cache is None:
+            raise ValueError(
+                'candidate_store needs the images from image_cache or vision_feature_cache'
+            )
+        # 所有rank共享同一个内存映射的文本存储, 代替各自pickle的HF dataset
+        train_ds = build_candidate_store(
+            cfg.candidate_store_dir,
+            train_ds,
+            list(cfg.task.input_columns) + ['image_id'],
         )
-        sub_save_path = sub_save_path.replace(
-            os.path.basename(sub_save_path), sub_res_basename
+    elif image_cache is not None:
+        # the images come from the cache, avoid decoding them when select the data
+        train_ds = train_ds.remove_columns(cfg.task.image_field)
+
+    # 已完成的anchor从所有rank日志中恢复, 剩余的anchor放入共享队列
+    done_id_set = set()
+    for log_path in find_rank_logs(sub_save_path):
+        done_id_set.update(load_result_log(log_path).keys())
+    todo_pos_list = [
+        i for i, idx in enumerate(anchor_idx_list) if str(idx) not in done_id_set
+    ]
+    logger.info(f'{len(done_id_set)} anchors are done, {len(todo_pos_list)} to do')
+    task_list = [todo_pos_list[i : i + 1] for i in range(0, len(todo_pos_list), 1)]
+    if task_list:
+        run_task_queue(
+            gen_data,
+            args=(
+                cfg,
+                train_ds,
+                anchor_idx_list,
+                candidate_set_idx,
+                sub_save_path,
+                image_cache,
+            ),
+            task_list=task_list,
+            nprocs=len(cfg.gpu_ids),
+            max_parallel_load=cfg.max_parallel_model_load,
+            max_task_retries=cfg.max_task_retries,
         )
-        with open(sub_save_path, 'r') as f:
-            data = json.load(f)
-        logger.info(f'load the data from {sub_save_path}, the data length: {len(data)}')
-        total_data.update(data)
-    with open(save_path, 'w') as f:
-        json.dump(total_data, f)
+
+    merge_result_logs(find_rank_logs(sub_save_path), save_path)
     logger.info(f'save the final data to {save_path}')
 
 
@@ -29,6 +29,7 @@ from src.load_ds_utils import load_coco_ds, load_vqav2_ds
 from src.metrics.cider_calculator import compute_cider
 from src.metrics.vqa_metrics import compute_vqa_accuracy, postprocess_vqa_generation
 from src.models import GPT2ICDLM, LSTMICDLM
+from src.stopping import get_stop_kwargs
 from src.utils import init_flamingo
 
 
@@ -68,6 +69,7 @@ def evaluate_retriever(
                 icd_prompt,
                 cfg.dataset.val_coco_annotation_file,
                 output_files,
+                cfg.ptb_tokenizer,
             )
         elif cfg.task.task_name == 'vqa':
             metric = inference_vqa(
@@ -138,6 +140,7 @@ def inference_caption(
     icd_prompt,
     val_ann_path,
     output_json_filename,
+    ptb_tokenizer='java',
 ):
     output_dict = inferencer.inference(
         retriever,
@@ -155,7 +158,7 @@ def inference_caption(
                 .replace('"', ""),
             }
         )
-    cider_score = compute_cider(pred_coco, val_ann_path)
+    cider_score = compute_cider(pred_coco, val_ann_path, ptb_tokenizer=ptb_tokenizer)
     return cider_score * 100
 
 
@@ -246,7 +249,18 @@ def main(cfg: DictConfig):
         num_workers=cfg.num_workers,
         num_proc=cfg.num_proc,
         preprocessor_bs=cfg.preprocessor_bs,
-        generation_kwargs=cfg.task.gen_args,
+        generation_kwargs={
+            # each row stops at the marker of the next example instead of
+            # max_new_tokens, the rest is cut off by the post-processing anyway.
+            # An explicit eos_token_id of gen_args wins
+            **get_stop_kwargs(
+                model,
+                tokenizer,
+                cfg.task.get('stop_strings'),
+                cfg.task.gen_args.get('num_beams', 1),
+            ),
+            **cfg.task.gen_args,
+        },
         output_json_filepath=os.path.join(result_dir, 'generation_metainfo'),
     )
 
@@ -350,6 +364,7 @@ def main(cfg: DictConfig):
                     icd_prompt,
                     cfg.dataset.val_coco_annotation_file,
                     output_files,
+                    cfg.ptb_tokenizer,
                 )
             elif cfg.task.task_name == 'vqa':
                 metric = inference_vqa(
@@ -0,0 +1,265 @@
+"""
+Throughput benchmark of the data generation (InfoScore and CIDEr beam search)
+and the few-shot inference on the CPU stand-in Flamingo and a synthetic COCO
+like dataset, no GPU or checkpoint is needed. Run from the repo root:
+    python scripts/benchmark_generation.py --num_anchors 8
+    python scripts/benchmark_generation.py --save_path base.json
+    python scripts/benchmark_generation.py --compare base.json prefix_kv_cache=true
+
+The extra key=value arguments override configs/generate_data.yaml (and the
+cider config for the cider suite, which needs java for the default
+ptb_tokenizer=java). A suite that fails stops the benchmark.
+With --compare, the exit code is 1 if any throughput drops more than
+--tolerance, or a suite of the baseline did not run.
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+from loguru import logger
+from omegaconf import OmegaConf
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+from src import profiler
+from src.mock_flamingo import build_synthetic_coco, init_mock_flamingo
+from src.stopping import get_stop_kwargs
+from src.utils import build_vision_input, flamingo_generate
+
+
+def get_rss():
+    # the resident memory of this process in bytes
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextmanager
+def peak_memory(device, result, interval=0.01):
+    """The peak memory (MB) above the start, sampled in a background thread."""
+    if torch.device(device).type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        begin = torch.cuda.memory_allocated(device)
+        yield
+        result['peak_memory_mb'] = (
+            torch.cuda.max_memory_allocated(device) - begin
+        ) / 2**20
+        return
+
+    begin = get_rss()
+    peak = [begin]
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(interval):
+            peak[0] = max(peak[0], get_rss())
+
+    thread = threading.Thread(target=sample, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+        peak[0] = max(peak[0], get_rss())
+        result['peak_memory_mb'] = (peak[0] - begin) / 2**20
+
+
+def load_cfg(config_name, overrides, ann_path):
+    cfg = OmegaConf.load(os.path.join(ROOT, 'configs', config_name))
+    cfg.task = OmegaConf.load(os.path.join(ROOT, 'configs', 'task', 'caption.yaml'))
+    cfg.dataset = {'train_coco_annotation_file': ann_path}
+    cfg.device = 'cpu'
+    return OmegaConf.merge(cfg, OmegaConf.from_dotlist(overrides))
+
+
+def run_suite(name, fn, device):
+    result = {}
+    profiler.configure(enable=True)
+    begin = time.perf_counter()
+    with peak_memory(device, result):
+        anchor_num = fn()
+    result['time'] = time.perf_counter() - begin
+    counters = profiler.summary()['counters']
+    result['anchors/s'] = anchor_num / result['time']
+    if 'candidate_scores' in counters:
+        result['candidate_scores/s'] = counters['candidate_scores'] / result['time']
+    profiler.configure(enable=False)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--suites', default='info_score,cider,inference')
+    parser.add_argument('--num_samples', type=int, default=200)
+    parser.add_argument('--num_anchors', type=int, default=8)
+    parser.add_argument('--candidate_num', type=int, default=32)
+    parser.add_argument('--shot_num', type=int, default=2)
+    parser.add_argument('--max_new_tokens', type=int, default=10)
+    parser.add_argument('--hidden_size', type=int, default=128)
+    parser.add_argument('--num_layers', type=int, default=4)
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument(
+        '--device', default='cuda' if torch.cuda.is_available() else 'cpu'
+    )
+    parser.add_argument('--save_path', default=None)
+    parser.add_argument('--compare', default=None)
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args, overrides = parser.parse_known_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    ann_dir = tempfile.mkdtemp()
+    ann_path = os.path.join(ann_dir, 'captions_synthetic.json')
+    train_ds = build_synthetic_coco(args.num_samples, ann_dir=ann_dir)
+    model, image_processor, tokenizer, autocast_context = init_mock_flamingo(
+        args.device, hidden_size=args.hidden_size, num_layers=args.num_layers
+    )
+    rng = random.Random(0)
+    anchor_idx_list = rng.sample(range(len(train_ds)), args.num_anchors)
+    candidate_set_idx = [
+        rng.sample(
+            [idx for idx in range(len(train_ds)) if idx != anchor_idx],
+            args.candidate_num,
+        )
+        for anchor_idx in anchor_idx_list
+    ]
+    gen_args = {'max_new_tokens': args.max_new_tokens}
+
+    def info_score_suite():
+        import generate_data
+
+        cfg = load_cfg('generate_data.yaml', overrides, ann_path)
+        cfg.task.gen_args.update(gen_args)
+        for begin in range(0, len(anchor_idx_list), cfg.anchor_batch_size):
+            pos_list = range(begin, begin + cfg.anchor_batch_size)
+            pos_list = [pos for pos in pos_list if pos < len(anchor_idx_list)]
+            generate_data.generate_multi_sample_icd(
+                model,
+                tokenizer,
+                image_processor,
+                train_ds.select([anchor_idx_list[pos] for pos in pos_list]),
+                cfg,
+                [train_ds.select(candidate_set_idx[pos]) for pos in pos_list],
+                autocast_context,
+                args.device,
+            )
+        return len(anchor_idx_list)
+
+    def cider_suite():
+        import generate_data_cider
+
+        from src.metrics.cider_calculator import CiderReferenceIndex
+
+        cfg = load_cfg('generate_data_cider.yaml', overrides, ann_path)
+        cfg.task.gen_args.update(gen_args)
+        # built once per rank by gen_data, so it is shared by all anchors here
+        cider_index = CiderReferenceIndex(ann_path, ptb_tokenizer=cfg.ptb_tokenizer)
+        for anchor_idx, cand_idx in zip(anchor_idx_list, candidate_set_idx):
+            generate_data_cider.generate_single_sample_icd(
+                model,
+                tokenizer,
+                image_processor,
+                train_ds[anchor_idx],
+                cfg,
+                train_ds.select(cand_idx),
+                autocast_context,
+                args.device,
+                cider_index=cider_index,
+            )
+        return len(anchor_idx_list)
+
+    def inference_suite():
+        # the few-shot caption generation of every anchor with random icds
+        cfg = load_cfg('generate_data.yaml', overrides, ann_path)
+        inference_gen_args = {**cfg.task.gen_args, **gen_args}
+        for begin in range(0, len(anchor_idx_list), cfg.batch_size):
+            batch_idx = anchor_idx_list[begin : begin + cfg.batch_size]
+            prompts, images = [], []
+            for anchor_idx in batch_idx:
+                icd_idx = rng.sample(range(len(train_ds)), args.shot_num)
+                prompts.append(
+                    cfg.task.icd_join_char.join(
+                        [
+                            f'<image>Output:{train_ds[idx]["single_caption"]}'
+                            for idx in icd_idx
+                        ]
+                        + ['<image>Output:']
+                    )
+                )
+                images.append(
+                    [
+                        image_processor(train_ds[idx]['image'])
+                        for idx in icd_idx + [anchor_idx]
+                    ]
+                )
+            lang_x = tokenizer(prompts, return_tensors='pt', padding=True)
+            with autocast_context:
+                flamingo_generate(
+                    model,
+                    lang_x['input_ids'].to(args.device),
+                    lang_x['attention_mask'].to(args.device),
+                    **build_vision_input(images, args.device),
+                    pad_token_id=tokenizer.pad_token_id,
+                    **{
+                        **get_stop_kwargs(
+                            model,
+                            tokenizer,
+                            cfg.task.get('stop_strings'),
+                            inference_gen_args.get('num_beams', 1),
+                        ),
+                        **inference_gen_args,
+                    },
+                )
+        return len(anchor_idx_list)
+
+    suites = {
+        'info_score': info_score_suite,
+        'cider': cider_suite,
+        'inference': inference_suite,
+    }
+    results = {}
+    for name in args.suites.split(','):
+        results[name] = run_suite(name, suites[name], args.device)
+        print(
+            f'{name:<12} '
+            + ', '.join(f'{k}: {v:.2f}' for k, v in results[name].items())
+        )
+
+    if args.save_path is not None:
+        with open(args.save_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regression = False
+        for name in baseline:
+            if name not in results:
+                logger.error(f'the baseline suite {name} did not run')
+                regression = True
+        for name, result in results.items():
+            for key, value in result.items():
+                if not key.endswith('/s') or key not in baseline.get(name, {}):
+                    continue
+                ratio = value / baseline[name][key]
+                flag = ''
+                if ratio < 1 - args.tolerance:
+                    regression = True
+                    flag = ' REGRESSION'
+                print(f'{name} {key}: {ratio:.2f}x of the baseline{flag}')
+        sys.exit(1 if regression else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Micro-benchmark of the loss masking in get_ppl: the old python double loop vs
+get_masked_ce_loss. Run from the repo root:
+    python scripts/benchmark_get_ppl.py --batch_size 32 --seq_len 512
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.metrics.info_score import get_masked_ce_loss
+
+
+def loop_ce_loss(logits, lang_x, icd_token_length, pad_token_id=0):
+    # the implementation before the vectorization
+    shift_logits = logits[..., :-1, :].contiguous()
+    shift_labels = lang_x[..., 1:].contiguous()
+    loss_fct = torch.nn.CrossEntropyLoss(reduction='none', ignore_index=pad_token_id)
+    loss = loss_fct(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
+    loss = loss.view(shift_labels.size())
+
+    loss_mask = torch.zeros_like(shift_labels)
+    for i in range(len(loss_mask)):
+        for j in range(icd_token_length[i] - 1, len(loss_mask[i])):
+            loss_mask[i][j] = 1
+    loss = loss * loss_mask
+    lens = (lang_x != pad_token_id).sum(-1)
+    lens -= torch.tensor(icd_token_length, device=lens.device)
+    return loss.sum(-1) / lens
+
+
+def benchmark(fn, repeat, device):
+    times = []
+    for _ in range(repeat):
+        if device.startswith('cuda'):
+            torch.cuda.synchronize(device)
+        begin = time.perf_counter()
+        out = fn()
+        if device.startswith('cuda'):
+            torch.cuda.synchronize(device)
+        times.append(time.perf_counter() - begin)
+    return out, sorted(times)[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--seq_len', type=int, default=512)
+    parser.add_argument('--vocab_size', type=int, default=1024)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument(
+        '--device', default='cuda' if torch.cuda.is_available() else 'cpu'
+    )
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    pad_token_id = 0
+    logits = torch.randn(
+        args.batch_size, args.seq_len, args.vocab_size, device=args.device
+    )
+    lang_x = torch.randint(
+        1, args.vocab_size, (args.batch_size, args.seq_len), device=args.device
+    )
+    # right padding and a random context length for every sample
+    seq_lens = torch.randint(args.seq_len // 2, args.seq_len + 1, (args.batch_size,))
+    for i, length in enumerate(seq_lens.tolist()):
+        lang_x[i, length:] = pad_token_id
+    icd_token_length = [
+        int(torch.randint(1, length // 2, ()).item()) for length in seq_lens.tolist()
+    ]
+
+    loop_out, loop_time = benchmark(
+        lambda: loop_ce_loss(logits, lang_x, icd_token_length, pad_token_id),
+        args.repeat,
+        args.device,
+    )
+    vec_out, vec_time = benchmark(
+        lambda: get_masked_ce_loss(logits, lang_x, icd_token_length, pad_token_id),
+        args.repeat,
+        args.device,
+    )
+    print(
+        f'batch_size={args.batch_size} seq_len={args.seq_len} '
+        f'vocab_size={args.vocab_size} device={args.device}'
+    )
+    print(f'loop:       {loop_time * 1000:.2f} ms')
+    print(f'vectorized: {vec_time * 1000:.2f} ms ({loop_time / vec_time:.1f}x)')
+    print(f'max abs diff: {(loop_out - vec_out).abs().max().item():.3e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""
+Parity check of the python PTB tokenizer (src/metrics/ptb_tokenizer.py) against
+the java PTBTokenizer of pycocoevalcap. Run from the repo root:
+    python scripts/check_ptb_tokenizer.py
+    python scripts/check_ptb_tokenizer.py --ann_path captions_train2017.json
+
+The built-in cases are always checked against their reference outputs, which
+were generated by the java tokenizer. With java available, the captions of
+--ann_path (at most --num) are also tokenized by both and diffed token for
+token: the differing captions, the most frequent differing token spans and
+the share of the java tokens the python tokenizer reproduces are printed.
+The exit code is 1 on any mismatch.
+"""
+
+import argparse
+import collections
+import difflib
+import json
+import os
+import shutil
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.metrics.ptb_tokenizer import PTBTokenizer
+
+# (caption, the output of the java PTBTokenizer of pycocoevalcap), regenerate
+# them with --print_reference when the cases are changed
+REFERENCE_CASES = [
+    (
+        'A man riding a wave on top of a surfboard.',
+        'a man riding a wave on top of a surfboard',
+    ),
+    ('A dog\'s toy, lying on the "grass".', "a dog 's toy lying on the grass"),
+    ("The kids don't want to eat.", "the kids do n't want to eat"),
+    ("Two cats can't sit still!", "two cats ca n't sit still"),
+    ("They're sitting; it's 10:30 now", "they 're sitting it 's 10:30 now"),
+    ('A black-and-white photo of a t-shirt.', 'a black-and-white photo of a t-shirt'),
+    ('It is 3.5 miles... away!', 'it is 3.5 miles away'),
+    ('A 1,000 pound weight cannot fly', 'a 1,000 pound weight can not fly'),
+    ("The dogs' toys are at the U.S. border", 'the dogs toys are at the u.s. border'),
+    ('Is this a cat?  Yes: a cat - a big one', 'is this a cat yes a cat a big one'),
+    ('A 1950s car in 2nd place', 'a 1950s car in 2nd place'),
+    ("A clock showing 5 o'clock", "a clock showing 5 o'clock"),
+    (
+        'A grey cat in the centre of a colourful room.',
+        'a grey cat in the centre of a colourful room',
+    ),
+    (
+        'A dog sitting on a bench.The sky is blue.',
+        'a dog sitting on a bench.the sky is blue',
+    ),
+    (
+        'A b/w photo of a pizza w/ cheese and/or olives',
+        'a b/w photo of a pizza w / cheese and/or olives',
+    ),
+    (
+        'A sign for www.example.com and x.org/path.',
+        'a sign for www.example.com and x.org/path',
+    ),
+    (
+        'Email me@example.com or visit http://a.b/c.',
+        'email me@example.com or visit http://a.b/c',
+    ),
+    ("Rock 'n' roll fans and rock'n'roll", "rock 'n' roll fans and rock 'n' roll"),
+    ("'Tis the season of the '90s, y'all", "'t is the season of the '90s y' all"),
+    ('A sign that says No. 5 and no.7', 'a sign that says no. 5 and no. 7'),
+    ('Mr. Smith and dr. Who near mt. Fuji', 'mr. smith and dr. who near mt. fuji'),
+    (
+        'The AT&T store near an R&D lab and a r&b band',
+        'the at&t store near an r&d lab and a r & b band',
+    ),
+    (
+        'A C++ book, a C# book and **bold** text',
+        'a c++ book a c# book and ** bold ** text',
+    ),
+    ('A file named my_photo_1.jpg on a__b', 'a file named my_photo_1 jpg on a __ b'),
+    (
+        'The 12/25/2010 party and 1/2/3/4 pizza',
+        'the 12/25/2010 party and 1/2/3 / 4 pizza',
+    ),
+    ('A happy dog :) next to a cat :-(', 'a happy dog :-rrb- next to a cat :--lrb-'),
+    ('A pizza \U0001f355 on a plate', 'a pizza on a plate'),
+    (
+        'The @home sign and a #1 fan with #hashtag',
+        'the @home sign and a # 1 fan with #hashtag',
+    ),
+    ('I see a. And B. too', 'i see a. and b. too'),
+]
+
+
+def load_captions(ann_path, num):
+    with open(ann_path, 'r') as f:
+        annotations = json.load(f)['annotations'][:num]
+    return {ann['id']: [{'caption': ann['caption']}] for ann in annotations}
+
+
+def token_diff(java_tokens, python_tokens):
+    """The (java span, python span) of every token difference of two captions."""
+    java_tokens, python_tokens = java_tokens.split(' '), python_tokens.split(' ')
+    matcher = difflib.SequenceMatcher(a=java_tokens, b=python_tokens, autojunk=False)
+    return [
+        (' '.join(java_tokens[i1:i2]), ' '.join(python_tokens[j1:j2]))
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+        if tag != 'equal'
+    ]
+
+
+def compare_with_java(captions, show):
+    """Tokenize the captions by both, print the differences, return their num."""
+    from pycocoevalcap.tokenizer.ptbtokenizer import PTBTokenizer as JavaPTBTokenizer
+
+    begin = time.perf_counter()
+    java_tokens = JavaPTBTokenizer().tokenize(captions)
+    java_time = time.perf_counter() - begin
+    begin = time.perf_counter()
+    python_tokens = PTBTokenizer().tokenize(captions)
+    python_time = time.perf_counter() - begin
+
+    diff = [k for k in captions if java_tokens[k] != python_tokens[k]]
+    for k in diff[:show]:
+        print(
+            f'{captions[k][0]["caption"]!r}\n'
+            f'  python: {python_tokens[k][0]!r}\n'
+            f'  java: {java_tokens[k][0]!r}'
+        )
+    # token for token: the java tokens which the python tokenizer does not
+    # reproduce, and the most frequent differences
+    token_num = sum(len(java_tokens[k][0].split(' ')) for k in captions)
+    diff_num = 0
+    span_counter = collections.Counter()
+    for k in diff:
+        for java_span, python_span in token_diff(
+            java_tokens[k][0], python_tokens[k][0]
+        ):
+            diff_num += len(java_span.split(' ')) if java_span else 0
+            span_counter[java_span, python_span] += 1
+    for (java_span, python_span), count in span_counter.most_common(show):
+        print(f'{count:>8}  java: {java_span!r}  python: {python_span!r}')
+    print(
+        f'{len(captions) - len(diff)}/{len(captions)} captions identical, '
+        f'{token_num - diff_num}/{token_num} java tokens reproduced, '
+        f'java {java_time:.2f}s, python {python_time:.2f}s'
+    )
+    return len(diff)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ann_path', default=None)
+    parser.add_argument('--num', type=int, default=100000)
+    parser.add_argument('--show', type=int, default=20)
+    parser.add_argument(
+        '--print_reference',
+        action='store_true',
+        help='print REFERENCE_CASES with the outputs of the java tokenizer',
+    )
+    args = parser.parse_args()
+
+    if args.print_reference:
+        from pycocoevalcap.tokenizer.ptbtokenizer import (
+            PTBTokenizer as JavaPTBTokenizer,
+        )
+
+        outputs = JavaPTBTokenizer().tokenize(
+            {i: [{'caption': c}] for i, (c, _) in enumerate(REFERENCE_CASES)}
+        )
+        print('REFERENCE_CASES = [')
+        for i, (caption, _) in enumerate(REFERENCE_CASES):
+            print(f'    ({caption!r}, {outputs[i][0]!r}),')
+        print(']')
+        return
+
+    tokenizer = PTBTokenizer()
+    mismatch = 0
+    for caption, reference in REFERENCE_CASES:
+        output = tokenizer.tokenize({0: [{'caption': caption}]})[0][0]
+        if output != reference:
+            mismatch += 1
+            print(f'{caption!r}\n  python: {output!r}\n  reference: {reference!r}')
+    print(f'reference cases: {len(REFERENCE_CASES) - mismatch}/{len(REFERENCE_CASES)}')
+
+    if args.ann_path is not None:
+        if shutil.which('java') is None:
+            print('java is not found, skip the comparison with the java tokenizer')
+        else:
+            print(f'{args.ann_path}:')
+            mismatch += compare_with_java(
+                load_captions(args.ann_path, args.num), args.show
+            )
+    sys.exit(1 if mismatch else 0)
+
+
+if __name__ == '__main__':
+    main()
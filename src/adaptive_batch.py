@@ -0,0 +1,169 @@
+from typing import Callable, List, Optional
+
+import torch
+from loguru import logger
+
+
+def is_oom_error(e: Exception) -> bool:
+    if isinstance(e, torch.cuda.OutOfMemoryError):
+        return True
+    return isinstance(e, RuntimeError) and 'out of memory' in str(e)
+
+
+def free_device_memory():
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+class AdaptiveBatchSizer:
+    """
+    Learn the batch size of every sequence length bucket during the run.
+
+    A bucket starts from batch_size. When a batch runs out of memory it is split
+    and retried by the caller, and the bucket (and every longer bucket) is never
+    grown to that size again. After grow_after successive full batches the size
+    grows by 25% until it reaches max_batch_size or the known OOM size.
+
+    simulate_oom_tokens: raise a simulated OOM when a batch has more padded tokens
+        (row num * max length) than it, to test the backoff on CPU.
+    """
+
+    def __init__(
+        self,
+        batch_size: int,
+        max_batch_size: Optional[int] = None,
+        bucket_width: int = 64,
+        grow_after: int = 4,
+        simulate_oom_tokens: Optional[int] = None,
+    ):
+        self.batch_size = batch_size
+        self.max_batch_size = max_batch_size or batch_size
+        self.bucket_width = bucket_width
+        self.grow_after = grow_after
+        self.simulate_oom_tokens = simulate_oom_tokens
+        # bucket -> current batch size / the smallest batch size that OOM
+        self.bucket_size = {}
+        self.oom_size = {}
+        self.success_num = {}
+
+    def get_bucket(self, length):
+        return length // self.bucket_width
+
+    def get_limit(self, bucket):
+        # a longer bucket can not run a batch size that OOM on a shorter one
+        oom_size = [size for b, size in self.oom_size.items() if b <= bucket]
+        if not oom_size:
+            return self.max_batch_size
+        return max(1, min(min(oom_size) - 1, self.max_batch_size))
+
+    def get_batch_size(self, length):
+        bucket = self.get_bucket(length)
+        size = self.bucket_size.get(bucket, self.batch_size)
+        return min(size, self.get_limit(bucket))
+
+    def check_simulated_oom(self, batch_num, length):
+        if (
+            self.simulate_oom_tokens is not None
+            and batch_num * length > self.simulate_oom_tokens
+        ):
+            raise torch.cuda.OutOfMemoryError(
+                f'simulated out of memory: {batch_num} x {length} tokens'
+            )
+
+    def on_success(self, batch_num, length):
+        bucket = self.get_bucket(length)
+        size = self.get_batch_size(length)
+        if batch_num < size:
+            # the batch is not full, it tells nothing about the headroom
+            return
+        self.success_num[bucket] = self.success_num.get(bucket, 0) + 1
+        if self.success_num[bucket] < self.grow_after:
+            return
+        self.success_num[bucket] = 0
+        new_size = min(size + max(1, size // 4), self.get_limit(bucket))
+        if new_size > size:
+            logger.debug(f'batch size of length bucket {bucket}: {size} -> {new_size}')
+        self.bucket_size[bucket] = new_size
+
+    def on_oom(self, batch_num, length):
+        bucket = self.get_bucket(length)
+        self.oom_size[bucket] = min(self.oom_size.get(bucket, batch_num), batch_num)
+        self.bucket_size[bucket] = max(1, batch_num // 2)
+        self.success_num[bucket] = 0
+        logger.warning(
+            f'OOM with {batch_num} rows of length {length}, '
+            f'batch size of length bucket {bucket} -> {self.bucket_size[bucket]}'
+        )
+        free_device_memory()
+
+    def info(self):
+        return ', '.join(
+            f'{bucket * self.bucket_width}+: {self.get_batch_size(bucket * self.bucket_width)}'
+            for bucket in sorted(self.bucket_size)
+        )
+
+    @classmethod
+    def from_config(cls, cfg, batch_size):
+        if cfg is None or not cfg.enable:
+            return None
+        return cls(
+            batch_size,
+            max_batch_size=cfg.max_batch_size,
+            bucket_width=cfg.bucket_width,
+            grow_after=cfg.grow_after,
+            simulate_oom_tokens=cfg.simulate_oom_tokens,
+        )
+
+
+def run_with_backoff(
+    run_fn: Callable,
+    build_fn: Callable,
+    batch_index: List[int],
+    lengths,
+    batch_sizer: Optional[AdaptiveBatchSizer] = None,
+    batch=None,
+):
+    """
+    run_fn(build_fn(batch_index)) with the OOM backoff of batch_sizer. If the
+    batch runs out of memory, it is split into halves, each half is rebuilt by
+    build_fn and retried. run_fn should save its results by itself, since a
+    batch may finish in several parts.
+    lengths: the token length of every row, indexed by the items of batch_index.
+    batch: the already built batch of batch_index, e.g. from a Prefetcher.
+    """
+    batch_len = max(lengths[i] for i in batch_index)
+    if batch_sizer is not None:
+        # the batch was planned before a later OOM lowered the batch size
+        size = batch_sizer.get_batch_size(batch_len)
+        if len(batch_index) > size:
+            for begin in range(0, len(batch_index), size):
+                run_with_backoff(
+                    run_fn,
+                    build_fn,
+                    batch_index[begin : begin + size],
+                    lengths,
+                    batch_sizer,
+                )
+            return
+    oom = False
+    try:
+        if batch is None:
+            batch = build_fn(batch_index)
+        if batch_sizer is not None:
+            batch_sizer.check_simulated_oom(len(batch_index), batch_len)
+        run_fn(batch)
+    except Exception as e:
+        if batch_sizer is None or len(batch_index) == 1 or not is_oom_error(e):
+            raise
+        oom = True
+    # retry outside the except block, so the traceback does not hold the device
+    # memory of the failed batch
+    batch = None
+    if not oom:
+        if batch_sizer is not None:
+            batch_sizer.on_success(len(batch_index), batch_len)
+        return
+    batch_sizer.on_oom(len(batch_index), batch_len)
+    half = len(batch_index) // 2
+    for sub_index in (batch_index[:half], batch_index[half:]):
+        run_with_backoff(run_fn, build_fn, sub_index, lengths, batch_sizer)
@@ -0,0 +1,167 @@
+import math
+import os
+import time
+from typing import Optional
+
+import faiss
+import numpy as np
+from loguru import logger
+
+from src.feature_store import iter_feature_chunks
+
+
+class AnnIndex:
+    """
+    The inner product (cosine for the normalized features) knn index of the
+    similarity samplers.
+
+    index_type: flat (exact), ivf or hnsw. The ivf/hnsw index is saved next to
+        the feature cache as <feature_cache>.<index name>.faiss and reused by the
+        later runs and configs, only the build parameters are in the name, so
+        the search parameters (nprobe, ef_search) can change freely.
+    nlist: the num of ivf clusters, None uses 4 * sqrt(N) (at most N / 39, so
+        every cluster has enough training points).
+    recall_check_num: the num of queries to report the recall@k of the ivf/hnsw
+        index against the flat index, 0 disables it.
+    The features can be an array or a FeatureStore, which is added to the index
+    shard by shard.
+    """
+
+    def __init__(
+        self,
+        index_type: str = 'flat',
+        nlist: Optional[int] = None,
+        hnsw_m: int = 32,
+        ef_construction: int = 200,
+        nprobe: int = 32,
+        ef_search: int = 128,
+        recall_check_num: int = 1000,
+    ):
+        if index_type not in ('flat', 'ivf', 'hnsw'):
+            raise ValueError(f'{index_type=} error, should in ["flat", "ivf", "hnsw"]')
+        self.index_type = index_type
+        self.nlist = nlist
+        self.hnsw_m = hnsw_m
+        self.ef_construction = ef_construction
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.recall_check_num = recall_check_num
+        self.last_recall = None
+
+    @classmethod
+    def from_config(cls, cfg):
+        if cfg is None:
+            return cls()
+        return cls(
+            index_type=cfg.type,
+            nlist=cfg.nlist,
+            hnsw_m=cfg.hnsw_m,
+            ef_construction=cfg.ef_construction,
+            nprobe=cfg.nprobe,
+            ef_search=cfg.ef_search,
+            recall_check_num=cfg.recall_check_num,
+        )
+
+    @property
+    def exact(self):
+        return self.index_type == 'flat'
+
+    def get_nlist(self, num):
+        return self.nlist or max(1, min(int(4 * math.sqrt(num)), num // 39))
+
+    def get_name(self, num):
+        if self.index_type == 'ivf':
+            return f'ivf{self.get_nlist(num)}'
+        if self.index_type == 'hnsw':
+            return f'hnsw{self.hnsw_m}-efc{self.ef_construction}'
+        return 'flat'
+
+    def build(self, features):
+        num, dim = features.shape
+        if self.index_type == 'flat':
+            index = faiss.IndexFlatIP(dim)
+        elif self.index_type == 'ivf':
+            nlist = self.get_nlist(num)
+            index = faiss.index_factory(
+                dim, f'IVF{nlist},Flat', faiss.METRIC_INNER_PRODUCT
+            )
+            # faiss建议每个聚类中心最多用256个训练样本
+            train_num = min(num, nlist * 256)
+            train_idx = np.random.RandomState(0).choice(num, train_num, replace=False)
+            index.train(
+                np.ascontiguousarray(features[np.sort(train_idx)], dtype=np.float32)
+            )
+        else:
+            index = faiss.IndexHNSWFlat(dim, self.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = self.ef_construction
+        for _, chunk in iter_feature_chunks(features):
+            index.add(chunk)
+        return index
+
+    def load_or_build(self, features, feature_cache: Optional[str] = None):
+        if self.exact or feature_cache is None:
+            return self.build(features)
+        index_path = f'{feature_cache}.{self.get_name(len(features))}.faiss'
+        if os.path.exists(index_path):
+            index = faiss.read_index(index_path)
+            if index.ntotal == len(features) and index.d == features.shape[1]:
+                logger.info(f'load the {self.index_type} index from {index_path}')
+                return index
+            logger.warning(
+                f'the index {index_path} ({index.ntotal} x {index.d}) does not match '
+                f'the features {features.shape}, rebuilding...'
+            )
+        begin = time.perf_counter()
+        index = self.build(features)
+        logger.info(
+            f'build the {self.index_type} index of {features.shape} in '
+            f'{time.perf_counter() - begin:.1f}s, saving to {index_path}'
+        )
+        faiss.write_index(index, index_path)
+        return index
+
+    def set_search_params(self, index):
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            ivf.nprobe = self.nprobe
+        if hasattr(index, 'hnsw'):
+            index.hnsw.efSearch = max(self.ef_search, 1)
+
+    def search(self, query, features, top_k, feature_cache: Optional[str] = None):
+        query = np.ascontiguousarray(query, dtype=np.float32)
+        index = self.load_or_build(features, feature_cache)
+        self.set_search_params(index)
+        dist, idx = index.search(query, top_k)
+        if not self.exact and self.recall_check_num > 0:
+            self.last_recall = self.get_recall(query, features, idx, top_k)
+            logger.info(
+                f'{self.index_type} index (nprobe: {self.nprobe}, '
+                f'ef_search: {self.ef_search}) recall@{top_k}: {self.last_recall:.4f}'
+            )
+        return dist, idx
+
+    def get_recall(self, query, features, idx, top_k):
+        """The mean recall@k of the first recall_check_num queries vs the flat index."""
+        check_num = min(self.recall_check_num, len(query))
+        _, exact_idx = exact_search(query[:check_num], features, top_k)
+        hit = [
+            len(set(exact_idx[i].tolist()) & set(idx[i].tolist()))
+            for i in range(check_num)
+        ]
+        return float(np.sum(hit) / (check_num * top_k))
+
+
+def exact_search(query, features, top_k):
+    """
+    The exact inner product top_k of the query over the features (an array or a
+    FeatureStore), searched chunk by chunk, only one chunk is in memory.
+    """
+    query = np.ascontiguousarray(query, dtype=np.float32)
+    heap = faiss.ResultHeap(len(query), top_k, keep_max=True)
+    for start, chunk in iter_feature_chunks(features):
+        dist, idx = faiss.knn(
+            query, chunk, min(top_k, len(chunk)), faiss.METRIC_INNER_PRODUCT
+        )
+        heap.add_result(dist, np.where(idx >= 0, idx + start, -1))
+    heap.finalize()
+    return heap.D, heap.I
@@ -0,0 +1,151 @@
+from typing import Callable, Dict, List
+
+import torch
+
+from src import profiler
+
+
+class ICDBeamSearch:
+    """
+    The beam search of the ICD sequences of several anchors, the beams are kept
+    as tensors:
+        cand_idx: (A, C) the sorted candidate idx of every anchor, padded by -1
+        beam_pos: (A, K, t) the position in cand_idx of the chosen icds
+        beam_mask: (A, K, C) True for the chosen icds and the padding, which can
+            not be added to the beam again
+        beam_score: (A, K) the score of the last step, -inf for an empty beam
+
+    scorer(step, beams) -> a 1-D score tensor of every beam, in the order of
+        beam['candidate_idx']. Each beam is a dict of anchor (the anchor index),
+        icd_seq (the chosen icd idx in the prompt order), candidate_idx (the idx
+        that can be added). A candidate with -inf score is never chosen.
+    prepend: the new icd is placed at the beginning of the prompt, otherwise
+        after the chosen icds (just before the test sample).
+    dedup: keep only the best beam of the same icd set in different orders.
+    """
+
+    def __init__(
+        self,
+        candidate_idx_list: List[List[int]],
+        beam_size: int,
+        scorer: Callable,
+        prepend: bool = True,
+        dedup: bool = False,
+    ):
+        self.beam_size = beam_size
+        self.scorer = scorer
+        self.prepend = prepend
+        self.dedup = dedup
+        self.step_num = 0
+
+        anchor_num = len(candidate_idx_list)
+        cand_num = max(len(idx_list) for idx_list in candidate_idx_list)
+        self.cand_idx = torch.full((anchor_num, cand_num), -1, dtype=torch.long)
+        for anchor_i, idx_list in enumerate(candidate_idx_list):
+            self.cand_idx[anchor_i, : len(idx_list)] = torch.tensor(
+                sorted(idx_list), dtype=torch.long
+            )
+        # 第一步每个anchor只有一个空的beam
+        self.beam_pos = torch.zeros((anchor_num, 1, 0), dtype=torch.long)
+        self.beam_mask = (self.cand_idx < 0)[:, None]
+        self.beam_score = torch.zeros((anchor_num, 1))
+
+    @property
+    def beam_valid(self):
+        return self.beam_score > float('-inf')
+
+    def get_icd_seq(self, anchor_i, beam_i) -> List[int]:
+        return self.cand_idx[anchor_i, self.beam_pos[anchor_i, beam_i]].tolist()
+
+    def get_beams(self) -> List[Dict]:
+        beams = []
+        for anchor_i, beam_i in self.beam_valid.nonzero().tolist():
+            beams.append(
+                {
+                    'anchor': anchor_i,
+                    'beam': beam_i,
+                    'icd_seq': self.get_icd_seq(anchor_i, beam_i),
+                    'candidate_idx': self.cand_idx[anchor_i][
+                        ~self.beam_mask[anchor_i, beam_i]
+                    ].tolist(),
+                }
+            )
+        return beams
+
+    def step(self):
+        beams = self.get_beams()
+        score_list = self.scorer(self.step_num, beams)
+        with profiler.timer('beam_topk'):
+            self.update(beams, score_list)
+        self.step_num += 1
+
+    def update(self, beams, score_list):
+        anchor_num, beam_num, cand_num = self.beam_mask.shape
+        scores = torch.full((anchor_num, beam_num, cand_num), float('-inf'))
+        for beam, beam_scores in zip(beams, score_list):
+            anchor_i, beam_i = beam['anchor'], beam['beam']
+            scores[anchor_i, beam_i, ~self.beam_mask[anchor_i, beam_i]] = (
+                torch.as_tensor(beam_scores, dtype=scores.dtype)
+            )
+
+        # 所有anchor的所有beam的候选一起选出topk
+        flat_scores = scores.view(anchor_num, -1)
+        # 去重时多取一些, 被去掉的beam由后面的补上
+        k = self.beam_size * beam_num if self.dedup else self.beam_size
+        top_scores, top_flat = flat_scores.topk(min(k, flat_scores.shape[1]), dim=1)
+        top_beam = top_flat // cand_num
+        top_cand = top_flat % cand_num
+
+        new_mask = self.beam_mask.gather(
+            1, top_beam[..., None].expand(-1, -1, cand_num)
+        ).clone()
+        new_mask.scatter_(2, top_cand[..., None], True)
+        keep = top_scores > float('-inf')
+        if self.dedup:
+            # 同一组icd只是顺序不同, 只保留分数最高(最靠前)的beam
+            same_set = (new_mask[:, :, None] == new_mask[:, None]).all(-1)
+            earlier = torch.ones_like(same_set[0]).tril(-1)
+            keep &= ~(same_set & earlier & keep[:, None]).any(-1)
+        # 每个anchor保留前beam_size个beam, 被丢弃的beam分数设为-inf
+        order = (keep.cumsum(1) <= self.beam_size) & keep
+        top_scores = top_scores.masked_fill(~order, float('-inf'))
+        # 保留的beam排在前面
+        sort_idx = (~order).float().argsort(dim=1, stable=True)[:, : self.beam_size]
+
+        top_beam = top_beam.gather(1, sort_idx)
+        top_cand = top_cand.gather(1, sort_idx)
+        old_pos = self.beam_pos.gather(
+            1, top_beam[..., None].expand(-1, -1, self.beam_pos.shape[2])
+        )
+        if self.prepend:
+            self.beam_pos = torch.cat([top_cand[..., None], old_pos], dim=2)
+        else:
+            self.beam_pos = torch.cat([old_pos, top_cand[..., None]], dim=2)
+        self.beam_mask = new_mask.gather(
+            1, sort_idx[..., None].expand(-1, -1, cand_num)
+        )
+        self.beam_score = top_scores.gather(1, sort_idx)
+
+    def run(self, step_num):
+        for _ in range(step_num):
+            self.step()
+        return self
+
+    def results(self, test_idx_list: List[int]) -> List[Dict]:
+        """
+        The id_list (the icd idx in the prompt order + the test sample idx) and
+        the score_list of the beams of every anchor.
+        """
+        res = []
+        for anchor_i, test_idx in enumerate(test_idx_list):
+            valid = self.beam_valid[anchor_i].nonzero()[:, 0].tolist()
+            res.append(
+                {
+                    'id_list': [
+                        [*self.get_icd_seq(anchor_i, beam_i), test_idx]
+                        for beam_i in valid
+                    ],
+                    'score_list': self.beam_score[anchor_i, valid].tolist(),
+                }
+            )
+        return res
@@ -1,10 +1,7 @@
 import os
-import random
 
-import torch
-from loguru import logger
-
-from src.utils import encode_image, recall_sim_feature
+from src.ann_index import AnnIndex
+from src.utils import load_feature_store, recall_sim_feature, remove_anchor
 
 from .base_sampler import BaseSampler
 
@@ -22,14 +19,21 @@ class ImgSimSampler(BaseSampler):
         img_field_name,
         device,
         candidate_set_encode_bs,
+        ann_index=None,
+        candidate_set_encode_workers=0,
     ):
+        self.ann_index = AnnIndex.from_config(ann_index)
+        other_info = feature_cache_filename.replace('openai/', '')
+        if not self.ann_index.exact:
+            # the approximate candidate sets are cached apart from the exact ones
+            other_info = f'{other_info}-{self.ann_index.index_type}'
         super().__init__(
             candidate_num=candidate_num,
             sampler_name=sampler_name,
             dataset_name=dataset_name,
             cache_dir=cache_dir,
             overwrite=overwrite,
-            other_info=feature_cache_filename.replace('openai/', ''),
+            other_info=other_info,
         )
         self.clip_model_name = clip_model_name
         self.feature_cache_filename = feature_cache_filename.replace('openai/', '')
@@ -37,25 +41,25 @@ class ImgSimSampler(BaseSampler):
         self.img_field_name = img_field_name
         self.device = device
         self.bs = candidate_set_encode_bs
+        self.num_workers = candidate_set_encode_workers
 
     def sample(self, anchor_set, train_ds):
-        if os.path.exists(self.feature_cache):
-            logger.info(f'feature cache {self.feature_cache} exists, loding...')
-            features = torch.load(self.feature_cache)
-        else:
-            features = encode_image(
-                train_ds,
-                self.img_field_name,
-                self.device,
-                self.clip_model_name,
-                self.bs,
-            )
-            logger.info(f'saving the features cache in {self.feature_cache} ...')
-            torch.save(features, self.feature_cache)
+        features = load_feature_store(
+            self.feature_cache,
+            'image',
+            train_ds,
+            self.img_field_name,
+            self.device,
+            self.clip_model_name,
+            self.bs,
+            self.num_workers,
+        )
         test_feature = features[anchor_set]
         _, sim_sample_idx = recall_sim_feature(
-            test_feature, features, top_k=self.candidate_num + 1
+            test_feature,
+            features,
+            top_k=self.candidate_num + 1,
+            ann_index=self.ann_index,
+            feature_cache=self.feature_cache,
         )
-        sim_sample_idx = sim_sample_idx[:, 1:].tolist()
-        candidate_set_idx = {idx: cand for idx, cand in zip(anchor_set, sim_sample_idx)}
-        return candidate_set_idx
+        return remove_anchor(anchor_set, sim_sample_idx, self.candidate_num)
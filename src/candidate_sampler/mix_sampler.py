@@ -1,10 +1,6 @@
-import os
-import random
-
 import torch
-from loguru import logger
 
-from src.utils import encode_text, recall_sim_feature
+from src.utils import load_feature_stores
 
 from .base_sampler import BaseSampler
 from .img_sim_sampler import ImgSimSampler
@@ -27,6 +23,8 @@ class MixSimSampler(BaseSampler):
         device,
         candidate_set_encode_bs,
         sampler_ratio: dict,
+        ann_index=None,
+        candidate_set_encode_workers=0,
     ):
         self.sampler_ratio = sampler_ratio
         self.sampler_candidate_num = {}
@@ -42,6 +40,8 @@ class MixSimSampler(BaseSampler):
             f'Text:{self.sampler_candidate_num["TextSimSampler"]}-'
             f'Img:{self.sampler_candidate_num["ImgSimSampler"]}'
         )
+        if ann_index is not None and ann_index.type != 'flat':
+            other_info = f'{other_info}-{ann_index.type}'
         super().__init__(
             candidate_num=candidate_num,
             dataset_name=dataset_name,
@@ -64,10 +64,12 @@ class MixSimSampler(BaseSampler):
             dataset_name=dataset_name,
             overwrite=overwrite,
             clip_model_name=clip_model_name,
-            feature_cache_filename=feature_cache_filename + '-TextFeatures.pth',
+            feature_cache_filename=feature_cache_filename + '-TextFeatures',
             text_field_name=text_field_name,
             device=device,
             candidate_set_encode_bs=candidate_set_encode_bs,
+            ann_index=ann_index,
+            candidate_set_encode_workers=candidate_set_encode_workers,
         )
         self.img_sim_sampler = ImgSimSampler(
             candidate_num=self.sampler_candidate_num['ImgSimSampler'],
@@ -76,15 +78,30 @@ class MixSimSampler(BaseSampler):
             overwrite=overwrite,
             dataset_name=dataset_name,
             clip_model_name=clip_model_name,
-            feature_cache_filename=feature_cache_filename + '-ImgFeatures.pth',
+            feature_cache_filename=feature_cache_filename + '-ImgFeatures',
             img_field_name=img_field_name,
             device=device,
             candidate_set_encode_bs=candidate_set_encode_bs,
+            ann_index=ann_index,
+            candidate_set_encode_workers=candidate_set_encode_workers,
         )
 
     @torch.inference_mode()
     def sample(self, anchor_set, train_ds):
         final_res = {k: [] for k in anchor_set}
+        # 一次遍历数据同时编码文本和图片特征
+        text_sampler, img_sampler = self.text_sim_sampler, self.img_sim_sampler
+        load_feature_stores(
+            train_ds,
+            {
+                'text': (text_sampler.text_field_name, text_sampler.feature_cache),
+                'image': (img_sampler.img_field_name, img_sampler.feature_cache),
+            },
+            img_sampler.device,
+            img_sampler.clip_model_name,
+            img_sampler.bs,
+            img_sampler.num_workers,
+        )
         rand_res = self.rand_sampler.sample(anchor_set, train_ds)
         img_sim_res = self.img_sim_sampler.sample(anchor_set, train_ds)
         text_sim_res = self.text_sim_sampler.sample(anchor_set, train_ds)
@@ -0,0 +1,87 @@
+import json
+import os
+from typing import Dict, List
+
+import numpy as np
+from loguru import logger
+from tqdm import tqdm
+
+
+class CandidateStore:
+    """
+    A memory-mapped store of the text fields (prompt columns, image_id, idx) of
+    every train sample, keyed by the dataset idx.
+
+    Each record is a utf-8 json line in records.bin, offsets.npy holds the byte
+    range of every idx, so gathering k candidates reads k slices. The store
+    pickles as its path only, all ranks map the same file instead of holding a
+    copy of the HF dataset. The images come from a TensorCache.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.offsets = np.load(os.path.join(store_dir, 'offsets.npy'), mmap_mode='r')
+        self.records = np.memmap(
+            os.path.join(store_dir, 'records.bin'), dtype=np.uint8, mode='r'
+        )
+
+    def __getstate__(self):
+        return {'store_dir': self.store_dir}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def columns(self):
+        return self.meta['columns']
+
+    def __getitem__(self, idx) -> Dict:
+        begin, end = self.offsets[idx], self.offsets[idx + 1]
+        return json.loads(self.records[begin:end].tobytes())
+
+    def select(self, idx_list) -> List[Dict]:
+        return [self[idx] for idx in idx_list]
+
+
+def build_candidate_store(store_dir, train_ds, columns, batch_size=10000):
+    """
+    Build the store once per dataset, reuse it if the columns and the length
+    are the same.
+    """
+    columns = sorted(set(columns) | {'idx'})
+    meta = {'columns': columns, 'dataset_len': len(train_ds)}
+    meta_path = os.path.join(store_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            if json.load(f) == meta:
+                logger.info(f'the candidate store {store_dir} exists, loading...')
+                return CandidateStore(store_dir)
+        os.remove(meta_path)
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    text_ds = train_ds.select_columns(columns)
+    offsets = np.zeros(len(text_ds) + 1, dtype=np.int64)
+    with open(os.path.join(store_dir, 'records.bin'), 'wb') as f:
+        for begin in tqdm(range(0, len(text_ds), batch_size), ncols=100):
+            batch = text_ds[begin : begin + batch_size]
+            for i in range(len(batch['idx'])):
+                if batch['idx'][i] != begin + i:
+                    raise ValueError(
+                        f'the idx of row {begin + i} is {batch["idx"][i]}, '
+                        'the store is keyed by the row index'
+                    )
+                record = json.dumps({col: batch[col][i] for col in columns}).encode()
+                f.write(record)
+                offsets[begin + i + 1] = offsets[begin + i] + len(record)
+    np.save(os.path.join(store_dir, 'offsets.npy'), offsets)
+    # the meta is written at last, an interrupted build will be rebuilt
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    logger.info(f'save the candidate store to {store_dir}')
+    return CandidateStore(store_dir)
@@ -0,0 +1,213 @@
+import json
+import os
+from typing import Optional
+
+import numpy as np
+import torch
+from loguru import logger
+
+
+def get_dataset_fingerprint(train_ds) -> Optional[str]:
+    # the hf datasets fingerprint is stable for the same data and transforms
+    return getattr(train_ds, '_fingerprint', None)
+
+
+class FeatureStore:
+    """
+    An on-disk store of the (N, dim) clip features of a dataset.
+
+    The rows are split into memory-mapped fp16 .npy shards of shard_size rows
+    (<store_dir>/shard_00000.npy, ...), the meta.json header records the model,
+    the dataset field and fingerprint the features come from. A shard is
+    written by the encoders batch by batch and marked by shard_xxxxx.done
+    when it is complete, so an interrupted encoding resumes from the first
+    unfinished shard. The readers gather the rows they need or iterate the
+    shards, so neither needs the whole matrix in memory.
+    """
+
+    def __init__(self, store_dir, meta):
+        self.store_dir = store_dir
+        self.meta = meta
+        self.num = meta['num']
+        self.dim = meta['dim']
+        self.shard_size = meta['shard_size']
+        self.dtype = meta['dtype']
+        self.shards = {}
+        self.writing = {}
+
+    @staticmethod
+    def meta_path(store_dir):
+        return os.path.join(store_dir, 'meta.json')
+
+    @classmethod
+    def exists(cls, store_dir):
+        return os.path.exists(cls.meta_path(store_dir))
+
+    @classmethod
+    def create(
+        cls,
+        store_dir,
+        num,
+        dim,
+        model,
+        field,
+        fingerprint=None,
+        shard_size=65536,
+        dtype='float16',
+    ):
+        """
+        Create an empty store, or reopen the unfinished one of the same meta
+        to resume its missing shards.
+        """
+        meta = {
+            'model': model,
+            'field': field,
+            'fingerprint': fingerprint,
+            'num': num,
+            'dim': dim,
+            'shard_size': shard_size,
+            'dtype': dtype,
+            'complete': False,
+        }
+        if cls.exists(store_dir):
+            store = cls.open(store_dir)
+            if {**store.meta, 'complete': False} == meta:
+                logger.info(
+                    f'resume the feature store {store_dir}: '
+                    f'{store.shard_num - len(store.missing_shards())}/'
+                    f'{store.shard_num} shards done'
+                )
+                return store
+            for shard_id in range(store.shard_num):
+                if store.is_done(shard_id):
+                    os.remove(store.done_path(shard_id))
+        elif not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        store = cls(store_dir, meta)
+        store.save_meta()
+        return store
+
+    @classmethod
+    def open(cls, store_dir):
+        with open(cls.meta_path(store_dir), 'r') as f:
+            meta = json.load(f)
+        return cls(store_dir, meta)
+
+    @classmethod
+    def from_array(cls, store_dir, features, model, field, fingerprint=None):
+        store = cls.create(store_dir, *features.shape, model, field, fingerprint)
+        for shard_id in store.missing_shards():
+            rows = store.shard_rows(shard_id)
+            store.write(rows, features[rows.start : rows.stop])
+            store.mark_done(shard_id)
+        store.finish()
+        return store
+
+    def save_meta(self):
+        with open(self.meta_path(self.store_dir), 'w') as f:
+            json.dump(self.meta, f, indent=2)
+
+    def matches(self, model, field, fingerprint=None, num=None):
+        return (
+            self.meta['complete']
+            and self.meta['model'] == model
+            and self.meta['field'] == field
+            and (fingerprint is None or self.meta['fingerprint'] == fingerprint)
+            and (num is None or self.num == num)
+        )
+
+    @property
+    def shape(self):
+        return self.num, self.dim
+
+    @property
+    def shard_num(self):
+        return (self.num + self.shard_size - 1) // self.shard_size
+
+    def __len__(self):
+        return self.num
+
+    def shard_path(self, shard_id):
+        return os.path.join(self.store_dir, f'shard_{shard_id:05d}.npy')
+
+    def done_path(self, shard_id):
+        return os.path.join(self.store_dir, f'shard_{shard_id:05d}.done')
+
+    def shard_rows(self, shard_id):
+        start = shard_id * self.shard_size
+        return range(start, min(start + self.shard_size, self.num))
+
+    def is_done(self, shard_id):
+        return os.path.exists(self.done_path(shard_id))
+
+    def missing_shards(self):
+        return [i for i in range(self.shard_num) if not self.is_done(i)]
+
+    def get_shard(self, shard_id):
+        if shard_id not in self.shards:
+            self.shards[shard_id] = np.load(self.shard_path(shard_id), mmap_mode='r')
+        return self.shards[shard_id]
+
+    def write(self, idx, features):
+        """Write the rows of idx, features: (len(idx), dim) tensor or array."""
+        if isinstance(features, torch.Tensor):
+            features = features.detach().float().cpu().numpy()
+        idx = np.asarray(idx, dtype=np.int64)
+        shard_ids, offsets = np.divmod(idx, self.shard_size)
+        for shard_id in np.unique(shard_ids).tolist():
+            if shard_id not in self.writing:
+                # 未完成的分片重新写, 不读旧内容
+                self.writing[shard_id] = np.lib.format.open_memmap(
+                    self.shard_path(shard_id),
+                    mode='w+',
+                    dtype=self.dtype,
+                    shape=(len(self.shard_rows(shard_id)), self.dim),
+                )
+            mask = shard_ids == shard_id
+            self.writing[shard_id][offsets[mask]] = features[mask]
+
+    def mark_done(self, shard_id):
+        shard = self.writing.pop(shard_id)
+        shard.flush()
+        del shard
+        self.shards.pop(shard_id, None)
+        open(self.done_path(shard_id), 'w').close()
+
+    def finish(self):
+        missing = self.missing_shards()
+        if missing:
+            raise ValueError(
+                f'the feature store {self.store_dir} shards {missing} are not done'
+            )
+        self.meta['complete'] = True
+        self.save_meta()
+
+    def __getitem__(self, idx) -> np.ndarray:
+        """Gather the rows of idx (int, slice or index list) as a float32 array."""
+        if isinstance(idx, slice):
+            idx = range(*idx.indices(self.num))
+        single = np.isscalar(idx)
+        idx = np.atleast_1d(np.asarray(idx, dtype=np.int64))
+        out = np.empty((len(idx), self.dim), dtype=np.float32)
+        shard_ids, offsets = np.divmod(idx, self.shard_size)
+        for shard_id in np.unique(shard_ids):
+            mask = shard_ids == shard_id
+            out[mask] = self.get_shard(int(shard_id))[offsets[mask]]
+        return out[0] if single else out
+
+    def iter_chunks(self):
+        """Yield (start row, float32 rows) of every shard."""
+        for shard_id in range(self.shard_num):
+            shard = self.get_shard(shard_id)
+            yield shard_id * self.shard_size, np.asarray(shard, dtype=np.float32)
+            self.shards.pop(shard_id, None)
+
+
+def iter_feature_chunks(features, chunk_size=65536):
+    """Yield (start row, float32 rows) of a FeatureStore or an in-memory array."""
+    if isinstance(features, FeatureStore):
+        yield from features.iter_chunks()
+        return
+    for start in range(0, len(features), chunk_size):
+        chunk = features[start : start + chunk_size]
+        yield start, np.ascontiguousarray(chunk, dtype=np.float32)
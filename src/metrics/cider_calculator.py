@@ -1,20 +1,43 @@
-from typing import Dict, List
+import threading
+from typing import Dict, List, Optional
 
 import more_itertools
+import numpy as np
 import torch
+from loguru import logger
 from PIL import Image
-from pycocoevalcap.cider.cider import Cider
-from pycocoevalcap.tokenizer.ptbtokenizer import PTBTokenizer
 from pycocotools.coco import COCO
 
+from src import profiler
+from src.adaptive_batch import AdaptiveBatchSizer, run_with_backoff
+from src.metrics.ptb_tokenizer import build_ptb_tokenizer
+from src.metrics.sparse_cider import (
+    NgramVocab,
+    SparseCider,
+    cider_d,
+    compact_columns,
+    image_presence,
+)
+from src.prefetch import Prefetcher, use_pin_memory
+from src.stopping import get_stop_kwargs
+from src.utils import (
+    chunk_by_token_budget,
+    flamingo_generate,
+    process_image,
+    stack_vision_input,
+    vision_input_to_device,
+)
 
-def compute_cider(result_dict, annotations_path, reduce_cider=True):
+
+def compute_cider(
+    result_dict, annotations_path, reduce_cider=True, ptb_tokenizer='java'
+):
     # create coco object and coco_result object
     coco = COCO(annotations_path)
     coco_result = coco.loadRes(result_dict)
 
     # create coco_eval object by taking coco and coco_result
-    coco_eval = COCOEvalCap(coco, coco_result)
+    coco_eval = COCOEvalCap(coco, coco_result, ptb_tokenizer)
     coco_eval.params["image_id"] = coco_result.getImgIds()
     coco_eval.evaluate()
     if reduce_cider:
@@ -23,6 +46,82 @@ def compute_cider(result_dict, annotations_path, reduce_cider=True):
         return coco_eval.imgToEval
 
 
+class CiderReferenceIndex:
+    """
+    The train references of the CIDEr score, loaded and PTB tokenized once, with
+    their n-gram term frequencies precomputed as sparse matrices, so each call
+    only tokenizes and scores the new predictions.
+    The document frequency is summed over the references of the scored images
+    of each call, the same as pycocoevalcap, so the scores equal compute_cider.
+    ptb_tokenizer: java (the pycocoevalcap tokenizer) or python (the in-process
+        port of src/metrics/ptb_tokenizer.py).
+    """
+
+    def __init__(
+        self,
+        annotations_path: str,
+        n: int = 4,
+        sigma: float = 6.0,
+        ptb_tokenizer: str = 'java',
+    ):
+        self.n = n
+        self.sigma = sigma
+        self.tokenizer = build_ptb_tokenizer(ptb_tokenizer)
+        coco = COCO(annotations_path)
+        gts = self.tokenizer.tokenize(
+            {img_id: coco.imgToAnns[img_id] for img_id in coco.getImgIds()}
+        )
+        self.img_ids = list(gts)
+        self.img_pos = {img_id: pos for pos, img_id in enumerate(self.img_ids)}
+        self.vocab = NgramVocab(n)
+        self.refs = self.vocab.encode(
+            [ref for img_id in self.img_ids for ref in gts[img_id]]
+        )
+        ref_num = np.array([len(gts[img_id]) for img_id in self.img_ids])
+        self.ref_offset = np.concatenate([[0], np.cumsum(ref_num)])
+        # 每张图片的参考n-gram集合, 每个n-gram对文档频率贡献1
+        self.presence = image_presence(
+            self.refs, np.repeat(np.arange(len(self.img_ids)), ref_num), len(ref_num)
+        )
+        logger.info(
+            f'CIDEr reference index of {len(self.img_ids)} images, '
+            f'{len(self.vocab)} n-grams'
+        )
+
+    def compute_score(self, predictions: Dict[int, str]) -> Dict[int, float]:
+        """
+        predictions: {image_id: caption}, returns {image_id: CIDEr score}.
+        """
+        img_ids = list(predictions)
+        res = self.tokenizer.tokenize(
+            {img_id: [{'caption': predictions[img_id]}] for img_id in img_ids}
+        )
+        pos = np.array([self.img_pos[img_id] for img_id in img_ids])
+        ref_rows = np.concatenate(
+            [np.arange(self.ref_offset[p], self.ref_offset[p + 1]) for p in pos]
+        )
+        ref_img = np.repeat(
+            np.arange(len(pos)), self.ref_offset[pos + 1] - self.ref_offset[pos]
+        )
+        # 参考中没有的n-gram只影响预测的norm, 放在临时的词表里
+        extra = NgramVocab(self.n)
+        hyp = self.vocab.encode([res[img_id][0] for img_id in img_ids], extra=extra)
+        (hyp, refs, presence), cols = compact_columns(
+            [hyp, self.refs[ref_rows], self.presence[pos]]
+        )
+        orders = np.array(self.vocab.orders + extra.orders, dtype=np.int64)[cols]
+        scores = cider_d(
+            hyp,
+            refs,
+            ref_img,
+            np.asarray(presence.sum(0)).ravel(),
+            orders,
+            self.n,
+            self.sigma,
+        )
+        return dict(zip(img_ids, scores.tolist()))
+
+
 @torch.inference_mode()
 def get_cider_score(
     model,
@@ -34,14 +133,30 @@ def get_cider_score(
     image_x: List[Image.Image],
     candidate_set: Dict,
     batch_size: int,
-    train_ann_path: str,
+    cider_index: CiderReferenceIndex,
     gen_kwargs: Dict,
     autocast_context,
+    vision_features: bool = False,
+    prefetch_depth: int = 0,
+    batch_sizer: Optional[AdaptiveBatchSizer] = None,
+    stop_strings: Optional[List[str]] = None,
 ):
+    """
+    cider_index: the CiderReferenceIndex of the train annotations.
+    stop_strings: each row stops generating at <|endofchunk|>, the end of text
+        or one of them (greedy generation only), e.g. the "Output" of the next
+        example.
+    batch_sizer: If given, it decides the batch size by the prompt token length
+        instead of batch_size, an OOM batch is split into halves and retried.
+    """
     output_dict = {}
-    image_x = [image_processor(image) for image in image_x]
+    image_x = [process_image(image_processor, image) for image in image_x]
     cand_idx = sorted(list(candidate_set.keys()))
-    for batch in more_itertools.chunked(cand_idx, batch_size):
+    pin_memory = use_pin_memory(device)
+    # the fast tokenizer can not be used by two threads at the same time
+    tokenizer_lock = threading.Lock()
+
+    def build_batch(batch):
         batch_data = [candidate_set[i] for i in batch]
         new_icd_lang_x = [data['text_input'] for data in batch_data]
         new_icd_image_x = [data['image'] for data in batch_data]
@@ -50,61 +165,106 @@ def get_cider_score(
         total_icd_lang_x_input = [
             icd_join_char.join([icd_lang_x] + lang_x) for icd_lang_x in new_icd_lang_x
         ]
-        total_icd_lang_x_input = tokenizer(
-            total_icd_lang_x_input, return_tensors='pt', padding=True
-        ).to(device=device)
-
-        batch_total_vision_x = [
-            torch.stack([image_processor(icd_image_x)] + image_x, dim=0)
-            for icd_image_x in new_icd_image_x
-        ]
-        total_vision_x = torch.stack(batch_total_vision_x, dim=0)
+        with tokenizer_lock, profiler.timer('tokenize'):
+            total_icd_lang_x_input = tokenizer(
+                total_icd_lang_x_input, return_tensors='pt', padding=True
+            )
+        with profiler.timer('image_preprocess'):
+            vision_input = stack_vision_input(
+                [
+                    [process_image(image_processor, icd_image_x)] + image_x
+                    for icd_image_x in new_icd_image_x
+                ],
+                vision_features,
+                pin_memory,
+            )
+        return batch_data, total_icd_lang_x_input, vision_input
 
-        total_vision_x = total_vision_x.unsqueeze(2).to(
-            device=device, non_blocking=True
-        )
-        with autocast_context:
-            outputs = model.generate(
-                vision_x=total_vision_x,
+    def generate_batch(batch):
+        batch_data, total_icd_lang_x_input, vision_input = batch
+        with profiler.timer('h2d'):
+            total_icd_lang_x_input = total_icd_lang_x_input.to(device=device)
+            vision_input = vision_input_to_device(vision_input, device)
+        with profiler.timer('generate'), autocast_context:
+            outputs = flamingo_generate(
+                model,
+                **vision_input,
                 lang_x=total_icd_lang_x_input['input_ids'],
                 attention_mask=total_icd_lang_x_input['attention_mask'].bool(),
-                eos_token_id=tokenizer.eos_token_id,
                 pad_token_id=tokenizer.pad_token_id,
-                **gen_kwargs,
+                # an explicit eos_token_id of gen_kwargs wins
+                **{
+                    **get_stop_kwargs(
+                        model, tokenizer, stop_strings, gen_kwargs.get('num_beams', 1)
+                    ),
+                    **gen_kwargs,
+                },
             )
-        outputs = outputs.tolist()
+            outputs = outputs.tolist()
         prompt_len = int(total_icd_lang_x_input['attention_mask'].shape[1])
 
-        generated = tokenizer.batch_decode(
-            [output[prompt_len:] for output in outputs],
-            skip_special_tokens=True,
-        )
+        with tokenizer_lock, profiler.timer('decode'):
+            generated = tokenizer.batch_decode(
+                [output[prompt_len:] for output in outputs],
+                skip_special_tokens=True,
+            )
         for i, data in enumerate(batch_data):
             output_dict[data['idx']] = {}
             output_dict[data['idx']]['prediction'] = generated[i]
             output_dict[data['idx']]['image_id'] = data['image_id']
 
-    pred_coco = []
-    for idx in output_dict:
-        pred_coco.append(
-            {
-                'image_id': output_dict[idx]['image_id'],
-                'caption': output_dict[idx]['prediction']
-                .split("Output", 1)[0]
-                .replace('"', ""),
-            }
+    if batch_sizer is None:
+        batches = list(more_itertools.chunked(cand_idx, batch_size))
+        cand_lengths = [0] * len(cand_idx)
+    else:
+        # the prompt token length of every candidate decides its batch size
+        with tokenizer_lock:
+            cand_lengths = [
+                len(input_ids)
+                for input_ids in tokenizer(
+                    [
+                        icd_join_char.join([candidate_set[i]['text_input']] + lang_x)
+                        for i in cand_idx
+                    ]
+                )['input_ids']
+            ]
+        batches = [
+            [cand_idx[i] for i in batch]
+            for batch in chunk_by_token_budget(cand_lengths, batch_sizer.get_batch_size)
+        ]
+    idx2length = dict(zip(cand_idx, cand_lengths))
+    prefetcher = Prefetcher(build_batch, batches, queue_depth=prefetch_depth)
+    for batch in prefetcher:
+        run_with_backoff(
+            generate_batch,
+            build_batch,
+            [data['idx'] for data in batch[0]],
+            idx2length,
+            batch_sizer,
+            batch=batch,
         )
-    cider_score_info = compute_cider(pred_coco, train_ann_path, reduce_cider=False)
+    logger.debug(
+        f'get_cider_score {len(cand_idx)} candidates, {prefetcher.timing_info()}'
+    )
+
+    predictions = {
+        output['image_id']: output['prediction'].split("Output", 1)[0].replace('"', "")
+        for output in output_dict.values()
+    }
+    with profiler.timer('cider'):
+        cider_score_info = cider_index.compute_score(predictions)
+    profiler.count('candidate_scores', len(cand_idx))
     cider_score = []
     for idx in cand_idx:
         img_id = candidate_set[idx]['image_id']
-        cider_score.append(cider_score_info[img_id]['CIDEr'])
+        cider_score.append(cider_score_info[img_id])
 
     return torch.tensor(cider_score)
 
 
 class COCOEvalCap:
-    def __init__(self, coco, cocoRes):
+    def __init__(self, coco, cocoRes, ptb_tokenizer='java'):
+        self.ptb_tokenizer = ptb_tokenizer
         self.evalImgs = []
         self.eval = {}
         self.imgToEval = {}
@@ -125,7 +285,7 @@ class COCOEvalCap:
         # Set up scorers
         # =================================================
         print('tokenization...')
-        tokenizer = PTBTokenizer()
+        tokenizer = build_ptb_tokenizer(self.ptb_tokenizer)
         gts = tokenizer.tokenize(gts)
         res = tokenizer.tokenize(res)
 
@@ -134,7 +294,7 @@ class COCOEvalCap:
         # =================================================
         print('setting up scorers...')
         scorers = [
-            (Cider(), "CIDEr"),
+            (SparseCider(), "CIDEr"),
         ]
 
         # =================================================
@@ -1,16 +1,184 @@
+from collections import Counter
 from typing import Dict, List, Optional
 
-import more_itertools
 import numpy as np
 import torch
+from loguru import logger
 from PIL import Image
 
+from src import profiler
+from src.adaptive_batch import AdaptiveBatchSizer, run_with_backoff
+from src.prefetch import Prefetcher, use_pin_memory
+from src.utils import (
+    build_vision_input,
+    chunk_by_token_budget,
+    flamingo_forward,
+    get_padding_ratio,
+    process_image,
+    stack_vision_input,
+    vision_input_to_device,
+)
 
-def get_input_token_num(tokenizer, inputs: str):
-    return len(tokenizer(inputs, verbose=False)['input_ids'])
+
+class ScoreCache:
+    """
+    The InfoScore cache of the anchors in one beam search loop. A beam is keyed
+    by its cache_key (anchor id + the ordered chosen icd ids), the candidate
+    scores by (beam key, candidate id) and the baseline P(y|x) by the beam key.
+    Different beams almost never share the same ordered key, so it only helps
+    the truncated pruning proxy, whose key (anchor id, ()) is scored again at
+    every step; without it the cache is only overhead.
+    """
+
+    def __init__(self):
+        self.score = {}
+        self.base_ppl = {}
+        self.counter = Counter()
+
+    def has_score(self, beam_key, idx):
+        hit = (beam_key, idx) in self.score
+        self.counter['score_hit' if hit else 'score_miss'] += 1
+        return hit
+
+    def get_score(self, beam_key, idx):
+        return self.score[(beam_key, idx)]
+
+    def set_score(self, beam_key, idx, score):
+        self.score[(beam_key, idx)] = score
+
+    def has_base_ppl(self, beam_key):
+        hit = beam_key in self.base_ppl
+        self.counter['base_hit' if hit else 'base_miss'] += 1
+        return hit
+
+    def get_base_ppl(self, beam_key):
+        return self.base_ppl[beam_key]
+
+    def set_base_ppl(self, beam_key, ppl):
+        self.base_ppl[beam_key] = ppl
+
+    def hit_rate(self, name):
+        total = self.counter[f'{name}_hit'] + self.counter[f'{name}_miss']
+        return self.counter[f'{name}_hit'] / total if total else 0.0
+
+    def info(self):
+        return (
+            f'score hit rate: {self.hit_rate("score"):.2%}, '
+            f'base ppl hit rate: {self.hit_rate("base"):.2%} ('
+            + ', '.join(f'{k}: {v}' for k, v in sorted(self.counter.items()))
+            + ')'
+        )
+
+
+class PromptTokenizer:
+    """
+    Tokenize every prompt segment (icd text, query, join char) only once and
+    assemble the prompts by concatenating the token ids.
+
+    Every segment begins with <image> and is joined by <|endofchunk|>, both are
+    special tokens which the tokenizer never merges with their neighbours, so
+    the concatenation is the same as tokenizing the whole prompt.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.segment_ids = {}
+        # the special tokens added around the whole input, e.g. the bos of llama
+        text = tokenizer.eos_token
+        ids = tokenizer(text, add_special_tokens=False)['input_ids']
+        special_ids = tokenizer(text)['input_ids']
+        begin = next(
+            i
+            for i in range(len(special_ids) - len(ids) + 1)
+            if special_ids[i : i + len(ids)] == ids
+        )
+        self.prefix_ids = special_ids[:begin]
+        self.suffix_ids = special_ids[begin + len(ids) :]
+
+    def encode(self, texts: List[str]):
+        # 只对没有见过的segment调用一次batch tokenizer
+        new_texts = list({text: None for text in texts if text not in self.segment_ids})
+        if new_texts:
+            input_ids = self.tokenizer(new_texts, add_special_tokens=False)['input_ids']
+            self.segment_ids.update(zip(new_texts, input_ids))
+
+    def __call__(self, segments: List[str], add_special_tokens=True) -> List[int]:
+        self.encode(segments)
+        input_ids = [i for segment in segments for i in self.segment_ids[segment]]
+        if add_special_tokens:
+            input_ids = self.prefix_ids + input_ids + self.suffix_ids
+        return input_ids
+
+
+def pad_input_ids(input_ids: List[List[int]], pad_token_id, padding_side='right'):
+    max_len = max(len(ids) for ids in input_ids)
+    lang_x = torch.full((len(input_ids), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(input_ids), max_len), dtype=torch.bool)
+    for i, ids in enumerate(input_ids):
+        if padding_side == 'right':
+            lang_x[i, : len(ids)] = torch.tensor(ids)
+            attention_mask[i, : len(ids)] = True
+        else:
+            lang_x[i, max_len - len(ids) :] = torch.tensor(ids)
+            attention_mask[i, max_len - len(ids) :] = True
+    return lang_x, attention_mask
+
+
+def expand_past_key_values(past_key_values, batch_size):
+    # 将batch为1的past_key_values广播到整个batch, expand不会复制显存
+    return tuple(
+        tuple(t.expand(batch_size, *t.shape[1:]) for t in layer_past)
+        for layer_past in past_key_values
+    )
+
+
+def select_past_key_values(past_key_values, row_index: List[int]):
+    # 每一行选择对应beam的前缀past_key_values
+    if len(set(row_index)) == 1:
+        prefix_past = tuple(
+            tuple(t[row_index[0] : row_index[0] + 1] for t in layer_past)
+            for layer_past in past_key_values
+        )
+        return expand_past_key_values(prefix_past, len(row_index))
+    index = torch.tensor(row_index, device=past_key_values[0][0].device)
+    return tuple(
+        tuple(t.index_select(0, index) for t in layer_past)
+        for layer_past in past_key_values
+    )
 
 
 @torch.inference_mode()
+def get_masked_ce_loss(
+    logits,
+    lang_x,
+    icd_token_length=None,
+    pad_token_id=0,
+    left_padding_len=0,
+):
+    """
+    The per-sample mean cross-entropy of lang_x. The first icd_token_length[i] - 1
+    shifted positions of sample i are the context and are not counted in the loss.
+    """
+    shift_logits = logits[..., :-1, :]
+    shift_labels = lang_x[..., 1:]
+    loss = torch.nn.functional.cross_entropy(
+        shift_logits.flatten(0, 1),
+        shift_labels.flatten(),
+        reduction='none',
+        ignore_index=pad_token_id,
+    ).view(shift_labels.size())
+
+    lens = (lang_x != pad_token_id).sum(-1) + left_padding_len
+    if icd_token_length is not None:
+        icd_token_length = torch.as_tensor(icd_token_length, device=loss.device)
+        # [batch, seqlen], position j is in the loss iff j >= icd_token_length - 1
+        positions = torch.arange(shift_labels.shape[1], device=loss.device)
+        loss_mask = positions[None] >= (icd_token_length[:, None] - 1)
+        loss = torch.where(loss_mask, loss, 0.0)
+        lens = lens - icd_token_length
+    return loss.sum(-1) / lens
+
+
 def get_ppl(
     model,
     model_input,
@@ -20,32 +188,139 @@ def get_ppl(
     left_padding_len=0,
 ):
     with autocast_context:
-        outputs = model(**model_input)
-
-        shift_logits = outputs.logits[..., :-1, :].contiguous()
-        shift_labels = model_input["lang_x"][..., 1:].contiguous()
-        loss_fct = torch.nn.CrossEntropyLoss(
-            reduction='none', ignore_index=pad_token_id
-        )
-        loss = loss_fct(
-            shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1)
+        outputs = flamingo_forward(model, **model_input)
+        ce_loss = get_masked_ce_loss(
+            outputs.logits,
+            model_input["lang_x"],
+            icd_token_length=icd_token_length,
+            pad_token_id=pad_token_id,
+            left_padding_len=left_padding_len,
         )
-        loss = loss.view(shift_labels.size())
-
-        if icd_token_length is not None:
-            loss_mask = torch.zeros_like(shift_labels)  # [batch, seqlen]
-            for i in range(len(loss_mask)):
-                for j in range(icd_token_length[i] - 1, len(loss_mask[i])):
-                    loss_mask[i][j] = 1
-            loss = loss * loss_mask
-        lens = (model_input["lang_x"] != pad_token_id).sum(-1)
-        if icd_token_length is not None:
-            lens -= torch.tensor(icd_token_length, device=lens.device)
-        lens += left_padding_len
-        ce_loss = loss.sum(-1) / lens
     return ce_loss
 
 
+@torch.inference_mode()
+def get_rows_ppl(
+    model,
+    tokenizer,
+    device: str,
+    rows: List[Dict],
+    batch_size: int,
+    autocast_context,
+    past_key_values=None,
+    prefix_attention_mask=None,
+    max_batch_tokens: Optional[int] = None,
+    vision_features: bool = False,
+    image_processor=None,
+    prefetch_depth: int = 0,
+    length_bucketing: bool = False,
+    batch_sizer: Optional[AdaptiveBatchSizer] = None,
+):
+    """
+    Compute the ppl of every row in rows. Each row is a dict with:
+        input_ids: the token ids of the full input
+        mask_length: the token num of the context part of input_ids, which is not
+            used to compute the loss
+        vision_x: the images (processed by image_processor on demand, each image
+            object only once) or the cached perceiver features if vision_features
+            is True, all rows should have the same image num
+        beam: the index of the prefix in past_key_values (only used with past_key_values)
+    The rows are packed into batches of at most batch_size rows and
+    max_batch_tokens padded tokens (prefix tokens included).
+    prefetch_depth: the num of batches prepared in a background thread while the
+        current batch runs on the device, 0 prepares the batches serially.
+    length_bucketing: pack the rows of similar token length into the same batch,
+        the ppl is still returned in the row order.
+    batch_sizer: If given, it decides the batch size of every length bucket
+        instead of batch_size, an OOM batch is split into halves and retried.
+    """
+    row_lengths = [len(row['input_ids']) for row in rows]
+    if past_key_values is not None:
+        prefix_len = prefix_attention_mask.shape[1]
+        row_lengths = [length + prefix_len for length in row_lengths]
+
+    pin_memory = use_pin_memory(device)
+    processed_image = {}
+
+    def get_image(image):
+        # rows of different beams share the same candidate image object
+        if id(image) not in processed_image:
+            with profiler.timer('image_preprocess'):
+                processed_image[id(image)] = process_image(image_processor, image)
+        return processed_image[id(image)]
+
+    def build_batch(batch_index):
+        with profiler.timer('build_batch'):
+            batch_rows = [rows[i] for i in batch_index]
+            lang_x, attention_mask = pad_input_ids(
+                [row['input_ids'] for row in batch_rows], tokenizer.pad_token_id
+            )
+            vision_input = stack_vision_input(
+                [[get_image(image) for image in row['vision_x']] for row in batch_rows],
+                vision_features,
+                pin_memory,
+            )
+            if pin_memory:
+                lang_x = lang_x.pin_memory()
+                attention_mask = attention_mask.pin_memory()
+        return batch_index, lang_x, attention_mask, vision_input
+
+    def forward_batch(batch_index, lang_x, attention_mask, vision_input):
+        batch_rows = [rows[i] for i in batch_index]
+        with profiler.timer('h2d'):
+            model_input = {
+                **vision_input_to_device(vision_input, device),
+                'lang_x': lang_x.to(device=device, non_blocking=True),
+                'attention_mask': attention_mask.to(device=device, non_blocking=True),
+            }
+        if past_key_values is not None:
+            row_beam = [row['beam'] for row in batch_rows]
+            model_input['past_key_values'] = select_past_key_values(
+                past_key_values, row_beam
+            )
+            model_input['attention_mask'] = torch.cat(
+                [prefix_attention_mask[row_beam], model_input['attention_mask']],
+                dim=1,
+            )
+        with profiler.timer('forward'):
+            ppl[batch_index] = (
+                get_ppl(
+                    model,
+                    model_input,
+                    autocast_context,
+                    icd_token_length=[row['mask_length'] for row in batch_rows],
+                    pad_token_id=tokenizer.pad_token_id,
+                )
+                .float()
+                .cpu()
+            )
+        profiler.count('forward_rows', len(batch_index))
+
+    ppl = torch.zeros(len(rows))
+    batches = chunk_by_token_budget(
+        row_lengths,
+        batch_size if batch_sizer is None else batch_sizer.get_batch_size,
+        max_batch_tokens,
+        sort_by_length=length_bucketing,
+    )
+    prefetcher = Prefetcher(build_batch, batches, queue_depth=prefetch_depth)
+    for batch in prefetcher:
+        run_with_backoff(
+            lambda batch: forward_batch(*batch),
+            build_batch,
+            batch[0],
+            row_lengths,
+            batch_sizer,
+            batch=batch,
+        )
+    logger.debug(
+        f'get_rows_ppl {len(rows)} rows in {len(batches)} batches, '
+        f'padding ratio: {get_padding_ratio(row_lengths, batches):.3f}, '
+        f'{prefetcher.timing_info()}'
+    )
+    return ppl
+
+
 @torch.inference_mode()
 def get_info_score(
     model,
@@ -59,93 +334,282 @@ def get_info_score(
     batch_size: int,
     autocast_context,
     split_token: Optional[str] = None,
+    prefix_kv_cache: bool = False,
+    max_batch_tokens: Optional[int] = None,
+    vision_features: bool = False,
+    prompt_tokenizer: Optional[PromptTokenizer] = None,
+    prefetch_depth: int = 0,
+    length_bucketing: bool = False,
+    batch_sizer: Optional[AdaptiveBatchSizer] = None,
 ):
-    model.eval()
-    tokenizer.padding_side = "right"
-
-    # 1. 计算P(y|x)
-    # 1.1 拼接文本输入
-    test_lang_x_input = lang_x[-1]
-    chosen_icd_input = icd_join_char.join(lang_x[:-1])
-    if chosen_icd_input:
-        chosen_icd_input += icd_join_char
-
-    query_test_lang_x_input = test_lang_x_input.split(split_token)[0] + split_token
-    mask_context = chosen_icd_input + query_test_lang_x_input
-
-    mask_length = get_input_token_num(tokenizer, mask_context)
-
-    lang_x_input = chosen_icd_input + test_lang_x_input + icd_join_char
-    lang_x_input = tokenizer(lang_x_input, return_tensors='pt').to(device=device)
-    lang_x_input['attention_mask'][lang_x_input['input_ids'] == 0] = 0
-
-    # 1.2 拼接图像输入
-    image_x = [image_processor(image) for image in image_x]
-    vision_x = torch.stack(image_x, dim=0)
-    vision_x = vision_x.unsqueeze(1).unsqueeze(0).to(device=device, non_blocking=True)
-
-    model_input = {
-        'vision_x': vision_x,
-        'lang_x': lang_x_input['input_ids'],
-        'attention_mask': lang_x_input['attention_mask'].bool(),
-    }
-    ppl = get_ppl(
+    return get_beam_info_score(
         model,
-        model_input,
-        autocast_context,
-        icd_token_length=[mask_length],
-        pad_token_id=tokenizer.pad_token_id,
+        tokenizer,
+        image_processor,
+        device,
+        icd_join_char=icd_join_char,
+        beam_inputs=[
+            {'lang_x': lang_x, 'image_x': image_x, 'candidate_set': candidate_set}
+        ],
+        batch_size=batch_size,
+        autocast_context=autocast_context,
+        split_token=split_token,
+        prefix_kv_cache=prefix_kv_cache,
+        max_batch_tokens=max_batch_tokens,
+        vision_features=vision_features,
+        prompt_tokenizer=prompt_tokenizer,
+        prefetch_depth=prefetch_depth,
+        length_bucketing=length_bucketing,
+        batch_sizer=batch_sizer,
+    )[0]
+
+
+def use_prefix_kv_cache(prefix_kv_cache, beam_inputs):
+    # 只有所有beam都已选择了icd时, 才有共享的前缀
+    return (
+        prefix_kv_cache
+        and len(beam_inputs) > 0
+        and all([len(beam_input['lang_x']) > 1 for beam_input in beam_inputs])
     )
 
-    # 2. 计算P(y|x, c)
-    info_score_list = []
-    cand_idx = sorted(list(candidate_set.keys()))
-    for batch in more_itertools.chunked(cand_idx, batch_size):
-        batch_data = [candidate_set[i] for i in batch]
-        new_icd_lang_x = [data['text_input'] for data in batch_data]
-        new_icd_image_x = [data['image'] for data in batch_data]
-
-        # 2.1 拼接文本输入
-        total_icd_lang_x_input = [
-            icd_join_char.join([icd_lang_x] + lang_x) + icd_join_char
-            for icd_lang_x in new_icd_lang_x
-        ]
-        total_icd_lang_x_input = tokenizer(
-            total_icd_lang_x_input, return_tensors='pt', padding=True
-        ).to(device=device)
 
-        icd_text_list = [
-            icd_join_char.join([icd_lang_x] + lang_x[:-1]) + icd_join_char
-            for icd_lang_x in new_icd_lang_x
+@torch.inference_mode()
+def get_beam_info_score(
+    model,
+    tokenizer,
+    image_processor,
+    device: str,
+    icd_join_char: str,
+    beam_inputs: List[Dict],
+    batch_size: int,
+    autocast_context,
+    split_token: Optional[str] = None,
+    prefix_kv_cache: bool = False,
+    max_batch_tokens: Optional[int] = None,
+    vision_features: bool = False,
+    prompt_tokenizer: Optional[PromptTokenizer] = None,
+    prefetch_depth: int = 0,
+    score_cache: Optional[ScoreCache] = None,
+    length_bucketing: bool = False,
+    batch_sizer: Optional[AdaptiveBatchSizer] = None,
+):
+    """
+    Compute the InfoScore of all beams in one beam search step. Every
+    (beam, candidate) pair is flattened into one work queue and packed into full
+    batches, then the scores are scattered back to each beam.
+
+    beam_inputs: a list of dict with the keys: lang_x, image_x and candidate_set.
+        The lang_x/image_x are the chosen icds + the test sample of the beam.
+        The beams can come from different test samples.
+    prefix_kv_cache: If set True, the candidate is placed between the chosen icds
+        and the test sample, so the chosen icds become a prefix shared by all
+        candidates of a beam. The prefix is encoded only once and its
+        past_key_values are broadcast across the candidate rows.
+    prompt_tokenizer: The PromptTokenizer caches the token ids of every segment,
+        share one across the beam search steps to tokenize each candidate once.
+    prefetch_depth: the num of batches prepared in background, see get_rows_ppl.
+    score_cache: If given, the beam_input should have a cache_key (e.g. the anchor
+        id and the ordered chosen icd ids). The cached candidate scores and
+        baselines are reused, only the missing ones are sent to the model.
+    length_bucketing: batch the rows by token length, see get_rows_ppl.
+    batch_sizer: the adaptive batch size shared by the whole run, see get_rows_ppl.
+    Returns:
+        A list of InfoScore tensors, in the sorted candidate idx order of each beam.
+    """
+    model.eval()
+    if prompt_tokenizer is None:
+        prompt_tokenizer = PromptTokenizer(tokenizer)
+
+    # 先查询缓存, 只有未命中的候选才需要计算
+    beam_cand_idx = [
+        sorted(list(beam_input['candidate_set'].keys())) for beam_input in beam_inputs
+    ]
+    beam_keys = [beam_input.get('cache_key') for beam_input in beam_inputs]
+    beam_miss_idx = [
+        [
+            idx
+            for idx in cand_idx
+            if score_cache is None or not score_cache.has_score(key, idx)
         ]
+        for key, cand_idx in zip(beam_keys, beam_cand_idx)
+    ]
+    work_beams = [beam_i for beam_i, miss in enumerate(beam_miss_idx) if miss]
+    work_inputs = [beam_inputs[beam_i] for beam_i in work_beams]
+    add_special_tokens = not use_prefix_kv_cache(prefix_kv_cache, work_inputs)
 
-        total_icd_input_token_num = [
-            get_input_token_num(tokenizer, icd_lang_x + query_test_lang_x_input)
-            for icd_lang_x in icd_text_list
+    # 所有segment只tokenize一次, prompt由token id拼接而成
+    segments = [icd_join_char]
+    for beam_i, beam_input in zip(work_beams, work_inputs):
+        lang_x = beam_input['lang_x']
+        segments += lang_x
+        segments.append(lang_x[-1].split(split_token)[0] + split_token)
+        segments += [
+            beam_input['candidate_set'][idx]['text_input']
+            for idx in beam_miss_idx[beam_i]
         ]
+    with profiler.timer('tokenize'):
+        prompt_tokenizer.encode(segments)
 
-        # 2.2 拼接图像输入
-        batch_total_vision_x = [
-            torch.stack([image_processor(icd_image_x)] + image_x, dim=0)
-            for icd_image_x in new_icd_image_x
+    base_rows = []
+    base_beams = []
+    beam_context = []
+    for beam_i, beam_input in zip(work_beams, work_inputs):
+        lang_x = beam_input['lang_x']
+        chosen_icd_segments = [
+            segment for icd in lang_x[:-1] for segment in (icd, icd_join_char)
         ]
-        total_vision_x = torch.stack(batch_total_vision_x, dim=0)
+        query_test_lang_x_input = lang_x[-1].split(split_token)[0] + split_token
+        image_x = [
+            process_image(image_processor, image) for image in beam_input['image_x']
+        ]
+        beam_context.append(
+            {
+                'chosen_icd_segments': chosen_icd_segments,
+                'test_lang_x_input': lang_x[-1],
+                'query_test_lang_x_input': query_test_lang_x_input,
+                'image_x': image_x,
+            }
+        )
+
+        # 1. 计算P(y|x)
+        if score_cache is not None and score_cache.has_base_ppl(beam_keys[beam_i]):
+            continue
+        base_beams.append(beam_i)
+        base_rows.append(
+            {
+                'input_ids': prompt_tokenizer(
+                    chosen_icd_segments + [lang_x[-1], icd_join_char]
+                ),
+                'mask_length': len(
+                    prompt_tokenizer(chosen_icd_segments + [query_test_lang_x_input])
+                ),
+                'vision_x': image_x,
+            }
+        )
+    base_ppl = {}
+    if base_rows:
+        base_ppl = dict(
+            zip(
+                base_beams,
+                get_rows_ppl(
+                    model,
+                    tokenizer,
+                    device,
+                    base_rows,
+                    batch_size,
+                    autocast_context,
+                    max_batch_tokens=max_batch_tokens,
+                    vision_features=vision_features,
+                    image_processor=image_processor,
+                    prefetch_depth=prefetch_depth,
+                    length_bucketing=length_bucketing,
+                    batch_sizer=batch_sizer,
+                ).tolist(),
+            )
+        )
+    for beam_i in work_beams:
+        if beam_i not in base_ppl:
+            base_ppl[beam_i] = score_cache.get_base_ppl(beam_keys[beam_i])
+        elif score_cache is not None:
+            score_cache.set_base_ppl(beam_keys[beam_i], base_ppl[beam_i])
 
-        total_vision_x = total_vision_x.unsqueeze(2).to(
-            device=device, non_blocking=True
+    # 2. 计算P(y|x, c)
+    past_key_values = None
+    prefix_attention_mask = None
+    use_prefix = not add_special_tokens
+    if use_prefix:
+        # 2.0 每个beam已选的icd作为共享前缀, 只计算一次
+        # 左padding使所有前缀右对齐, 便于和候选部分拼接
+        prefix_lang_x, prefix_attention_mask = pad_input_ids(
+            [prompt_tokenizer(ctx['chosen_icd_segments']) for ctx in beam_context],
+            tokenizer.pad_token_id,
+            padding_side='left',
         )
-        model_input = {
-            'vision_x': total_vision_x,
-            'lang_x': total_icd_lang_x_input['input_ids'],
-            'attention_mask': total_icd_lang_x_input['attention_mask'].bool(),
-        }
-        new_ppl = get_ppl(
+        prefix_attention_mask = prefix_attention_mask.to(device=device)
+        with profiler.timer('prefix_forward'), autocast_context:
+            prefix_outputs = flamingo_forward(
+                model,
+                **build_vision_input(
+                    [ctx['image_x'][:-1] for ctx in beam_context],
+                    device,
+                    vision_features,
+                ),
+                lang_x=prefix_lang_x.to(device=device),
+                attention_mask=prefix_attention_mask,
+                use_cache=True,
+            )
+        past_key_values = prefix_outputs.past_key_values
+
+    candidate_rows = []
+    for work_i, (beam_i, beam_input, ctx) in enumerate(
+        zip(work_beams, work_inputs, beam_context)
+    ):
+        for idx in beam_miss_idx[beam_i]:
+            icd_segments = [
+                beam_input['candidate_set'][idx]['text_input'],
+                icd_join_char,
+            ]
+            if not use_prefix:
+                icd_segments += ctx['chosen_icd_segments']
+            candidate_rows.append(
+                {
+                    'input_ids': prompt_tokenizer(
+                        icd_segments + [ctx['test_lang_x_input'], icd_join_char],
+                        add_special_tokens=add_special_tokens,
+                    ),
+                    'mask_length': len(
+                        prompt_tokenizer(
+                            icd_segments + [ctx['query_test_lang_x_input']],
+                            add_special_tokens=add_special_tokens,
+                        )
+                    ),
+                    # 候选图像在不同beam之间共享, 在batch准备线程中只处理一次
+                    'vision_x': [beam_input['candidate_set'][idx]['image']]
+                    + (ctx['image_x'][-1:] if use_prefix else ctx['image_x']),
+                    'beam': work_i,
+                }
+            )
+    cand_ppl = []
+    if candidate_rows:
+        cand_ppl = get_rows_ppl(
             model,
-            model_input,
+            tokenizer,
+            device,
+            candidate_rows,
+            batch_size,
             autocast_context,
-            icd_token_length=total_icd_input_token_num,
-            pad_token_id=tokenizer.pad_token_id,
+            past_key_values=past_key_values,
+            prefix_attention_mask=prefix_attention_mask,
+            max_batch_tokens=max_batch_tokens,
+            vision_features=vision_features,
+            image_processor=image_processor,
+            prefetch_depth=prefetch_depth,
+            length_bucketing=length_bucketing,
+            batch_sizer=batch_sizer,
+        ).split([len(beam_miss_idx[beam_i]) for beam_i in work_beams])
+
+    new_info_score = {}
+    for beam_i, sub_cand_ppl in zip(work_beams, cand_ppl):
+        info_score = (-sub_cand_ppl).exp() - torch.tensor(-base_ppl[beam_i]).exp()
+        new_info_score[beam_i] = dict(zip(beam_miss_idx[beam_i], info_score.tolist()))
+        if score_cache is not None:
+            for idx, score in new_info_score[beam_i].items():
+                score_cache.set_score(beam_keys[beam_i], idx, score)
+
+    profiler.count('candidate_scores', sum(len(cand_idx) for cand_idx in beam_cand_idx))
+    info_score_list = []
+    for beam_i, cand_idx in enumerate(beam_cand_idx):
+        beam_score = new_info_score.get(beam_i, {})
+        info_score_list.append(
+            torch.tensor(
+                [
+                    (
+                        beam_score[idx]
+                        if idx in beam_score
+                        else score_cache.get_score(beam_keys[beam_i], idx)
+                    )
+                    for idx in cand_idx
+                ]
+            )
         )
-        sub_info_score = (-new_ppl).exp() - (-ppl).exp()
-        info_score_list.append(sub_info_score)
-    return torch.cat(info_score_list)
+    return info_score_list
@@ -0,0 +1,264 @@
+import re
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+# the same as pycocoevalcap.tokenizer.ptbtokenizer
+PUNCTUATIONS = {
+    "''",
+    "'",
+    "``",
+    "`",
+    "-LRB-",
+    "-RRB-",
+    "-LCB-",
+    "-RCB-",
+    ".",
+    "?",
+    "!",
+    ",",
+    ":",
+    "-",
+    "--",
+    "...",
+    ";",
+}
+
+# the abbreviations which keep their period, matched in any case
+ABBREVIATIONS = (
+    r'Mrs?|Ms|Drs?|Profs?|Sens?|Reps?|Attys?|Lt|Col|Gen|Messrs|Govs?|Adm|Rev|Maj|'
+    r'Sgt|Cpl|Pvt|Capt|Ste?|Ave|Pres|Lieut|Hon|Brig|Co?mdr|Pfc|Spc|Supts?|Det|'
+    r'Mme|Mlle|Jr|Sr|Bros|Blvd|Rd|Esq|Ph\.D|Ed\.D|'
+    r'Jan|Feb|Mar|Apr|Jun|Jul|Aug|Sept?|Oct|Nov|Dec|Mon|Tues?|Wed|Thu|Thurs|Fri|'
+    r'Calif|Conn|Fla|Mich|Va|Ariz|Tenn|Md|Wis|Colo|Ga|Ind|Kan|Ky|Minn|Mo|Nev|Okla|'
+    r'Wyo|Vt|Mont|Neb|Ala|Ft|Mt|Penn|'
+    r'Inc|Cos?|Corp|Pty|Ltd|Plc|Bancorp|Dept|Bhd|Assn|Univ|Intl|Sys|Invt|Elec|'
+    r'Natl|Mfg|Mtg|tel|est|ext|sq|etc|al|seq|Bldg|vs|Alex|Wm|Jos|Cie|cf|TREAS'
+)
+# the abbreviations which are also common words, only the capitalized ones
+CAPITALIZED_ABBREVIATIONS = '|'.join(
+    f'{word[0]}(?i:{word[1:]})'
+    for word in ['Miss', 'Mass', 'Ill', 'Pa', 'Wash', 'La', 'Ore', 'Tex', 'Ark', 'Del']
+)
+# the abbreviations which keep their period before a number, e.g. No. 5
+NUMBER_ABBREVIATIONS = r'No|Nos|Figs?|Op|Ca|Pp'
+ESCAPES = {
+    '(': '-LRB-',
+    ')': '-RRB-',
+    '[': '-LSB-',
+    ']': '-RSB-',
+    '{': '-LCB-',
+    '}': '-RCB-',
+}
+NORMALIZE = [
+    ('&amp;', '&'),
+    ('\u00a0', ' '),
+    ('\u00ad', ''),
+    ('\u2018', "'"),
+    ('\u2019', "'"),
+    ('\u201c', '"'),
+    ('\u201d', '"'),
+    ('\u2026', '...'),
+]
+# the currency signs and the fractions rewritten by java
+CHARACTER_TOKENS = {
+    '\u00a2': 'cents',
+    '\u00a3': '#',
+    '\u20ac': '$',
+    '\u00bd': '1/2',
+    '\u00bc': '1/4',
+    '\u00be': '3/4',
+    '\u2153': '1/3',
+    '\u2154': '2/3',
+}
+
+# the vulgar fractions are numeric in python but not letters or digits in java
+LETTER = r'[^\W\d_\u00bc-\u00be\u2150-\u215f]'
+ALNUM = r'[^\W_\u00bc-\u00be\u2150-\u215f]'
+ALNUM_WORD = rf'(?:[dDoOlL]\'(?={ALNUM}))?{ALNUM}+(?:_{ALNUM}+)*'
+# the JFlex URL and email macros of corenlp, ',-_' is a character range there too
+FULL_URL = r'https?://[^ \t\n\f\r"<>|()]+[^ \t\n\f\r"<>|.!?(){},-]'
+LIKELY_URL = (
+    r'(?:www\.(?:[^ \t\n\f\r"<>|.!?(){},]+\.)+[a-zA-Z]{2,4}'
+    r'|(?:[^ \t\n\f\r"`\'<>|.!?(){},-_$]+\.)+(?:com|net|org|edu))'
+    r'(?:/[^ \t\n\f\r"<>|()]+[^ \t\n\f\r"<>|.!?(){},-])?'
+)
+EMAIL = (
+    r'[a-zA-Z0-9][^ \t\n\f\r"<>|()\u00a0{}]*@'
+    r'(?:[^ \t\n\f\r"<>|(){}.\u00a0]+\.)*[^ \t\n\f\r"<>|(){}.\u00a0]+'
+)
+APOSTROPHE_WORD = (
+    r"'[nN]'|'[nN](?![A-Za-z])|'em|'cause|'till?|'[2-9]0s|'[tT](?=(?i:is|was)\b)"
+    r"|[lLdDjJ]'|[yY]'(?=[A-Za-z])|ol'|Dunkin'|somethin'"
+    r"|c'mon|s'mores|ev'ry|li'l|nat'l|e'er"
+    r"|[A-Za-z]*[aeiouyAEIOUY]'[aeiouA-Z][A-Za-z]*"
+)
+# the tags like <b>, <a href="x">, the other <...> are split
+SGML = r'<![A-Za-z][^<>]*>|</?[A-Za-z][\w:.@+-]*(?:\s+[\w:-]+="[^"<>]*")*\s*/?>'
+SMILEY = rf'[<>]?[:;=][\-o*\']?[()DPdpO{{@|\[\]](?!{ALNUM})'
+# (rule name, token regex, trailing context regex), the same as the JFlex lexer
+# the longest match (token + trailing context) wins, ties go to the first rule
+RULES = [
+    (
+        'token',
+        r'(?i:can(?=not\b)|gon(?=na\b)|got(?=ta\b)|wan(?=na\b)|gim(?=me\b)|lem(?=me\b))',
+        r'(?i:not|na|ta|me)',
+    ),
+    ('token', r'[A-Za-z]*[A-MO-Za-mo-z]', r"[nN]'[tT](?![A-Za-z])"),
+    ('neg', r"[nN]'[tT](?![A-Za-z])", None),
+    ('token', rf'{ALNUM}+', r"'(?:[msdMSD]|re|RE|ve|VE|ll|LL)(?![A-Za-z])"),
+    ('token', r"'(?:[msdMSD]|re|RE|ve|VE|ll|LL)(?![A-Za-z])", None),
+    ('token', rf'{ALNUM_WORD}(?:-{ALNUM_WORD})*', None),
+    # dotted words like dog.The (a missing space) are kept as one token
+    (
+        'token',
+        rf'{LETTER}{ALNUM}*(?:[.!?]{LETTER}{ALNUM}*)+(?:-{ALNUM_WORD})*',
+        None,
+    ),
+    # slashed words like and/or, km/h, 12/25/2010
+    (
+        'token',
+        rf'{ALNUM}+(?:-{LETTER}+){{0,2}}(?:\\?/{ALNUM}+(?:-{LETTER}+){{0,2}}){{1,2}}',
+        None,
+    ),
+    ('token', r"[A-HJ-XZn]'[A-Za-z]{2,}", None),
+    ('token', APOSTROPHE_WORD, None),
+    ('token', r'[A-Z]+(?:[+&][A-Z]+)+|[A-Za-z]\+\+|[A-Za-z]#(?![A-Za-z])', None),
+    ('token', FULL_URL, None),
+    ('token', LIKELY_URL, None),
+    ('token', EMAIL, None),
+    ('token', r'@[A-Za-z][A-Za-z0-9_]*|#+' + LETTER + '*', None),
+    ('token', r'[-+]?(?:\d*(?:[.:,]\d+)+|\d+)', None),
+    ('token', r'\d{1,2}-\d{1,2}-\d{2,4}', None),
+    ('token', r'[A-Za-z](?:\.[A-Za-z])*\.', None),
+    ('token', rf'(?i:{ABBREVIATIONS})\.|(?:{CAPITALIZED_ABBREVIATIONS})\.', None),
+    ('token', rf'(?i:{NUMBER_ABBREVIATIONS})\.(?=\s*\d)', None),
+    ('ellipsis', r'\.\.\.+|\. \. \.', None),
+    ('dash', r'-{2,4}|[\u2013\u2014]', None),
+    ('token', r'[?!]+|\*+|__+|-{5,}|<<|>>', None),
+    ('sgml', SGML, None),
+    ('smiley', SMILEY, None),
+    ('double_quote', r'"|\'\'|``', None),
+    ('single_quote', r"'|`", None),
+    ('escape', r'[()\[\]{}]', None),
+    # java drops the characters out of the BMP, e.g. emojis
+    ('untokenizable', r'[\U00010000-\U0010ffff]', None),
+    ('character', r'\S', None),
+]
+RULES = [
+    (
+        name,
+        re.compile(token),
+        re.compile(context) if context is not None else None,
+    )
+    for name, token, context in RULES
+]
+SPACE = re.compile(r'\s+')
+# a plain word up to the next space is a token by itself, except the words
+# split by the first rule, so most words skip the rules
+PLAIN_WORD = re.compile(rf'{ALNUM}+(?=\s|$)')
+SPLIT_WORDS = {'cannot', 'gonna', 'gotta', 'wanna', 'gimme', 'lemme'}
+
+
+def is_open_context(line: str, pos: int) -> bool:
+    # 引号前面是开头/空白/左括号时为左引号
+    return pos == 0 or line[pos - 1].isspace() or line[pos - 1] in '([{'
+
+
+@lru_cache(maxsize=1 << 16)
+def tokenize_line(line: str) -> Tuple[str, ...]:
+    """
+    The lowercased PTB tokens of one line, a python port of the Stanford
+    corenlp 3.4.1 PTBTokenizer -preserveLines -lowerCase used by pycocoevalcap.
+    """
+    for old, new in NORMALIZE:
+        line = line.replace(old, new)
+    tokens = []
+    pos = 0
+    while True:
+        space = SPACE.match(line, pos)
+        if space is not None:
+            pos = space.end()
+        if pos >= len(line):
+            break
+        plain = PLAIN_WORD.match(line, pos)
+        if plain is not None and plain.group().lower() not in SPLIT_WORDS:
+            tokens.append(plain.group().lower())
+            pos = plain.end()
+            continue
+        best, best_len = None, 0
+        for name, token, context in RULES:
+            m = token.match(line, pos)
+            if m is None or m.end() == pos:
+                continue
+            length = m.end() - pos
+            if context is not None:
+                c = context.match(line, m.end())
+                if c is None:
+                    continue
+                length += c.end() - m.end()
+            if length > best_len:
+                best, best_len = (name, m.group()), length
+        name, text = best
+        pos += len(text)
+        if name == 'untokenizable':
+            continue
+        elif name == 'neg':
+            text = "n't"
+        elif name == 'ellipsis':
+            text = '...'
+        elif name == 'dash':
+            text = '--'
+        elif name == 'double_quote':
+            text = '``' if is_open_context(line, pos - len(text)) else "''"
+        elif name == 'single_quote':
+            is_open = is_open_context(line, pos - len(text))
+            text = '`' if text == '`' or is_open else "'"
+        elif name == 'escape':
+            text = ''.join(ESCAPES.get(c, c) for c in text)
+        elif name == 'sgml':
+            # the spaces in a tag are kept as no-break spaces
+            text = SPACE.sub('\u00a0', text)
+        elif name == 'character':
+            text = CHARACTER_TOKENS.get(text, text)
+        elif name == 'smiley':
+            text = text.replace('(', '-LRB-').replace(')', '-RRB-')
+        tokens.append(text.lower())
+    return tuple(tokens)
+
+
+class PTBTokenizer:
+    """
+    In-process stand-in of pycocoevalcap.tokenizer.ptbtokenizer.PTBTokenizer,
+    without the java subprocess and the temp files. It is not token-for-token
+    identical to java, check it with scripts/check_ptb_tokenizer.py before
+    using it for the reported scores.
+    """
+
+    def tokenize(self, captions_for_image: Dict) -> Dict[int, List[str]]:
+        final_tokenized_captions_for_image = {}
+        for k, v in captions_for_image.items():
+            final_tokenized_captions_for_image[k] = [
+                ' '.join(
+                    w
+                    for w in tokenize_line(c['caption'].replace('\n', ' '))
+                    if w not in PUNCTUATIONS
+                )
+                for c in v
+            ]
+        return final_tokenized_captions_for_image
+
+
+def build_ptb_tokenizer(ptb_tokenizer: str = 'java'):
+    """
+    java: the corenlp PTBTokenizer of pycocoevalcap, the reference tokenization.
+    python: the in-process port above, no java is needed.
+    """
+    if ptb_tokenizer == 'java':
+        from pycocoevalcap.tokenizer.ptbtokenizer import (
+            PTBTokenizer as JavaPTBTokenizer,
+        )
+
+        return JavaPTBTokenizer()
+    elif ptb_tokenizer == 'python':
+        return PTBTokenizer()
+    raise ValueError(f'{ptb_tokenizer=} error, should in ["java", "python"]')
@@ -0,0 +1,332 @@
+"""
+A tiny randomly initialised stand-in of init_flamingo for CPU benchmarks.
+
+The model is the real open_flamingo Flamingo (perceiver + gated cross attention)
+around a tiny vision encoder and a tiny causal LM, so the same code paths run
+(the tuple past_key_values with the batch dim first like MPT, the cached vision
+features, generate). The outputs are meaningless, only the cost matters.
+"""
+
+import contextlib
+import json
+import os
+import random
+from types import SimpleNamespace
+
+import datasets
+import numpy as np
+import open_clip
+import torch
+import torch.nn.functional as F
+from open_flamingo.src.flamingo import Flamingo
+from open_flamingo.src.flamingo_lm import FlamingoLMMixin
+from open_flamingo.src.helpers import PerceiverResampler
+from open_flamingo.src.utils import extend_instance
+from PIL import Image
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast
+from transformers.modeling_outputs import CausalLMOutputWithPast
+
+COLORS = 'red blue green yellow white black brown orange pink gray'.split()
+OBJECTS = (
+    'man woman dog cat horse bus train car bike plate pizza kite boat bird '
+    'giraffe elephant zebra table bench clock umbrella surfboard'.split()
+)
+VERBS = 'riding sitting standing eating holding walking flying parked lying'.split()
+PLACES = 'street beach field kitchen table park road water grass room snow'.split()
+OTHER_WORDS = 'a an the on in of with near two three some is are and'.split()
+PROMPT_WORDS = ['Output', 'Question', 'Short', 'answer', ':', '?', '.', ',', '"']
+
+
+def build_mock_tokenizer():
+    vocab = {'<|endoftext|>': 0, '<image>': 1, '<|endofchunk|>': 2, '[UNK]': 3}
+    for word in COLORS + OBJECTS + VERBS + PLACES + OTHER_WORDS + PROMPT_WORDS:
+        vocab.setdefault(word, len(vocab))
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token='[UNK]'))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        eos_token='<|endoftext|>',
+        unk_token='[UNK]',
+        additional_special_tokens=['<image>', '<|endofchunk|>'],
+    )
+    # the same as init_flamingo
+    tokenizer.padding_side = 'left'
+    tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+
+class TinyVisionEncoder(torch.nn.Module):
+    """Patch embedding only, returns (pooled, tokens) like the open_clip visual."""
+
+    def __init__(self, vis_dim, patch_size):
+        super().__init__()
+        self.patch_embed = torch.nn.Conv2d(3, vis_dim, patch_size, stride=patch_size)
+
+    def forward(self, x):
+        tokens = self.patch_embed(x).flatten(2).transpose(1, 2)
+        return tokens.mean(1), tokens
+
+
+class TinyDecoderBlock(torch.nn.Module):
+    def __init__(self, hidden_size, num_heads):
+        super().__init__()
+        self.num_heads = num_heads
+        self.ln_1 = torch.nn.LayerNorm(hidden_size)
+        self.qkv = torch.nn.Linear(hidden_size, 3 * hidden_size)
+        self.proj = torch.nn.Linear(hidden_size, hidden_size)
+        self.ln_2 = torch.nn.LayerNorm(hidden_size)
+        self.mlp = torch.nn.Sequential(
+            torch.nn.Linear(hidden_size, 4 * hidden_size),
+            torch.nn.GELU(),
+            torch.nn.Linear(4 * hidden_size, hidden_size),
+        )
+
+    def forward(self, x, attention_mask=None, layer_past=None, use_cache=False):
+        b, t, d = x.shape
+        q, k, v = (
+            self.qkv(self.ln_1(x))
+            .view(b, t, 3, self.num_heads, d // self.num_heads)
+            .permute(2, 0, 3, 1, 4)
+        )
+        if layer_past is not None:
+            k = torch.cat([layer_past[0], k], dim=2)
+            v = torch.cat([layer_past[1], v], dim=2)
+        # attention_mask: (b, past + t), 1 for the real tokens
+        past_len = k.shape[2] - t
+        causal = torch.ones(t, k.shape[2], dtype=torch.bool, device=x.device).tril(
+            past_len
+        )
+        mask = causal[None, None]
+        if attention_mask is not None:
+            mask = mask & attention_mask[:, None, None, :].bool()
+        # a fully masked row (left padding) attends to itself to avoid nan
+        positions = torch.arange(k.shape[2], device=x.device)
+        mask = mask | (positions[None] == positions[past_len:, None])[None, None]
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+        x = x + self.proj(out.transpose(1, 2).reshape(b, t, d))
+        x = x + self.mlp(self.ln_2(x))
+        return x, ((k, v) if use_cache else None)
+
+
+class TinyCausalLM(torch.nn.Module):
+    """
+    A GPT-like LM with the MPT style cache: past_key_values is a tuple of (k, v)
+    of every layer, k/v: (batch, heads, seq, head_dim).
+    """
+
+    def __init__(self, vocab_size, hidden_size=128, num_layers=4, num_heads=4):
+        super().__init__()
+        self.config = SimpleNamespace(
+            hidden_size=hidden_size, vocab_size=vocab_size, max_position=2048
+        )
+        self.wte = torch.nn.Embedding(vocab_size, hidden_size)
+        self.wpe = torch.nn.Embedding(self.config.max_position, hidden_size)
+        self.blocks = torch.nn.ModuleList(
+            [TinyDecoderBlock(hidden_size, num_heads) for _ in range(num_layers)]
+        )
+        self.ln_f = torch.nn.LayerNorm(hidden_size)
+        self.lm_head = torch.nn.Linear(hidden_size, vocab_size, bias=False)
+
+    def get_input_embeddings(self):
+        return self.wte
+
+    def forward(
+        self,
+        input_ids,
+        attention_mask=None,
+        past_key_values=None,
+        use_cache=False,
+        labels=None,
+        **kwargs,
+    ):
+        if attention_mask is None:
+            past_len = 0 if past_key_values is None else past_key_values[0][0].shape[2]
+            attention_mask = torch.ones(
+                input_ids.shape[0],
+                past_len + input_ids.shape[1],
+                dtype=torch.long,
+                device=input_ids.device,
+            )
+        # the position of the left padded rows starts from the first real token
+        position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+        position_ids = position_ids[:, -input_ids.shape[1] :]
+        x = self.wte(input_ids) + self.wpe(position_ids)
+        presents = []
+        for i, block in enumerate(self.blocks):
+            x, present = block(
+                x,
+                attention_mask=attention_mask,
+                layer_past=None if past_key_values is None else past_key_values[i],
+                use_cache=use_cache,
+            )
+            presents.append(present)
+        logits = self.lm_head(self.ln_f(x))
+        return CausalLMOutputWithPast(
+            logits=logits, past_key_values=tuple(presents) if use_cache else None
+        )
+
+    @torch.no_grad()
+    def generate(
+        self,
+        input_ids,
+        attention_mask=None,
+        eos_token_id=None,
+        pad_token_id=0,
+        max_new_tokens=20,
+        num_beams=1,
+        stopping_criteria=None,
+        **kwargs,
+    ):
+        """
+        Beam search with the sum of log probs (length_penalty=0), a beam is
+        finished by eos_token_id or stopping_criteria, the other HF generate
+        arguments are ignored. Returns input_ids + the generated tokens
+        of the best beam.
+        """
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        eos_token_id = torch.tensor(
+            eos_token_id if isinstance(eos_token_id, (list, tuple)) else [eos_token_id],
+            device=input_ids.device,
+        )
+        batch_size = input_ids.shape[0]
+        # the vision features have been repeated num_beams times by Flamingo.generate
+        ids = input_ids.repeat_interleave(num_beams, dim=0)
+        attention_mask = attention_mask.repeat_interleave(num_beams, dim=0)
+        beam_scores = torch.zeros(batch_size, num_beams, device=ids.device)
+        beam_scores[:, 1:] = float('-inf')
+        finished = torch.zeros(ids.shape[0], dtype=torch.bool, device=ids.device)
+        past_key_values = None
+        step_ids = ids
+        for _ in range(max_new_tokens):
+            outputs = self(
+                input_ids=step_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+            log_probs = outputs.logits[:, -1].float().log_softmax(-1)
+            # a finished beam can only be extended by the pad token with no cost
+            log_probs[finished] = float('-inf')
+            log_probs[finished, pad_token_id] = 0
+            vocab_size = log_probs.shape[-1]
+            scores = (beam_scores.view(-1, 1) + log_probs).view(batch_size, -1)
+            beam_scores, top_idx = scores.topk(num_beams, dim=1)
+            src = (
+                torch.arange(batch_size, device=ids.device)[:, None] * num_beams
+                + top_idx // vocab_size
+            ).view(-1)
+            tokens = (top_idx % vocab_size).view(-1, 1)
+
+            ids = torch.cat([ids[src], tokens], dim=1)
+            finished = finished[src] | torch.isin(tokens[:, 0], eos_token_id)
+            if stopping_criteria is not None:
+                finished |= torch.as_tensor(
+                    stopping_criteria(ids, log_probs), device=ids.device
+                )
+            attention_mask = torch.cat(
+                [attention_mask[src], torch.ones_like(tokens)], dim=1
+            )
+            past_key_values = tuple(
+                (k.index_select(0, src), v.index_select(0, src))
+                for k, v in outputs.past_key_values
+            )
+            step_ids = tokens
+            if finished.all():
+                break
+        return ids.view(batch_size, num_beams, -1)[:, 0]
+
+
+def init_mock_flamingo(
+    device='cpu',
+    hidden_size=128,
+    num_layers=4,
+    num_heads=4,
+    vis_dim=64,
+    image_size=32,
+    patch_size=8,
+    num_latents=16,
+    cross_attn_every_n_layers=1,
+    seed=0,
+):
+    """
+    The same return values as init_flamingo:
+        model, image_processor, tokenizer, autocast_context
+    """
+    torch.manual_seed(seed)
+    tokenizer = build_mock_tokenizer()
+    lang_encoder = TinyCausalLM(len(tokenizer), hidden_size, num_layers, num_heads)
+    extend_instance(lang_encoder, FlamingoLMMixin)
+    lang_encoder.set_decoder_layers_attr_name('blocks')
+    vision_encoder = torch.nn.Module()
+    vision_encoder.visual = TinyVisionEncoder(vis_dim, patch_size)
+    model = Flamingo(
+        vision_encoder,
+        lang_encoder,
+        eoc_token_id=tokenizer.convert_tokens_to_ids('<|endofchunk|>'),
+        media_token_id=tokenizer.convert_tokens_to_ids('<image>'),
+        vis_dim=vis_dim,
+        cross_attn_every_n_layers=cross_attn_every_n_layers,
+    )
+    model.perceiver = PerceiverResampler(dim=vis_dim, depth=1, num_latents=num_latents)
+    # the gates are zero at init, open them so the images change the outputs
+    for name, param in model.named_parameters():
+        if 'gate' in name:
+            param.data.fill_(0.5)
+    model.to(device=device)
+    model.eval()
+    image_processor = open_clip.image_transform(
+        (image_size, image_size), is_train=False
+    )
+    return model, image_processor, tokenizer, contextlib.nullcontext()
+
+
+def random_caption(rng: random.Random):
+    return (
+        f'a {rng.choice(COLORS)} {rng.choice(OBJECTS)} {rng.choice(VERBS)} '
+        f'{rng.choice(["on", "in", "near"])} the {rng.choice(PLACES)}'
+    )
+
+
+def build_synthetic_coco(num_samples, ann_dir=None, image_size=64, seed=0):
+    """
+    A COCO caption like HF dataset with the same columns as load_coco_ds
+    (single_caption, image, idx, image_id, captions), the images are random PIL
+    images. If ann_dir is given, the COCO format caption annotation file
+    <ann_dir>/captions_synthetic.json is also written for compute_cider.
+    """
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+    rows = []
+    for idx in range(num_samples):
+        captions = [random_caption(rng) for _ in range(5)]
+        color = np_rng.integers(0, 256, size=3)
+        noise = np_rng.integers(-32, 32, size=(image_size, image_size, 3))
+        image = np.clip(color + noise, 0, 255).astype(np.uint8)
+        rows.append(
+            {
+                'single_caption': captions[0],
+                'image': Image.fromarray(image),
+                'idx': idx,
+                'image_id': 100000 + idx,
+                'captions': captions,
+            }
+        )
+    ds = datasets.Dataset.from_list(rows)
+    if ann_dir is not None:
+        os.makedirs(ann_dir, exist_ok=True)
+        ann = {
+            'info': {},
+            'licenses': [],
+            'type': 'captions',
+            'images': [{'id': row['image_id']} for row in rows],
+            'annotations': [
+                {'image_id': row['image_id'], 'id': i * 5 + j, 'caption': caption}
+                for i, row in enumerate(rows)
+                for j, caption in enumerate(row['captions'])
+            ],
+        }
+        with open(os.path.join(ann_dir, 'captions_synthetic.json'), 'w') as f:
+            json.dump(ann, f)
+    return ds
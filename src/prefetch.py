@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable
+
+import torch
+
+
+class Prefetcher:
+    """
+    Build the batches in a background thread pool while the caller runs the
+    previous batch on the device:
+
+        prefetcher = Prefetcher(build_batch, batch_index_list, queue_depth=2)
+        for batch in prefetcher:
+            ...
+        logger.debug(prefetcher.timing_info())
+
+    queue_depth: the max num of batches built ahead, 0 builds every batch in the
+        caller thread (no overlap).
+    timing: prepare is the time spent building the batches (in the workers),
+        wait is the time the caller blocked for a batch, compute is the time the
+        caller spent on the batches. wait << prepare means the overlap works.
+    """
+
+    def __init__(
+        self,
+        build_fn: Callable,
+        items: Iterable,
+        queue_depth: int = 2,
+        num_workers: int = 1,
+    ):
+        self.build_fn = build_fn
+        self.items = items
+        self.queue_depth = queue_depth
+        self.num_workers = num_workers
+        self.timing = {'prepare': 0.0, 'wait': 0.0, 'compute': 0.0}
+        self._timing_lock = threading.Lock()
+
+    def _build(self, item):
+        begin = time.perf_counter()
+        batch = self.build_fn(item)
+        with self._timing_lock:
+            self.timing['prepare'] += time.perf_counter() - begin
+        return batch
+
+    def __iter__(self):
+        items = iter(self.items)
+        if self.queue_depth <= 0:
+            for item in items:
+                batch = self._build(item)
+                begin = time.perf_counter()
+                yield batch
+                self.timing['compute'] += time.perf_counter() - begin
+            return
+
+        with ThreadPoolExecutor(self.num_workers) as pool:
+            futures = deque(
+                pool.submit(self._build, item)
+                for _, item in zip(range(self.queue_depth), items)
+            )
+            while futures:
+                begin = time.perf_counter()
+                batch = futures.popleft().result()
+                self.timing['wait'] += time.perf_counter() - begin
+                for item in items:
+                    futures.append(pool.submit(self._build, item))
+                    break
+                begin = time.perf_counter()
+                yield batch
+                self.timing['compute'] += time.perf_counter() - begin
+
+    def timing_info(self):
+        return ', '.join(f'{k}: {v:.3f}s' for k, v in self.timing.items())
+
+
+def use_pin_memory(device):
+    return torch.device(device).type == 'cuda'
@@ -0,0 +1,174 @@
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+from loguru import logger
+
+
+class _Timer:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.begin, self.profiler.sync())
+
+
+class Profiler:
+    """
+    Named stage timers of one process (rank):
+
+        with profiler.timer('forward'):
+            ...
+        profiler.count('anchors', len(anchor_list))
+
+    When disabled, timer() returns a shared nullcontext and count() returns at
+    once, so the instrumentation costs nothing.
+    cuda_sync: synchronize the device when a timer exits, so the asynchronous
+        device time is attributed to its stage instead of the next sync point.
+    trace: keep a chrome trace event of every timer (chrome://tracing or
+        https://ui.perfetto.dev), at most max_trace_events.
+    """
+
+    def __init__(self):
+        self.enable = False
+        self.configure()
+
+    def configure(
+        self,
+        enable=False,
+        cuda_sync=False,
+        trace=False,
+        max_trace_events=1000000,
+        device=None,
+    ):
+        self.enable = enable
+        self.cuda_sync = cuda_sync and torch.cuda.is_available()
+        self.trace = trace
+        self.max_trace_events = max_trace_events
+        self.device = device
+        self.durations = defaultdict(list)
+        self.counters = Counter()
+        self.trace_events = []
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    def timer(self, name):
+        if not self.enable:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def count(self, name, num=1):
+        if self.enable:
+            with self.lock:
+                self.counters[name] += num
+
+    def sync(self):
+        if self.cuda_sync:
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def record(self, name, begin, end):
+        with self.lock:
+            self.durations[name].append(end - begin)
+            if self.trace and len(self.trace_events) < self.max_trace_events:
+                self.trace_events.append(
+                    {
+                        'name': name,
+                        'ph': 'X',
+                        'ts': (begin - self.start) * 1e6,
+                        'dur': (end - begin) * 1e6,
+                        'pid': os.getpid(),
+                        'tid': threading.get_ident(),
+                    }
+                )
+
+    def summary(self):
+        wall_time = time.perf_counter() - self.start
+        stages = {}
+        for name, durations in sorted(self.durations.items()):
+            durations = np.array(durations)
+            p50, p90, p99 = np.percentile(durations, [50, 90, 99])
+            stages[name] = {
+                'num': len(durations),
+                'total': float(durations.sum()),
+                'ratio': float(durations.sum() / wall_time),
+                'mean': float(durations.mean()),
+                'p50': float(p50),
+                'p90': float(p90),
+                'p99': float(p99),
+                'max': float(durations.max()),
+            }
+        return {
+            'wall_time': wall_time,
+            'stages': stages,
+            'counters': dict(self.counters),
+            'throughput': {
+                f'{name}/s': num / wall_time for name, num in self.counters.items()
+            },
+            'anchors/hour': self.counters['anchors'] / wall_time * 3600,
+        }
+
+    def summary_info(self, summary=None):
+        summary = summary or self.summary()
+        lines = [
+            f'wall time: {summary["wall_time"]:.1f}s, '
+            f'anchors/hour: {summary["anchors/hour"]:.1f}, '
+            + ', '.join(f'{k}: {v:.2f}' for k, v in summary['throughput'].items())
+        ]
+        for name, stage in summary['stages'].items():
+            lines.append(
+                f'{name:<24} num: {stage["num"]:<8} total: {stage["total"]:.2f}s '
+                f'({stage["ratio"]:.1%}) p50: {stage["p50"] * 1000:.1f}ms '
+                f'p90: {stage["p90"] * 1000:.1f}ms p99: {stage["p99"] * 1000:.1f}ms'
+            )
+        return '\n'.join(lines)
+
+    def export(self, save_path):
+        """
+        Save the summary to <save_path>.json and the chrome trace to
+        <save_path>_trace.json.
+        """
+        if not self.enable:
+            return
+        save_dir = os.path.dirname(save_path)
+        if save_dir and not os.path.exists(save_dir):
+            os.makedirs(save_dir, exist_ok=True)
+        summary = self.summary()
+        logger.info(f'profile of {save_path}:\n{self.summary_info(summary)}')
+        with open(f'{save_path}.json', 'w') as f:
+            json.dump(summary, f, indent=2)
+        if self.trace:
+            with open(f'{save_path}_trace.json', 'w') as f:
+                json.dump({'traceEvents': self.trace_events}, f)
+            logger.info(f'save the chrome trace to {save_path}_trace.json')
+
+
+_NULL_TIMER = nullcontext()
+_profiler = Profiler()
+
+configure = _profiler.configure
+timer = _profiler.timer
+count = _profiler.count
+export = _profiler.export
+summary = _profiler.summary
+
+
+def configure_from_cfg(cfg, device=None):
+    if cfg is None:
+        return
+    configure(
+        enable=cfg.enable,
+        cuda_sync=cfg.cuda_sync,
+        trace=cfg.trace,
+        device=device,
+    )
@@ -0,0 +1,64 @@
+import math
+from typing import Callable, Dict, List
+
+import torch
+from loguru import logger
+
+from src.feature_store import FeatureStore
+
+
+def successive_halving(
+    candidate_idx_list: List[List[int]],
+    rounds: List[Dict],
+    beam_size: int,
+    get_proxy_score: Callable,
+):
+    """
+    Prune the candidates of every beam with the cheap proxies round by round.
+
+    candidate_idx_list: the candidate idx of every beam.
+    rounds: a list of {'proxy': name, 'keep_ratio': float}, each round keeps the
+        top keep_ratio of the survivors (at least beam_size) by the proxy score.
+    get_proxy_score(proxy, candidate_idx_list) -> the proxy scores of every beam,
+        all beams are passed at once so the proxy can batch them.
+    Returns:
+        The survivor idx of every beam, and a {proxy: pruned idx list} dict of
+        every beam.
+    """
+    survivor_list = [list(idx_list) for idx_list in candidate_idx_list]
+    pruned_list = [{} for _ in candidate_idx_list]
+    for pruning_round in rounds:
+        proxy = pruning_round['proxy']
+        score_list = get_proxy_score(proxy, survivor_list)
+        for beam_i, (survivors, scores) in enumerate(zip(survivor_list, score_list)):
+            keep_num = max(
+                beam_size, math.ceil(len(survivors) * pruning_round['keep_ratio'])
+            )
+            pruned = pruned_list[beam_i].setdefault(proxy, [])
+            if keep_num >= len(survivors):
+                continue
+            order = torch.tensor(scores).argsort(descending=True).tolist()
+            survivor_list[beam_i] = [survivors[i] for i in order[:keep_num]]
+            pruned.extend(sorted(survivors[i] for i in order[keep_num:]))
+    return survivor_list, pruned_list
+
+
+def get_clip_proxy_score(feature_path, anchor_idx_list, candidate_set_idx):
+    """
+    The similarity between the clip features of the anchor and each candidate,
+    the features are the FeatureStore of the normalized ones saved by the
+    similarity samplers, only the rows of the anchors and candidates are read.
+    Returns a {candidate idx: score} dict of every anchor.
+    """
+    if not FeatureStore.exists(feature_path):
+        raise ValueError(
+            f'the clip feature {feature_path} does not exist, '
+            'please run the ImgSimSampler/TextSimSampler to build it first'
+        )
+    logger.info(f'open the clip feature store {feature_path}')
+    features = FeatureStore.open(feature_path)
+    clip_score_list = []
+    for anchor_idx, cand_idx in zip(anchor_idx_list, candidate_set_idx):
+        scores = features[cand_idx] @ features[anchor_idx]
+        clip_score_list.append(dict(zip(cand_idx, scores.tolist())))
+    return clip_score_list
@@ -0,0 +1,88 @@
+import glob
+import json
+import os
+from typing import Dict, List
+
+from loguru import logger
+
+
+def load_result_log(log_path) -> Dict:
+    """
+    Read an append-only JSONL result log, every line is a {data_id: result} dict.
+    A partially written last line (the process was killed while writing) is
+    dropped and truncated from the file, so the log can be appended again. A
+    complete last line without the newline gets one, so the next record does
+    not continue it.
+    """
+    res = {}
+    if not os.path.exists(log_path):
+        return res
+    valid_size = 0
+    last_line = b''
+    with open(log_path, 'rb') as f:
+        for line in f:
+            try:
+                res.update(json.loads(line))
+            except json.JSONDecodeError:
+                logger.warning(f'drop the broken record at the end of {log_path}')
+                break
+            valid_size += len(line)
+            last_line = line
+    if valid_size != os.path.getsize(log_path):
+        with open(log_path, 'r+b') as f:
+            f.truncate(valid_size)
+    elif last_line and not last_line.endswith(b'\n'):
+        with open(log_path, 'ab') as f:
+            f.write(b'\n')
+    return res
+
+
+def append_result_log(log_path, res: Dict):
+    with open(log_path, 'a') as f:
+        for k, v in res.items():
+            f.write(json.dumps({k: v}) + '\n')
+
+
+def merge_result_logs(log_path_list: List[str], save_path):
+    """
+    Stream the records of several result logs into one json dict file, only
+    the keys are kept in memory.
+    """
+    seen_keys = set()
+    with open(save_path, 'w') as out_f:
+        out_f.write('{')
+        for log_path in log_path_list:
+            record_num = 0
+            with open(log_path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning(
+                            f'drop the broken record at the end of {log_path}'
+                        )
+                        break
+                    for k, v in record.items():
+                        if k in seen_keys:
+                            continue
+                        if seen_keys:
+                            out_f.write(', ')
+                        seen_keys.add(k)
+                        out_f.write(f'{json.dumps(k)}: {json.dumps(v)}')
+                        record_num += 1
+            logger.info(f'load the data from {log_path}, the data length: {record_num}')
+        out_f.write('}')
+    return len(seen_keys)
+
+
+def get_rank_log_path(save_path, rank):
+    save_dir, basename = os.path.split(save_path)
+    return os.path.join(save_dir, basename.split('.')[0] + f'_rank:{rank}.jsonl')
+
+
+def find_rank_logs(save_path) -> List[str]:
+    # the ranks pull the anchors from a shared queue, so every rank log may hold
+    # any anchor, and the gpu num can be changed between runs
+    save_dir, basename = os.path.split(save_path)
+    pattern = glob.escape(basename.split('.')[0]) + '_rank:*.jsonl'
+    return sorted(glob.glob(os.path.join(glob.escape(save_dir), pattern)))
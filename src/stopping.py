@@ -0,0 +1,65 @@
+from typing import List, Optional
+
+import torch
+import transformers
+from packaging import version
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+# the stopping criteria can finish single rows since transformers 4.39
+PER_ROW_STOPPING = version.parse(transformers.__version__) >= version.parse('4.39.0')
+
+
+class StopStringCriteria(StoppingCriteria):
+    """
+    Finish a row once its newest token completes one of stop_strings, e.g. the
+    "Output" of the next in-context example, which is cut off by the
+    post-processing anyway.
+    Only the last tokens of each row are decoded. A stop string has to end in
+    the newest token, so the "Output:" at the end of the prompt never matches,
+    and nothing is kept between the steps or the generate calls.
+    """
+
+    def __init__(self, tokenizer, stop_strings: List[str]):
+        self.tokenizer = tokenizer
+        self.stop_strings = list(stop_strings)
+        # every token decodes to at least one character
+        self.tail_len = max(len(s) for s in self.stop_strings) + 1
+
+    def __call__(self, input_ids, scores, **kwargs):
+        tail = input_ids[:, -self.tail_len :]
+        texts = self.tokenizer.batch_decode(tail)
+        # the text before the newest token is a prefix of the text
+        prev_lens = [len(text) for text in self.tokenizer.batch_decode(tail[:, :-1])]
+        done = torch.tensor(
+            [
+                any(
+                    s in text[max(prev_len - len(s) + 1, 0) :]
+                    for s in self.stop_strings
+                )
+                for text, prev_len in zip(texts, prev_lens)
+            ],
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
+        if PER_ROW_STOPPING:
+            return done
+        return bool(done.all())
+
+
+def get_stop_kwargs(
+    model, tokenizer, stop_strings: Optional[List[str]] = None, num_beams: int = 1
+):
+    """
+    The generate kwargs that end each row at <|endofchunk|>, the end of text or
+    one of stop_strings, instead of running to max_new_tokens.
+    The stop_strings are only used by the greedy or sampling generation
+    (num_beams=1). The beam search keeps every row in the batch until the
+    whole batch is done, so stopping single beams saves nothing, and stopping
+    the whole batch early can change which beams are kept.
+    """
+    kwargs = {'eos_token_id': [model.eoc_token_id, tokenizer.eos_token_id]}
+    if stop_strings and num_beams == 1:
+        kwargs['stopping_criteria'] = StoppingCriteriaList(
+            [StopStringCriteria(tokenizer, stop_strings)]
+        )
+    return kwargs
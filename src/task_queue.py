@@ -0,0 +1,186 @@
+import time
+from contextlib import contextmanager
+from typing import Callable, List
+
+import torch.multiprocessing as mp
+from loguru import logger
+from tqdm import tqdm
+
+
+class TaskQueueClient:
+    """
+    The rank side of run_task_queue. The ranks pull the tasks from one shared
+    queue, so a fast rank never waits for a slow one:
+
+        with task_queue.model_loading():
+            model = ...
+        for task_id, task in task_queue:
+            ...
+
+    A task is marked done when the loop body finishes without error.
+    """
+
+    def __init__(
+        self, rank, task_queue, load_semaphore, rank_loading, rank_task, task_done
+    ):
+        self.rank = rank
+        self.task_queue = task_queue
+        self.load_semaphore = load_semaphore
+        # the main process releases the load slot of a rank killed while loading
+        self.rank_loading = rank_loading
+        # shared memory, still readable by the main process if this rank crashes
+        self.rank_task = rank_task
+        self.task_done = task_done
+
+    @contextmanager
+    def model_loading(self):
+        # 限制同时加载模型的rank数, 上一个rank加载完成后下一个立即开始
+        self.load_semaphore.acquire()
+        self.rank_loading[self.rank] = True
+        try:
+            yield
+        finally:
+            self.rank_loading[self.rank] = False
+            self.load_semaphore.release()
+        logger.info(f'Rank: {self.rank} model is ready.')
+
+    def __iter__(self):
+        while True:
+            item = self.task_queue.get()
+            if item is None:
+                return
+            task_id, task = item
+            self.rank_task[self.rank] = task_id
+            yield task_id, task
+            self.task_done[task_id] = True
+            self.rank_task[self.rank] = -1
+
+
+def _worker(
+    rank,
+    worker_fn,
+    task_queue,
+    load_semaphore,
+    rank_loading,
+    rank_task,
+    task_done,
+    args,
+):
+    worker_fn(
+        rank,
+        TaskQueueClient(
+            rank, task_queue, load_semaphore, rank_loading, rank_task, task_done
+        ),
+        *args,
+    )
+
+
+def run_task_queue(
+    worker_fn: Callable,
+    args: tuple,
+    task_list: List,
+    nprocs: int,
+    max_parallel_load: int = 1,
+    poll_interval: float = 1.0,
+    max_task_retries: int = 1,
+):
+    """
+    Run worker_fn(rank, task_queue: TaskQueueClient, *args) in nprocs processes,
+    which pull the tasks of task_list from a shared queue. If a rank crashes, its
+    unfinished task is put back to the queue for the other ranks, and its model
+    loading slot is released if it died while loading. A task which crashed
+    more than max_task_retries times (e.g. a corrupt image) stops the run
+    instead of killing the remaining ranks one by one.
+    """
+    ctx = mp.get_context('spawn')
+    task_queue = ctx.Queue()
+    load_semaphore = ctx.Semaphore(max_parallel_load)
+    rank_loading = ctx.Array('b', nprocs, lock=False)
+    rank_task = ctx.Array('i', [-1] * nprocs, lock=False)
+    task_done = ctx.Array('b', len(task_list), lock=False)
+    for task_id, task in enumerate(task_list):
+        task_queue.put((task_id, task))
+
+    processes = [
+        ctx.Process(
+            target=_worker,
+            args=(
+                rank,
+                worker_fn,
+                task_queue,
+                load_semaphore,
+                rank_loading,
+                rank_task,
+                task_done,
+                args,
+            ),
+        )
+        for rank in range(nprocs)
+    ]
+    for p in processes:
+        p.start()
+
+    task_fail_num = [0] * len(task_list)
+
+    def requeue(task_id):
+        task_fail_num[task_id] += 1
+        if task_fail_num[task_id] > max_task_retries:
+            raise RuntimeError(
+                f'the task {task_id} {task_list[task_id]} failed '
+                f'{task_fail_num[task_id]} times, stop the run'
+            )
+        logger.warning(f're-queue the task {task_id}')
+        task_queue.put((task_id, task_list[task_id]))
+
+    alive = set(range(nprocs))
+    idle_poll_num = 0
+    pbar = tqdm(total=len(task_list), ncols=100)
+    finished = False
+    try:
+        while True:
+            time.sleep(poll_interval)
+            done_num = sum(task_done)
+            pbar.update(done_num - pbar.n)
+            if done_num == len(task_list):
+                break
+
+            for rank in [rank for rank in alive if not processes[rank].is_alive()]:
+                alive.remove(rank)
+                logger.warning(
+                    f'Rank: {rank} exited with code {processes[rank].exitcode}'
+                )
+                if rank_loading[rank]:
+                    # 加载模型时被kill, 信号量不会自动释放, 其他rank会一直等待
+                    logger.warning(f'release the model loading slot of Rank: {rank}')
+                    rank_loading[rank] = False
+                    load_semaphore.release()
+                task_id = rank_task[rank]
+                if task_id >= 0 and not task_done[task_id]:
+                    requeue(task_id)
+            if not alive:
+                raise RuntimeError(
+                    f'all ranks exited, {len(task_list) - done_num} tasks are not finished'
+                )
+
+            # a rank crashed between pulling a task and recording it, the task is
+            # lost. All ranks are waiting for an empty queue in this case.
+            running = {rank_task[rank] for rank in alive} - {-1}
+            if not running and task_queue.empty():
+                idle_poll_num += 1
+            else:
+                idle_poll_num = 0
+            if idle_poll_num >= 3:
+                for task_id in range(len(task_list)):
+                    if not task_done[task_id]:
+                        requeue(task_id)
+                idle_poll_num = 0
+        finished = True
+    finally:
+        pbar.close()
+        for p in processes:
+            if finished:
+                task_queue.put(None)
+            elif p.is_alive():
+                p.terminate()
+        for p in processes:
+            p.join()
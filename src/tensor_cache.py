@@ -0,0 +1,179 @@
+import os
+
+import more_itertools
+import numpy as np
+import open_clip
+import torch
+from loguru import logger
+from tqdm import tqdm
+
+from src.utils import get_vision_features
+
+
+class TensorCache:
+    """
+    A persistent tensor cache keyed by the dataset idx.
+
+    The tensors are stored in a memory-mapped fp16 .npy array of shape
+    (dataset_len, *item_shape), so it only needs to be built once per dataset
+    and can be opened by several processes at the same time. Rows are lazily
+    filled, a `filled.npy` flag array records which idx are ready.
+    """
+
+    def __init__(self, cache_dir, dataset_len, item_shape, dtype='float16'):
+        self.cache_dir = cache_dir
+        self.dataset_len = dataset_len
+        self.item_shape = tuple(item_shape)
+        self.dtype = dtype
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.data_path = os.path.join(self.cache_dir, 'data.npy')
+        self.filled_path = os.path.join(self.cache_dir, 'filled.npy')
+
+        shape = (self.dataset_len, *self.item_shape)
+        if os.path.exists(self.data_path):
+            self.data = np.load(self.data_path, mmap_mode='r+')
+            if self.data.shape != shape:
+                raise ValueError(
+                    f'the tensor cache {self.data_path} shape is {self.data.shape}, '
+                    f'but expect {shape}'
+                )
+        else:
+            self.data = np.lib.format.open_memmap(
+                self.data_path, mode='w+', dtype=self.dtype, shape=shape
+            )
+        if os.path.exists(self.filled_path):
+            self.filled = np.load(self.filled_path)
+        else:
+            self.filled = np.zeros(self.dataset_len, dtype=bool)
+
+    @classmethod
+    def open(cls, cache_dir):
+        """
+        Open an existing cache, the shape and dtype are read from the .npy header.
+        """
+        data = np.load(os.path.join(cache_dir, 'data.npy'), mmap_mode='r')
+        return cls(cache_dir, data.shape[0], data.shape[1:], str(data.dtype))
+
+    def __getstate__(self):
+        # only pickle the meta info, the memmap will be reopened in the new process
+        return {
+            'cache_dir': self.cache_dir,
+            'dataset_len': self.dataset_len,
+            'item_shape': self.item_shape,
+            'dtype': self.dtype,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return self.dataset_len
+
+    def __contains__(self, idx):
+        return bool(self.filled[idx])
+
+    def __getitem__(self, idx) -> torch.Tensor:
+        # zero copy: the tensor is a view of the memory-mapped file
+        if not self.filled[idx]:
+            raise KeyError(f'the idx {idx} is not in the tensor cache {self.cache_dir}')
+        return torch.from_numpy(self.data[idx])
+
+    def gather(self, idx_list):
+        return [self[idx] for idx in idx_list]
+
+    def missing(self, idx_list):
+        return sorted({idx for idx in idx_list if not self.filled[idx]})
+
+    def fill(self, idx_list, tensors: torch.Tensor):
+        self.data[idx_list] = tensors.detach().cpu().numpy().astype(self.dtype)
+        self.filled[idx_list] = True
+
+    def flush(self):
+        self.data.flush()
+        np.save(self.filled_path, self.filled)
+
+
+def get_image_size(clip_vision_encoder_path='ViT-L-14'):
+    image_size = open_clip.get_model_config(clip_vision_encoder_path)['vision_cfg'][
+        'image_size'
+    ]
+    if isinstance(image_size, int):
+        image_size = (image_size, image_size)
+    return tuple(image_size)
+
+
+def get_image_processor(clip_vision_encoder_path='ViT-L-14'):
+    # the same eval transform as open_flamingo, without loading the clip weights
+    return open_clip.image_transform(
+        get_image_size(clip_vision_encoder_path), is_train=False
+    )
+
+
+def build_image_cache(
+    cache_dir,
+    train_ds,
+    idx_list,
+    image_field,
+    clip_vision_encoder_path='ViT-L-14',
+    batch_size=128,
+):
+    idx_list = sorted(set(idx_list))
+    image_processor = get_image_processor(clip_vision_encoder_path)
+    cache = TensorCache(
+        cache_dir, len(train_ds), (3, *get_image_size(clip_vision_encoder_path))
+    )
+
+    missing_idx = cache.missing(idx_list)
+    logger.info(
+        f'image tensor cache {cache_dir}: {len(idx_list) - len(missing_idx)} hit, '
+        f'{len(missing_idx)} need to process'
+    )
+    for batch_idx in more_itertools.chunked(tqdm(missing_idx, ncols=100), batch_size):
+        images = train_ds.select(batch_idx)[image_field]
+        cache.fill(batch_idx, torch.stack([image_processor(image) for image in images]))
+    cache.flush()
+    return cache
+
+
+@torch.inference_mode()
+def build_vision_feature_cache(
+    cache_dir,
+    model,
+    image_processor,
+    train_ds,
+    image_field,
+    device,
+    autocast_context,
+    batch_size=128,
+    flush_every=50,
+):
+    """
+    Encode the whole train set by the frozen vision encoder + perceiver once,
+    so the data generation can skip the vision tower.
+    """
+    cache = TensorCache(
+        cache_dir,
+        len(train_ds),
+        (model.perceiver.latents.shape[0], model.vis_dim),
+    )
+    missing_idx = cache.missing(range(len(train_ds)))
+    logger.info(
+        f'vision feature cache {cache_dir}: {len(train_ds) - len(missing_idx)} hit, '
+        f'{len(missing_idx)} need to encode'
+    )
+    for i, batch_idx in enumerate(
+        more_itertools.chunked(tqdm(missing_idx, ncols=100), batch_size)
+    ):
+        images = train_ds.select(batch_idx)[image_field]
+        vision_x = torch.stack([image_processor(image) for image in images])
+        # (B, C, H, W) -> (B, T_img=1, F=1, C, H, W)
+        vision_x = vision_x[:, None, None].to(device=device, non_blocking=True)
+        with autocast_context:
+            features = get_vision_features(model, vision_x.float())
+        # (B, 1, n, d) -> (B, n, d)
+        cache.fill(batch_idx, features[:, 0])
+        if (i + 1) % flush_every == 0:
+            cache.flush()
+    cache.flush()
+    return cache
@@ -1,13 +1,13 @@
 import os
 from contextlib import suppress
 
-import faiss
 import more_itertools
 import numpy as np
 import torch
 from huggingface_hub import hf_hub_download
 from loguru import logger
 from open_flamingo import create_model_and_transforms
+from torch.utils.data import DataLoader
 from tqdm import tqdm
 from transformers import (
     AutoProcessor,
@@ -17,6 +17,10 @@ from transformers import (
     CLIPVisionModelWithProjection,
 )
 
+from src.ann_index import exact_search
+from src.feature_store import FeatureStore, get_dataset_fingerprint
+from src.prefetch import use_pin_memory
+
 
 def cast_type(precision):
     precision_list = ['fp16', 'bf16', 'fp32']
@@ -77,61 +81,343 @@ def init_flamingo(
     return model, image_processor, tokenizer, autocast_context
 
 
-def recall_sim_feature(test_vec, train_vec, top_k=200):
+def process_image(image_processor, image):
+    # the image from the tensor cache has been preprocessed
+    if isinstance(image, torch.Tensor):
+        return image
+    return image_processor(image)
+
+
+def stack_vision_input(image_list, vision_features=False, pin_memory=False):
+    """
+    Stack the image tensors of every sample into the flamingo vision input on cpu.
+    Returns {'vision_x': (B, T_img, 1, C, H, W)} for the preprocessed images, or
+    {'vision_features': (B, T_img, n, d)} for the cached perceiver features.
+    """
+    vision_x = torch.stack([torch.stack(images, dim=0) for images in image_list])
+    if pin_memory:
+        vision_x = vision_x.pin_memory()
+    if vision_features:
+        return {'vision_features': vision_x}
+    return {'vision_x': vision_x.unsqueeze(2)}
+
+
+def vision_input_to_device(vision_input, device):
+    return {
+        k: v.to(device=device, non_blocking=True).float()
+        for k, v in vision_input.items()
+    }
+
+
+def build_vision_input(image_list, device, vision_features=False):
+    return vision_input_to_device(
+        stack_vision_input(image_list, vision_features), device
+    )
+
+
+def get_vision_features(model, vision_x):
+    """
+    Encode the vision_x (B, T_img, 1, C, H, W) into the perceiver features
+    (B, T_img, n, d). The perceiver has no media time embedding in open_flamingo,
+    so every image can be encoded and cached independently.
+    """
+    b, T, F = vision_x.shape[:3]
+    vision_x = model.vision_encoder(vision_x.flatten(0, 2))[1]
+    vision_x = vision_x.view(b, T, F, *vision_x.shape[1:])
+    return model.perceiver(vision_x)
+
+
+def condition_vision_features(model, vision_features, lang_x):
+    for layer in model.lang_encoder._get_decoder_layers():
+        layer.condition_vis_x(vision_features)
+    model._condition_media_locations(input_ids=lang_x)
+    model.lang_encoder._use_cached_vision_x = True
+
+
+def flamingo_forward(model, vision_x=None, vision_features=None, **kwargs):
+    if vision_features is None:
+        return model(vision_x=vision_x, **kwargs)
+    # use the cached perceiver features, skip the vision encoder
+    condition_vision_features(model, vision_features, kwargs['lang_x'])
+    try:
+        return model(vision_x=None, **kwargs)
+    finally:
+        model.uncache_media()
+
+
+def flamingo_generate(
+    model, lang_x, attention_mask=None, vision_x=None, vision_features=None, **kwargs
+):
+    if vision_features is None:
+        return model.generate(
+            vision_x=vision_x, lang_x=lang_x, attention_mask=attention_mask, **kwargs
+        )
+    # the same as Flamingo.generate, but use the cached perceiver features
+    num_beams = kwargs.pop('num_beams', 1)
+    if num_beams > 1:
+        vision_features = vision_features.repeat_interleave(num_beams, dim=0)
+    condition_vision_features(model, vision_features, lang_x)
+    eos_token_id = kwargs.pop('eos_token_id', model.eoc_token_id)
+    try:
+        return model.lang_encoder.generate(
+            input_ids=lang_x,
+            attention_mask=attention_mask,
+            eos_token_id=eos_token_id,
+            num_beams=num_beams,
+            **kwargs,
+        )
+    finally:
+        model.uncache_media()
+
+
+def recall_sim_feature(
+    test_vec, train_vec, top_k=200, ann_index=None, feature_cache=None
+):
+    """
+    train_vec: an array or a FeatureStore, which is searched shard by shard.
+    ann_index: the AnnIndex to search, None is the exact flat search. The
+        ivf/hnsw index is persisted next to feature_cache.
+    """
     logger.info(f'embedding shape: {train_vec.shape}')
-    dim = train_vec.shape[-1]
-    index_feat = faiss.IndexFlatIP(dim)
-    index_feat.add(train_vec)
-    dist, index = index_feat.search(test_vec, top_k)
-    return dist, index
+    if ann_index is not None:
+        return ann_index.search(test_vec, train_vec, top_k, feature_cache)
+    return exact_search(test_vec, train_vec, top_k)
+
+
+def remove_anchor(anchor_set, sim_sample_idx, candidate_num):
+    """
+    Remove the anchor itself and the missing results (-1) from the top_k =
+    candidate_num + 1 results of every anchor. The anchor is usually the first
+    one, but not always for an approximate index.
+    """
+    candidate_set_idx = {}
+    for anchor, idx_list in zip(anchor_set, sim_sample_idx.tolist()):
+        cand = [i for i in idx_list if i != anchor and i >= 0]
+        candidate_set_idx[anchor] = cand[:candidate_num]
+    return candidate_set_idx
+
+
+class ClipEncodeCollator:
+    """Decode and preprocess a batch of rows in the DataLoader workers."""
+
+    def __init__(self, fields, tokenizer=None, processor=None):
+        # fields: {'text' or 'image': data_key}
+        self.fields = fields
+        self.tokenizer = tokenizer
+        self.processor = processor
+
+    def __call__(self, batch):
+        inputs = {}
+        if 'text' in self.fields:
+            text_list = [i[self.fields['text']] for i in batch]
+            inputs['text'] = dict(
+                self.tokenizer(text_list, padding=True, return_tensors="pt")
+            )
+        if 'image' in self.fields:
+            images = [i[self.fields['image']] for i in batch]
+            inputs['image'] = dict(self.processor(images=images, return_tensors="pt"))
+        return inputs
 
 
 @torch.inference_mode()
-def encode_text(
+def encode_features(
     train_ds,
-    data_key,
+    fields,
     device,
     model_type='openai/clip-vit-large-patch14',
     batch_size=128,
+    num_workers=0,
 ):
-    model = CLIPTextModelWithProjection.from_pretrained(model_type).to(device)
-    model.eval()
-    tokenizer = AutoTokenizer.from_pretrained(model_type)
-    final_text_feature = []
+    """
+    Encode the normalized clip features of train_ds into FeatureStores, all
+    the modalities in one pass over the data, e.g. the text and the image of
+    the MixSimSampler.
+    fields: {'text' or 'image': (data_key, store_dir)}.
+    The rows are decoded and preprocessed by num_workers DataLoader workers,
+    the texts of a shard are batched from the longest to the shortest to
+    reduce the padding. Only the unfinished shards are encoded, so an
+    interrupted encoding resumes where it stopped.
+
+    Returns:
+        {'text' or 'image': FeatureStore}
+    """
+    fingerprint = get_dataset_fingerprint(train_ds)
+    models, stores = {}, {}
+    for modality, (data_key, store_dir) in fields.items():
+        model_cls = (
+            CLIPTextModelWithProjection
+            if modality == 'text'
+            else CLIPVisionModelWithProjection
+        )
+        models[modality] = model_cls.from_pretrained(model_type).to(device)
+        models[modality].eval()
+        stores[modality] = FeatureStore.create(
+            store_dir,
+            len(train_ds),
+            models[modality].config.projection_dim,
+            model_type,
+            data_key,
+            fingerprint,
+        )
+    tokenizer = AutoTokenizer.from_pretrained(model_type) if 'text' in fields else None
+    processor = AutoProcessor.from_pretrained(model_type) if 'image' in fields else None
+    shard_store = next(iter(stores.values()))
+
+    for shard_id in range(shard_store.shard_num):
+        todo = [m for m in fields if not stores[m].is_done(shard_id)]
+        if not todo:
+            continue
+        keys = {m: fields[m][0] for m in todo}
+        # 只读取需要编码的列, 纯文本时不解码图片
+        data = train_ds.select_columns(sorted(set(keys.values())))
+        rows = shard_store.shard_rows(shard_id)
+        if 'text' in todo:
+            lengths = [
+                len(input_ids)
+                for input_ids in tokenizer(list(data.select(rows)[keys['text']]))[
+                    'input_ids'
+                ]
+            ]
+            batches = [
+                [rows[i] for i in batch]
+                for batch in chunk_by_token_budget(
+                    lengths, batch_size, sort_by_length=True
+                )
+            ]
+        else:
+            batches = list(more_itertools.chunked(rows, batch_size))
+        loader = DataLoader(
+            data,
+            batch_sampler=batches,
+            collate_fn=ClipEncodeCollator(keys, tokenizer, processor),
+            num_workers=num_workers,
+            pin_memory=use_pin_memory(device),
+        )
+        for batch_idx, inputs in zip(
+            batches,
+            tqdm(loader, desc=f'shard {shard_id + 1}/{shard_store.shard_num}'),
+        ):
+            for modality in todo:
+                model_inputs = {
+                    k: v.to(device, non_blocking=True)
+                    for k, v in inputs[modality].items()
+                }
+                outputs = models[modality](**model_inputs)
+                feature = (
+                    outputs.text_embeds if modality == 'text' else outputs.image_embeds
+                )
+                feature /= feature.norm(dim=-1, keepdim=True)
+                stores[modality].write(batch_idx, feature)
+        for modality in todo:
+            stores[modality].mark_done(shard_id)
+
+    for store in stores.values():
+        store.finish()
+    return stores
 
-    for batch in more_itertools.chunked(tqdm(train_ds), batch_size):
-        text_list = [i[data_key] for i in batch]
-        inputs = tokenizer(text_list, padding=True, return_tensors="pt").to(device)
-        text_feature = model(**inputs).text_embeds
-        text_feature /= text_feature.norm(dim=-1, keepdim=True)
-        final_text_feature.append(text_feature)
 
-    final_text_feature = torch.cat(final_text_feature, dim=0)
-    return final_text_feature.detach().cpu().numpy()
+def encode_text(
+    train_ds,
+    data_key,
+    device,
+    store_dir,
+    model_type='openai/clip-vit-large-patch14',
+    batch_size=128,
+    num_workers=0,
+):
+    return encode_features(
+        train_ds,
+        {'text': (data_key, store_dir)},
+        device,
+        model_type,
+        batch_size,
+        num_workers,
+    )['text']
 
 
-@torch.inference_mode()
 def encode_image(
     train_ds,
     data_key,
     device,
+    store_dir,
     model_type='openai/clip-vit-large-patch14',
     batch_size=128,
+    num_workers=0,
 ):
-    model = CLIPVisionModelWithProjection.from_pretrained(model_type).to(device)
-    processor = AutoProcessor.from_pretrained(model_type)
-    model.eval()
+    return encode_features(
+        train_ds,
+        {'image': (data_key, store_dir)},
+        device,
+        model_type,
+        batch_size,
+        num_workers,
+    )['image']
+
+
+def load_feature_stores(
+    train_ds,
+    fields,
+    device,
+    model_type='openai/clip-vit-large-patch14',
+    batch_size=128,
+    num_workers=0,
+):
+    """
+    Open the FeatureStores of the clip features that match the model, the
+    field and the dataset, the others are encoded together by encode_features.
+    The old torch.save cache at <store_dir>.pth is converted instead.
+    fields: {'text' or 'image': (data_key, store_dir)}.
+    """
+    fingerprint = get_dataset_fingerprint(train_ds)
+    stores, missing = {}, {}
+    for modality, (data_key, store_dir) in fields.items():
+        if FeatureStore.exists(store_dir):
+            store = FeatureStore.open(store_dir)
+            if store.matches(model_type, data_key, fingerprint, len(train_ds)):
+                logger.info(f'feature store {store_dir} exists, loading...')
+                stores[modality] = store
+                continue
+            if store.meta['complete']:
+                logger.warning(
+                    f'the feature store {store_dir} ({store.meta}) does not match '
+                    f'{model_type=}, {data_key=}, {fingerprint=}, re-encoding...'
+                )
+        elif os.path.exists(f'{store_dir}.pth'):
+            features = np.asarray(torch.load(f'{store_dir}.pth', weights_only=False))
+            if len(features) == len(train_ds):
+                logger.info(f'convert the feature cache {store_dir}.pth to {store_dir}')
+                stores[modality] = FeatureStore.from_array(
+                    store_dir, features, model_type, data_key, fingerprint
+                )
+                continue
+        missing[modality] = (data_key, store_dir)
+    if missing:
+        stores.update(
+            encode_features(
+                train_ds, missing, device, model_type, batch_size, num_workers
+            )
+        )
+    return stores
 
-    final_image_feature = []
-    for batch in more_itertools.chunked(tqdm(train_ds), batch_size):
-        images = [i[data_key] for i in batch]
-        inputs = processor(images=images, return_tensors="pt").to(device)
-        image_feature = model(**inputs).image_embeds
-        image_feature /= image_feature.norm(dim=-1, keepdim=True)
-        final_image_feature.append(image_feature)
 
-    final_image_feature = torch.cat(final_image_feature, dim=0)
-    return final_image_feature.detach().cpu().numpy()
+def load_feature_store(
+    store_dir,
+    modality,
+    train_ds,
+    data_key,
+    device,
+    model_type='openai/clip-vit-large-patch14',
+    batch_size=128,
+    num_workers=0,
+):
+    return load_feature_stores(
+        train_ds,
+        {modality: (data_key, store_dir)},
+        device,
+        model_type,
+        batch_size,
+        num_workers,
+    )[modality]
 
 
 def data_split(generated_data, train_ratio):
@@ -214,22 +500,67 @@ def collate_fn(batch, processor: CLIPProcessor):
     return collate_dict
 
 
-def load_feature_cache(cfg, cache_path, encoding_method, train_ds, data_key):
-    if os.path.exists(cache_path):
-        features = torch.load(cache_path)
-    else:
-        features = encoding_method(
-            train_ds,
-            data_key,
-            cfg.device,
-            cfg.sim_model_type,
-            cfg.candidate_set_encode_bs,
-        )
-        torch.save(features, cache_path)
-    return features
+def load_feature_cache(cfg, cache_path, modality, train_ds, data_key):
+    return load_feature_store(
+        cache_path,
+        modality,
+        train_ds,
+        data_key,
+        cfg.device,
+        cfg.sim_model_type,
+        cfg.candidate_set_encode_bs,
+        cfg.candidate_set_encode_workers,
+    )
 
 
-def beam_filter(score_list, data_id_list, beam_size):
-    score_list = torch.tensor(score_list)
-    score_value, indices = torch.topk(score_list, beam_size)
-    return score_value.tolist(), [data_id_list[idx] for idx in indices]
+def chunk_by_token_budget(
+    lengths, batch_size, max_batch_tokens=None, sort_by_length=False
+):
+    """
+    Greedily pack the rows (in order) into batches. A batch is closed when it
+    has batch_size rows, or when adding the next row makes the padded token num
+    (row num * max length) exceed max_batch_tokens.
+    If sort_by_length, the rows are packed from the longest to the shortest, so
+    the rows of similar length share a batch and less padding is needed.
+    batch_size can also be a function of the max length of the batch, e.g.
+    AdaptiveBatchSizer.get_batch_size.
+
+    Returns:
+        A list of batches, each is a list of row index.
+    """
+
+    def get_batch_size(length):
+        return batch_size(length) if callable(batch_size) else batch_size
+
+    order = range(len(lengths))
+    if sort_by_length:
+        order = sorted(order, key=lambda i: lengths[i], reverse=True)
+    batches = []
+    batch = []
+    batch_max_len = 0
+    for i in order:
+        length = lengths[i]
+        new_max_len = max(batch_max_len, length)
+        if batch and (
+            len(batch) >= get_batch_size(new_max_len)
+            or (
+                max_batch_tokens is not None
+                and new_max_len * (len(batch) + 1) > max_batch_tokens
+            )
+        ):
+            batches.append(batch)
+            batch = []
+            new_max_len = length
+        batch.append(i)
+        batch_max_len = new_max_len
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def get_padding_ratio(lengths, batches):
+    # the ratio of padding tokens in all padded batches
+    padded_num = sum(max(lengths[i] for i in batch) * len(batch) for batch in batches)
+    if padded_num == 0:
+        return 0.0
+    return 1 - sum(lengths) / padded_num